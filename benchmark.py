@@ -0,0 +1,138 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+from dotenv import load_dotenv
+from exceptions import MetrikaAPIError
+from mock_api import MockYandexServer
+from sinks import Sink, get_sink
+
+load_dotenv()
+
+
+def run_pipeline(name: str, func, args: tuple, server: MockYandexServer, sink: Sink, trace_memory: bool = True) -> dict:
+    """Прогоняет один пайплайн main.py против мок-сервера и возвращает метрики"""
+    server.requests.clear()
+    rows_before = sum(sink.rows.values())
+    error = None
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+    except MetrikaAPIError as e:
+        error = str(e)
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    requests_count = sum(server.requests.values())
+    rows = sum(sink.rows.values()) - rows_before
+    return {
+        'pipeline': name,
+        'seconds': round(elapsed, 4),
+        'requests': requests_count,
+        'requests_per_second': round(requests_count / elapsed, 2) if elapsed else 0,
+        'rows': rows,
+        'rows_per_second': round(rows / elapsed, 2) if elapsed else 0,
+        'peak_traced_memory_bytes': peak,
+        'requests_by_endpoint': dict(server.requests),
+        'error': error
+    }
+
+
+def run_benchmark(date_from: str, date_to: str, sink_name: str = 'null', latency: float = 0.0,
+                  jitter: float = 0.0, tail_rate: float = 0.0, tail_latency: float = 0.0, error_rate: float = 0.0, rows: int = 100, sections: int = 8,
+                  trace_memory: bool = True) -> dict:
+    """
+    Запускает get_metrika_data и get_webmaster_data против локального мок-сервера
+
+    :param sink_name: 'null' - строки только считаются, 'sqlite' - встроенная база (SQLITE_PATH),
+        'postgres' - запись в БД из DB_CONFIG
+    :return: Словарь с параметрами прогона и метриками по каждому пайплайну
+    """
+    with MockYandexServer(latency=latency, jitter=jitter, tail_rate=tail_rate, tail_latency=tail_latency,
+                          error_rate=error_rate, rows=rows, sections=sections) as server:
+        os.environ['METRIKA_API_URL'] = server.url
+        os.environ['WEBMASTER_API_URL'] = f'{server.url}/v4'
+
+        import main
+        from core import get_yandex_webmaster_user_id
+
+        user_id = get_yandex_webmaster_user_id('mock-token')
+
+        with get_sink(sink_name) as sink:
+            sink.create_tables()
+            results = [
+                run_pipeline('metrika', main.get_metrika_data,
+                             ('mock-token', '12345678', date_from, date_to, sink), server, sink, trace_memory),
+                run_pipeline('webmaster', main.get_webmaster_data,
+                             ('mock-token', 'https:zaruku.ru:443', user_id, date_from, date_to, sink),
+                             server, sink, trace_memory)
+            ]
+
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'sink': sink_name,
+        'latency': latency,
+        'jitter': jitter,
+        'tail_rate': tail_rate,
+        'tail_latency': tail_latency,
+        'error_rate': error_rate,
+        'rows': rows,
+        'sections': sections,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"Период {report['date_from']} - {report['date_to']}, sink={report['sink']}, "
+        f"latency={report['latency']}s, error_rate={report['error_rate']}, rows={report['rows']}",
+        f"{'пайплайн':<12}{'сек':>9}{'запросы':>10}{'req/s':>10}{'строки':>10}{'rows/s':>12}{'пик, МБ':>10}"
+    ]
+    for r in report['results']:
+        peak = f"{r['peak_traced_memory_bytes'] / 1024 / 1024:.1f}" if r['peak_traced_memory_bytes'] is not None else '-'
+        lines.append(
+            f"{r['pipeline']:<12}{r['seconds']:>9.2f}{r['requests']:>10}{r['requests_per_second']:>10.1f}"
+            f"{r['rows']:>10}{r['rows_per_second']:>12.1f}{peak:>10}"
+        )
+        if r['error']:
+            lines.append(f"  прервано: {r['error']}")
+    lines.append(f"max RSS: {report['max_rss_kb'] / 1024:.1f} МБ")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк пайплайнов main.py на локальном мок-сервере API')
+    parser.add_argument('--date-from', default='2025-01-01')
+    parser.add_argument('--date-to', default='2025-03-31')
+    parser.add_argument('--sink', choices=['null', 'sqlite', 'postgres'], default='null')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа мок-сервера, секунды')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Разброс задержки, секунды')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='Доля «зависающих» ответов')
+    parser.add_argument('--tail-latency', type=float, default=0.0, help='Задержка зависающих ответов, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой 500')
+    parser.add_argument('--rows', type=int, default=100, help='Размер ответов с группировками')
+    parser.add_argument('--sections', type=int, default=8, help='Количество разделов сайта на мок-сервере')
+    parser.add_argument('--no-trace-memory', action='store_true', help='Не включать tracemalloc (быстрее, без пика памяти)')
+    parser.add_argument('--json', metavar='PATH', help='Сохранить результат в JSON для отслеживания регрессий')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.date_from, args.date_to, args.sink, args.latency, args.jitter,
+                           args.tail_rate, args.tail_latency, args.error_rate, args.rows, args.sections, not args.no_trace_memory)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,186 @@
+import os
+
+from collections import Counter
+from core import MetrikaQueryPlanner, YandexMetrika
+from datetime import date, timedelta
+from typing import NamedTuple
+from utils import generate_daily_periods, generate_monthly_periods
+
+# Квоты API на сервис. Метрика ограничивает запросы в секунду с IP и в сутки на пользователя,
+# Вебмастер - в сутки на пользователя. Значения по умолчанию взяты с запасом
+METRIKA_CALLS_PER_SECOND = float(os.getenv('METRIKA_CALLS_PER_SECOND', 10))
+METRIKA_CALLS_PER_DAY = int(os.getenv('METRIKA_CALLS_PER_DAY', 5000))
+WEBMASTER_CALLS_PER_SECOND = float(os.getenv('WEBMASTER_CALLS_PER_SECOND', 5))
+WEBMASTER_CALLS_PER_DAY = int(os.getenv('WEBMASTER_CALLS_PER_DAY', 10000))
+
+STAT_ENDPOINT = '/stat/v1/data'
+WEBMASTER_QUERIES_ENDPOINT = '/search-queries/popular'
+
+# Таблица, по которой проверяется, что единица работы уже выгружена
+UNIT_TABLES = {
+    'section': 'all_traffic_by_url',
+    'referral': 'referral_urls',
+    'webmaster': 'search_queries_webmaster',
+    'section_daily': 'all_traffic_by_url_daily',
+    'referral_daily': 'referral_urls_daily',
+    'webmaster_daily': 'search_queries_webmaster_daily'
+}
+
+
+class ApiBudget(NamedTuple):
+    """Квота одного сервиса"""
+    service: str
+    per_second: float
+    per_day: int
+
+
+class WorkUnit(NamedTuple):
+    """Единица работы пайплайна: один вид выгрузки (раздел, рефереры, запросы) за один период"""
+    service: str
+    kind: str
+    url: str
+    date_from: str
+    date_to: str
+    endpoint: str
+    calls: int
+
+
+class Schedule(NamedTuple):
+    """Результат планирования: что выполнить в этом запуске, что отложить"""
+    scheduled: list
+    deferred: list
+    remaining: dict
+    seconds: dict
+
+
+def default_budgets(tokens: int = 1) -> dict:
+    """
+    Квоты сервисов для пула из ``tokens`` токенов: суточная квота у каждого пользователя своя
+    и складывается, ограничение в секунду Метрика считает по IP, поэтому оно общее
+    """
+    return {
+        'metrika': ApiBudget('metrika', METRIKA_CALLS_PER_SECOND, METRIKA_CALLS_PER_DAY * tokens),
+        'webmaster': ApiBudget('webmaster', WEBMASTER_CALLS_PER_SECOND, WEBMASTER_CALLS_PER_DAY * tokens)
+    }
+
+
+def section_calls(metrika: YandexMetrika, url: str, date_from: str, date_to: str, daily: bool = False) -> int:
+    """
+    Сколько вызовов /stat/v1/data займёт выгрузка раздела за период.
+    Считается тем же планировщиком, что и при реальной выгрузке, без запросов к API
+    """
+    planner = MetrikaQueryPlanner(metrika)
+    metrika.plan_all_traffic_by_url(planner, date_from, date_to, url)
+    metrika.plan_behavior_metrics(planner, date_from, date_to, url)
+    metrika.plan_search_engines_traffic(planner, date_from, date_to, url)
+    # Месячная выгрузка дополнительно запрашивает органические страницы раздела
+    return len(planner.plan()) + (0 if daily else 1)
+
+
+def enumerate_units(metrika: YandexMetrika, sink, sections: list, date_from: str, date_to: str,
+                    grain: str = 'monthly', settle_days: int = 1, discover: bool = False,
+                    today: date = None) -> tuple:
+    """
+    Перечисляет вызовы API, которые сделает запуск, с учётом уже выгруженных данных.
+
+    Попаданием в кеш считаются закрытые периоды, записанные после того, как данные
+    устоялись (через settle_days после конца периода). Открытый месяц выгружается всегда.
+    В дневном режиме неустоявшиеся дни не выгружаются вовсе.
+
+    :return: (список WorkUnit, Counter (сервис, эндпоинт) -> вызовы, сэкономленные кешем)
+    """
+    today = today or date.today()
+    last_settled = (today - timedelta(days=settle_days)).strftime('%Y-%m-%d')
+    units = []
+    cache_hits = Counter()
+
+    if discover:
+        units.append(WorkUnit('metrika', 'discover', None, None, None, STAT_ENDPOINT, 1))
+
+    if grain == 'daily':
+        date_to = min(date_to, last_settled)
+        periods = [(day, day) for day in generate_daily_periods(date_from, date_to)] if date_from <= date_to else []
+        suffix = '_daily'
+    else:
+        periods = generate_monthly_periods(date_from, date_to)
+        suffix = ''
+
+    def add(service: str, kind: str, url: str, endpoint: str, calls):
+        # Месячные периоды начинаются с 1-го числа, даже если date_from - середина месяца.
+        # Попадание - только период с тем же date_to: частичная выгрузка месяца его не закрывает
+        loaded = sink.get_loaded_days(UNIT_TABLES[kind], periods[0][0], date_to, url, settle_days) if periods else set()
+        for period_from, period_to in periods:
+            count = calls(period_from, period_to)
+            if period_to <= last_settled and (period_from, period_to) in loaded:
+                cache_hits[(service, endpoint)] += count
+            else:
+                units.append(WorkUnit(service, kind, url, period_from, period_to, endpoint, count))
+
+    for url in sections:
+        add('metrika', 'section' + suffix, url, STAT_ENDPOINT,
+            lambda d1, d2: section_calls(metrika, url, d1, d2, daily=bool(suffix)))
+    add('metrika', 'referral' + suffix, None, STAT_ENDPOINT, lambda d1, d2: 1)
+    add('webmaster', 'webmaster' + suffix, None, WEBMASTER_QUERIES_ENDPOINT, lambda d1, d2: 1)
+    return units, cache_hits
+
+
+def prioritize(units: list, today: date = None) -> list:
+    """Сначала обновление каталога, затем открытый месяц, затем периоды от свежих к старым"""
+    today = today or date.today()
+    open_from = today.replace(day=1).strftime('%Y-%m-%d')
+    units = sorted(units, key=lambda unit: unit.date_from or '', reverse=True)
+    return sorted(units, key=lambda unit: (unit.kind != 'discover', (unit.date_to or '') < open_from))
+
+
+def schedule_units(units: list, budgets: dict, used: dict = None, today: date = None) -> Schedule:
+    """
+    Раскладывает единицы работы в дневную квоту с учётом уже израсходованного сегодня.
+    Не поместившееся откладывается: следующий запуск найдёт эти периоды невыгруженными
+    и возьмёт их в первую очередь после открытого месяца.
+    """
+    used = used or {}
+    remaining = {service: max(0, budget.per_day - used.get(service, 0)) for service, budget in budgets.items()}
+    scheduled, deferred = [], []
+    for unit in prioritize(units, today):
+        if unit.calls <= remaining[unit.service]:
+            remaining[unit.service] -= unit.calls
+            scheduled.append(unit)
+        else:
+            deferred.append(unit)
+
+    seconds = {}
+    for service, budget in budgets.items():
+        calls = sum(unit.calls for unit in scheduled if unit.service == service)
+        seconds[service] = calls / budget.per_second if budget.per_second else 0.0
+    return Schedule(scheduled, deferred, remaining, seconds)
+
+
+def format_plan(units: list, cache_hits: Counter, schedule: Schedule, budgets: dict, used: dict = None) -> str:
+    """Отчёт dry-run: вызовы по эндпоинтам, попадания в кеш и раскладка по квоте"""
+    used = used or {}
+    needed = Counter()
+    planned = Counter()
+    for unit in units:
+        needed[(unit.service, unit.endpoint)] += unit.calls
+    for unit in schedule.scheduled:
+        planned[(unit.service, unit.endpoint)] += unit.calls
+
+    lines = [f"{'сервис':<11}{'эндпоинт':<26}{'нужно':>8}{'кеш':>8}{'сейчас':>8}{'отложено':>10}"]
+    for service, endpoint in sorted(set(needed) | set(cache_hits)):
+        lines.append(
+            f"{service:<11}{endpoint:<26}{needed[(service, endpoint)]:>8}{cache_hits[(service, endpoint)]:>8}"
+            f"{planned[(service, endpoint)]:>8}{needed[(service, endpoint)] - planned[(service, endpoint)]:>10}"
+        )
+    for service, budget in budgets.items():
+        lines.append(
+            f"{service}: израсходовано сегодня {used.get(service, 0)} из {budget.per_day}, "
+            f"после запуска останется {schedule.remaining[service]}, "
+            f"не меньше {schedule.seconds[service]:.0f} с при {budget.per_second:g} запр/с"
+        )
+    lines.append(f"Единиц работы: {len(schedule.scheduled)} в этом запуске, {len(schedule.deferred)} отложено")
+    periods = [unit for unit in schedule.deferred if unit.date_from]
+    if periods:
+        oldest = min(unit.date_from for unit in periods)
+        newest = max(unit.date_to for unit in periods)
+        lines.append(f"Отложенные периоды: {oldest} - {newest}")
+    return '\n'.join(lines)
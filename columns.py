@@ -0,0 +1,112 @@
+import itertools
+import numpy as np
+import operator
+
+from array import array
+
+
+class ResponseColumns:
+    """
+    Ответ /stat/v1/data в виде колонок.
+
+    ``metrics`` - матрица float64 (строки x метрики). Каждая группировка хранится
+    словарём: ``labels[i]`` - уникальные значения в порядке появления,
+    ``codes[i]`` - номер значения для каждой строки (int32). Операции над строками
+    (суммы, доли, корзины, топ) выполняются над массивами, а строки группировок
+    обрабатываются один раз на уникальное значение.
+    """
+
+    def __init__(self, metrics: np.ndarray, codes: list, labels: list):
+        self.metrics = metrics
+        self.codes = codes
+        self.labels = labels
+
+    def __len__(self) -> int:
+        return self.metrics.shape[0]
+
+    def metric(self, index: int) -> np.ndarray:
+        return self.metrics[:, index]
+
+    def dimension(self, index: int) -> np.ndarray:
+        """Значения группировки по строкам (object-массив)"""
+        return self.labels[index][self.codes[index]]
+
+
+def to_columns(data, dimension_key: str = 'name') -> ResponseColumns:
+    """
+    Преобразует ответ API в ResponseColumns
+
+    :param data: Ответ /stat/v1/data (или result логического запроса планировщика)
+        либо JsonStream по его строкам
+    :param dimension_key: Какое поле группировки брать ('name' или 'id')
+    """
+    if not isinstance(data, dict):
+        return _stream_to_columns(data, dimension_key)
+    rows = data.get('data', [])
+    width = len(rows[0]['metrics']) if rows else len(data.get('query', {}).get('metrics', []))
+    # Разбор строк ответа - единственный проход на Python; дальше только операции над массивами
+    metrics = np.fromiter(
+        itertools.chain.from_iterable(map(operator.itemgetter('metrics'), rows)),
+        dtype=np.float64, count=len(rows) * width
+    ).reshape(len(rows), width)
+
+    codes, labels = [], []
+    dimensions = len(rows[0]['dimensions']) if rows else 0
+    for i in range(dimensions):
+        values = [row['dimensions'][i].get(dimension_key) for row in rows]
+        unique = list(dict.fromkeys(values))
+        index = {value: code for code, value in enumerate(unique)}
+        codes.append(np.fromiter(map(index.__getitem__, values), dtype=np.int32, count=len(values)))
+        labels.append(np.array(unique, dtype=object))
+    return ResponseColumns(metrics, codes, labels)
+
+
+def _stream_to_columns(stream, dimension_key: str) -> ResponseColumns:
+    # Один проход по потоку: метрики копятся в array('d'), группировки - сразу кодами словаря
+    values = array('d')
+    codes, indexes = None, None
+    rows = 0
+    for row in stream:
+        rows += 1
+        values.extend(row['metrics'])
+        dimensions = row['dimensions']
+        if codes is None:
+            codes = [array('i') for _ in dimensions]
+            indexes = [{} for _ in dimensions]
+        for i, dimension in enumerate(dimensions):
+            index = indexes[i]
+            codes[i].append(index.setdefault(dimension.get(dimension_key), len(index)))
+
+    if not rows:
+        width = len((stream.query or {}).get('metrics', []))
+        return ResponseColumns(np.empty((0, width)), [], [])
+    return ResponseColumns(
+        np.frombuffer(values, dtype=np.float64).reshape(rows, -1),
+        [np.frombuffer(column, dtype=np.int32) for column in codes],
+        [np.array(list(index), dtype=object) for index in indexes]
+    )
+
+
+def shares(values: np.ndarray, decimals: int = 1) -> np.ndarray:
+    """Доли значений от суммы в процентах (нули, если сумма 0)"""
+    total = values.sum()
+    if total <= 0:
+        return np.zeros_like(values)
+    return np.round(values / total * 100, decimals)
+
+
+def bucket_sums(codes: np.ndarray, labels: np.ndarray, values: np.ndarray, classify, size: int) -> np.ndarray:
+    """
+    Суммирует values по ``size`` корзинам. ``classify(label)`` возвращает номер корзины
+    или -1, чтобы отбросить строку; вызывается один раз на уникальное значение, а не на строку
+    """
+    buckets = np.array([classify(label) for label in labels], dtype=np.int64)
+    row_buckets = buckets[codes]
+    keep = row_buckets >= 0
+    return np.bincount(row_buckets[keep], weights=values[keep], minlength=size)
+
+
+def top_n(values: np.ndarray, n: int = None) -> np.ndarray:
+    """Индексы n наибольших значений по убыванию (при равенстве - в исходном порядке)"""
+    order = np.argsort(-values, kind='stable')
+    return order if n is None else order[:n]
@@ -1,8 +1,23 @@
+import numpy as np
+import os
 import requests
+import time
 
 from exceptions import MetrikaAPIError, MetrikaAuthError
+from profiling import profiler
+from collections import Counter
+from columns import bucket_sums, shares, to_columns, top_n
+from jsonstream import JsonStream
+from resilience import (
+    RATE_LIMIT_BACKOFF_SECONDS, RATE_LIMIT_RETRIES, CircuitBreaker, HedgingPolicy, LatencyTracker, PooledToken,
+    RateLimiter, TokenPool
+)
 from urllib.parse import urlparse, urlunparse
 
+# Адреса API можно переопределить через окружение (например, на локальный мок-сервер для бенчмарков)
+METRIKA_API_URL = 'https://api-metrika.yandex.net'
+WEBMASTER_API_URL = 'https://api.webmaster.yandex.net/v4'
+
 def get_yandex_webmaster_user_id(oauth_token: str) -> str:
     """
     Получает user_id для API Яндекс.Вебмастера
@@ -16,7 +31,7 @@ def get_yandex_webmaster_user_id(oauth_token: str) -> str:
     Raises:
         Exception: Если запрос не удался
     """
-    url = "https://api.webmaster.yandex.net/v4/user"
+    url = f"{os.getenv('WEBMASTER_API_URL', WEBMASTER_API_URL)}/user"
     
     headers = {
         "Authorization": f"OAuth {oauth_token}",
@@ -24,9 +39,11 @@ def get_yandex_webmaster_user_id(oauth_token: str) -> str:
     }
     
     try:
-        response = requests.get(url, headers=headers)
+        with profiler.stage('api_wait'):
+            response = requests.get(url, headers=headers)
         response.raise_for_status()  # Проверка ошибок HTTP
-        return response.json()['user_id']
+        with profiler.stage('json_decode'):
+            return response.json()['user_id']
         
     except requests.exceptions.RequestException as e:
         error_msg = f"Ошибка при запросе user_id: {str(e)}"
@@ -35,82 +52,477 @@ def get_yandex_webmaster_user_id(oauth_token: str) -> str:
         raise Exception(error_msg) from e
 
 
-class YandexWebmaster:
-    def __init__(self, token: str, host: str, user_id: str, timeout: int = 20):
+def _retry_after(response: requests.Response) -> float:
+    """Пауза из заголовка Retry-After (в секундах) или RATE_LIMIT_BACKOFF_SECONDS"""
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', RATE_LIMIT_BACKOFF_SECONDS)))
+    except ValueError:
+        return RATE_LIMIT_BACKOFF_SECONDS
+
+
+def _quota_exhausted(response: requests.Response) -> bool:
+    """
+    429 из-за суточной квоты пользователя (токена). Квоты по IP и на параллельные
+    запросы общие для всех токенов, поэтому карантин токена от них не спасает
+    """
+    body = response.text.lower()
+    return 'quota' in body and 'by_ip' not in body and 'parallel' not in body
+
+
+class BaseYandexClient:
+    """
+    Общая часть клиентов API: сессия, пул токенов, хеджирование медленных запросов
+    и предохранители по эндпоинтам.
+
+    :param token: OAuth-токен, список токенов или TokenPool. Каждый запрос уходит
+        токену с наибольшим запасом квоты; после 403/429 запрос повторяется с другим токеном
+    :param hedge: Включить хеджирование. По умолчанию из API_HEDGE (0/1)
+    :param rate_limit: Не больше стольких запросов в секунду (None - без ограничения)
+    """
+
+    def __init__(self, token, timeout: int = 20, hedge: bool = None, rate_limit: float = None):
+        self.tokens = token if isinstance(token, TokenPool) else TokenPool(token)
         self.session = requests.Session()
-        self.session.headers.update({
-            'Authorization': f'OAuth {token}',
-            'Content-Type': 'application/json'
-        })
+        self.session.headers.update({"Content-Type": "application/json"})
         self.timeout = timeout
-        self.host = host
-        self.user_id = user_id
+        if hedge is None:
+            hedge = os.getenv('API_HEDGE', '0') == '1'
+        self.hedging = HedgingPolicy() if hedge else None
+        self.latency = LatencyTracker()
+        self.breakers = {}
+        # Общий для всех токенов: и ограничение частоты, и пауза после 429
+        self.limiter = RateLimiter(rate_limit)
+        # Фактически отправленные запросы по эндпоинтам, включая дубликаты хеджирования
+        self.calls = Counter()
+
+    def _breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(endpoint)
+        return self.breakers[endpoint]
+
+    def _token_url(self, full_url: str, token: PooledToken) -> str:
+        """Адрес запроса для конкретного токена (у Вебмастера в адресе user_id владельца токена)"""
+        return full_url
 
-    def _request(self, method: str, url: str, **kwargs) -> dict:
-        """Базовый метод запроса"""
+    def _send(self, method: str, full_url: str, endpoint: str, **kwargs) -> requests.Response:
+        """
+        Отправляет запрос с учётом предохранителя и хеджирования.
+        5xx, 429 и сетевые ошибки считаются отказом эндпоинта.
+        403 и 429 с исчерпанной суточной квотой токена отправляют токен в карантин, и запрос
+        повторяется с другим токеном. Остальные 429 - ограничение частоты, общее для всех токенов
+        (у Метрики - по IP): все запросы клиента ждут Retry-After (или RATE_LIMIT_BACKOFF_SECONDS),
+        и запрос повторяется до RATE_LIMIT_RETRIES раз. Отказом считается только последний ответ.
+        """
+        breaker = self._breaker(endpoint)
+        breaker.before_request()
+
+        def send():
+            response = None
+            rotations = throttled = 0
+            while rotations < len(self.tokens) and throttled <= RATE_LIMIT_RETRIES:
+                self.limiter.wait()
+                token = self.tokens.acquire()
+                try:
+                    url = self._token_url(full_url, token)
+                except MetrikaAPIError as e:
+                    if e.status_code != 403:
+                        raise
+                    self.tokens.quarantine(token, denied=True)
+                    rotations += 1
+                    continue
+                if response is not None:
+                    response.close()
+                self.calls[endpoint] += 1
+                started = time.perf_counter()
+                response = self.session.request(method, url, headers=token.headers, timeout=self.timeout, **kwargs)
+                if response.status_code < 500 and response.status_code != 429:
+                    self.latency.record(endpoint, time.perf_counter() - started)
+                if response.status_code == 403:
+                    self.tokens.quarantine(token, denied=True)
+                    rotations += 1
+                elif response.status_code == 429 and (self.tokens.exhausted(token) or _quota_exhausted(response)):
+                    self.tokens.quarantine(token)
+                    rotations += 1
+                elif response.status_code == 429:
+                    self.limiter.pause(_retry_after(response))
+                    throttled += 1
+                else:
+                    return response
+            if response is None:
+                raise MetrikaAuthError("Access denied. Check token permissions", 403)
+            return response
+
+        delay = self.hedging.delay(self.latency, endpoint) if self.hedging else None
         try:
-            response = self.session.request(
-                method,
-                f"https://api.webmaster.yandex.net/v4/user/{self.user_id}/hosts/{self.host}{url}",
-                timeout=self.timeout,
-                **kwargs
-            )
+            response = send() if delay is None else self.hedging.run(send, delay)
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def _request_json(self, method: str, full_url: str, endpoint: str, **kwargs) -> dict:
+        try:
+            with profiler.stage('api_wait'):
+                response = self._send(method, full_url, endpoint, **kwargs)
             
             if response.status_code == 403:
                 raise MetrikaAuthError("Access denied. Check token permissions")
             response.raise_for_status()
-            return response.json()
+            with profiler.stage('json_decode'):
+                return response.json()
             
         except requests.exceptions.RequestException as e:
             raise MetrikaAPIError(f"Request failed: {str(e)}")
-        
-    def get_summary(self):
-        return self._request('GET', '/summary')
-    
-    def get_top_search_requests(self, date_from: str, date_to: str): # ёбанный яндекс не может принять параметры бля списком архитектуру мне похерили
+
+    def _request_stream(self, method: str, full_url: str, endpoint: str, array_key: str, **kwargs) -> JsonStream:
+        """
+        Как _request_json, но тело не читается целиком: строки массива ``array_key``
+        декодируются по мере чтения (см. JsonStream)
+        """
         try:
-            response = self.session.request(
-                'GET',
-                f"https://api.webmaster.yandex.net/v4/user/{self.user_id}/hosts/{self.host}/search-queries/popular?order_by=TOTAL_CLICKS&query_indicator=TOTAL_SHOWS&date_from={date_from}&date_to={date_to}&query_indicator=TOTAL_CLICKS&query_indicator=AVG_SHOW_POSITION&query_indicator=AVG_CLICK_POSITION",
-            )
-            
+            with profiler.stage('api_wait'):
+                response = self._send(method, full_url, endpoint, stream=True, **kwargs)
+
             if response.status_code == 403:
+                response.close()
                 raise MetrikaAuthError("Access denied. Check token permissions")
+            if response.status_code >= 400:
+                response.close()
             response.raise_for_status()
-            return response.json()
+            return JsonStream(response, array_key)
+
         except requests.exceptions.RequestException as e:
             raise MetrikaAPIError(f"Request failed: {str(e)}")
+
+
+class YandexWebmaster(BaseYandexClient):
+    """
+    :param user_id: user_id владельца токена. Без него (и при пуле токенов разных
+        пользователей) определяется для каждого токена при первом запросе
+    """
+
+    def __init__(self, token, host: str, user_id: str = None, timeout: int = 20, api_url: str = None,
+                 hedge: bool = None, rate_limit: float = None):
+        super().__init__(token, timeout, hedge, rate_limit)
+        self.host = host
+        self.user_id = user_id
+        self.user_ids = {}
+        self.api_url = api_url or os.getenv('WEBMASTER_API_URL', WEBMASTER_API_URL)
+
+    def _token_url(self, full_url: str, token: PooledToken) -> str:
+        user_id = self.user_id or self.user_ids.get(token.token)
+        if user_id is None:
+            # Без profiler.stage: при хеджировании здесь поток пула, а стек стадий профайлера однопоточный.
+            # Время запроса и так попадает в api_wait вызывающего _request_json
+            response = self.session.get(f"{self.api_url}/user", headers=token.headers, timeout=self.timeout)
+            if response.status_code == 403:
+                raise MetrikaAuthError("Access denied. Check token permissions", 403)
+            response.raise_for_status()
+            user_id = self.user_ids[token.token] = response.json()['user_id']
+        return full_url.replace('/user/{user_id}/', f'/user/{user_id}/', 1)
+
+    def _request(self, method: str, url: str, stream_key: str = None, **kwargs):
+        """Базовый метод запроса. С stream_key возвращает JsonStream по этому массиву ответа"""
+        endpoint = url.split('?')[0]
+        # user_id подставляет _token_url: он зависит от токена, выбранного для запроса
+        full_url = f"{self.api_url}/user/{{user_id}}/hosts/{self.host}{url}"
+        if stream_key:
+            return self._request_stream(method, full_url, endpoint, stream_key, **kwargs)
+        return self._request_json(method, full_url, endpoint, **kwargs)
+        
+    def get_summary(self):
+        return self._request('GET', '/summary')
+    
+    def get_top_search_requests(self, date_from: str, date_to: str, stream: bool = False): # ёбанный яндекс не может принять параметры бля списком архитектуру мне похерили
+        """С stream=True возвращает JsonStream по запросам ('queries') вместо словаря"""
+        return self._request(
+            'GET',
+            f"/search-queries/popular?order_by=TOTAL_CLICKS&query_indicator=TOTAL_SHOWS&date_from={date_from}&date_to={date_to}&query_indicator=TOTAL_CLICKS&query_indicator=AVG_SHOW_POSITION&query_indicator=AVG_CLICK_POSITION",
+            stream_key='queries' if stream else None
+        )
         
         
 
-class YandexMetrika:
-    def __init__(self, token: str, counter_id: str, timeout: int = 20):
-        self.session = requests.Session()
-        self.session.headers.update({
-            "Authorization": f"OAuth {token}",
-            "Content-Type": "application/json"
-        })
-        self.timeout = timeout
+# Основные типы трафика для анализа
+TRAFFIC_TYPES = {
+    'organic': 'organic',          # Поисковые системы
+    'direct': 'direct',            # Прямые заходы
+    'social': 'social',            # Соцсети
+    'referral': 'referral',        # Рефералы
+    'ad': 'ad',                    # Реклама
+    'internal': 'internal',        # Внутренние переходы
+    'email': 'email'               # Email-рассылки
+}
+
+# Лимиты /stat/v1/data на один запрос
+MAX_METRICS_PER_REQUEST = 20
+MAX_DIMENSIONS_PER_REQUEST = 10
+# Метрики, которые можно суммировать по лишним группировкам объединённого запроса
+ADDITIVE_METRICS = {'ym:s:visits', 'ym:s:users', 'ym:s:newUsers', 'ym:s:pageviews'}
+# Сегменты для /stat/v1/data/comparison (None - весь трафик)
+SEGMENTS = {
+    'all': None,
+    'organic': "ym:s:trafficSource=='organic'",
+    'yandex': "ym:s:searchEngineRoot=='yandex'",
+    'google': "ym:s:searchEngineRoot=='google'"
+}
+
+
+def _search_engine_bucket(name: str) -> int:
+    """Корзина поисковой системы: 0 - Яндекс, 1 - Google, 2 - прочие, -1 - без поисковика"""
+    engine = (name or '').lower()
+    if not engine or engine == '(none)':
+        return -1
+    if 'yandex' in engine:
+        return 0
+    if 'google' in engine:
+        return 1
+    return 2
+
+
+def _and_filters(*filters) -> str:
+    """Объединяет непустые фильтры через AND (None, если фильтров нет)"""
+    filters = [f for f in filters if f]
+    return ' AND '.join(filters) if filters else None
+
+
+class MetrikaQuery:
+    """
+    Логический запрос к /stat/v1/data.
+
+    :param metrics: Метрики
+    :param dimensions: Группировки, которые нужны вызывающему коду
+    :param filters: Общий фильтр (запросы с одинаковым фильтром и датами объединяются)
+    :param where: Условия равенства {группировка: значение}. Вместо фильтра
+        ``ym:s:trafficSource=='organic'`` планировщик добавляет группировку и
+        отдаёт запросу только подходящие строки
+    :param limit: Лимит строк. Запросы с limit/sort выполняются отдельно, как есть
+    :param sort: Сортировка
+    :param accuracy: Точность выборки
+    """
+
+    def __init__(self, date1: str, date2: str, metrics, dimensions=(), filters: str = None,
+                 where: dict = None, limit: int = None, sort: str = None, accuracy: str = None):
+        self.date1 = date1
+        self.date2 = date2
+        self.metrics = tuple(metrics)
+        self.dimensions = tuple(dimensions)
+        self.filters = filters
+        self.where = dict(where or {})
+        self.limit = limit
+        self.sort = sort
+        self.accuracy = accuracy
+        self.result = None
+
+    @property
+    def group_key(self) -> tuple:
+        return (self.date1, self.date2, self.filters, self.accuracy)
+
+    @property
+    def full_dimensions(self) -> tuple:
+        return self.dimensions + tuple(d for d in self.where if d not in self.dimensions)
+
+    @property
+    def additive(self) -> bool:
+        return all(m in ADDITIVE_METRICS for m in self.metrics)
+
+    @property
+    def standalone(self) -> bool:
+        return self.limit is not None or self.sort is not None
+
+    def params(self, counter_id: str) -> dict:
+        """Параметры для самостоятельного выполнения запроса"""
+        filters = ' AND '.join(
+            ([self.filters] if self.filters else []) + [f"{d}=='{v}'" for d, v in self.where.items()]
+        )
+        params = {
+            "ids": counter_id,
+            "metrics": ','.join(self.metrics),
+            "date1": self.date1,
+            "date2": self.date2
+        }
+        if self.dimensions:
+            params["dimensions"] = ','.join(self.dimensions)
+        if filters:
+            params["filters"] = filters
+        for name in ('limit', 'sort', 'accuracy'):
+            if getattr(self, name) is not None:
+                params[name] = getattr(self, name)
+        return params
+
+
+class PlannedCall:
+    """Один реальный вызов /stat/v1/data и логические запросы, которые он обслуживает"""
+
+    def __init__(self, queries: list, dimensions: tuple, metrics: tuple):
+        self.queries = queries
+        self.dimensions = dimensions
+        self.metrics = metrics
+
+    @property
+    def passthrough(self) -> bool:
+        return len(self.queries) == 1 and not self.queries[0].where
+
+    def params(self, counter_id: str, max_rows: int) -> dict:
+        if self.passthrough:
+            return self.queries[0].params(counter_id)
+        first = self.queries[0]
+        params = {
+            "ids": counter_id,
+            "metrics": ','.join(self.metrics),
+            "date1": first.date1,
+            "date2": first.date2,
+            "limit": max_rows
+        }
+        if self.dimensions:
+            params["dimensions"] = ','.join(self.dimensions)
+        if first.filters:
+            params["filters"] = first.filters
+        if first.accuracy is not None:
+            params["accuracy"] = first.accuracy
+        return params
+
+    def route(self, data: dict):
+        """Раскладывает ответ объединённого запроса по логическим запросам"""
+        if self.passthrough:
+            self.queries[0].result = data
+            return
+
+        rows = data.get('data', [])
+        dim_index = {d: i for i, d in enumerate(self.dimensions)}
+        metric_index = {m: i for i, m in enumerate(self.metrics)}
+
+        for query in self.queries:
+            where = [(dim_index[d], str(v)) for d, v in query.where.items()]
+            own_dims = [dim_index[d] for d in query.dimensions]
+            own_metrics = [metric_index[m] for m in query.metrics]
+            rollup = len(self.dimensions) > len(query.full_dimensions)
+
+            routed = {}
+            for row in rows:
+                dims = row['dimensions']
+                if any(str(dims[i].get('id', dims[i].get('name'))) != v and dims[i].get('name') != v for i, v in where):
+                    continue
+                key = tuple(dims[i].get('id', dims[i].get('name')) for i in own_dims)
+                metrics = [row['metrics'][i] for i in own_metrics]
+                if key in routed and rollup:
+                    routed[key]['metrics'] = [a + b for a, b in zip(routed[key]['metrics'], metrics)]
+                else:
+                    routed[key] = {'dimensions': [dims[i] for i in own_dims], 'metrics': metrics}
+
+            result_rows = list(routed.values())
+            totals = [
+                sum(row['metrics'][i] for row in result_rows) if m in ADDITIVE_METRICS else None
+                for i, m in enumerate(query.metrics)
+            ]
+            query.result = {
+                'query': dict(data.get('query', {}), metrics=list(query.metrics), dimensions=list(query.dimensions)),
+                'data': result_rows,
+                'total_rows': len(result_rows),
+                'totals': totals
+            }
+
+
+class MetrikaQueryPlanner:
+    """
+    Объединяет логические запросы к /stat/v1/data в минимум реальных вызовов.
+
+    Запросы с одинаковыми датами, фильтром и точностью сливаются в один вызов:
+    метрики объединяются, условия ``where`` превращаются в группировки, а лишние
+    для запроса группировки суммируются (только для аддитивных метрик).
+    После ``execute`` результат каждого запроса лежит в ``query.result``
+    в том же виде, что и ответ API.
+    """
+
+    def __init__(self, metrika: 'YandexMetrika', max_rows: int = 10000):
+        self.metrika = metrika
+        self.max_rows = max_rows
+        self.queries = []
+
+    def add(self, query: MetrikaQuery) -> MetrikaQuery:
+        self.queries.append(query)
+        return query
+
+    def plan(self) -> list:
+        """Возвращает список PlannedCall, не выполняя запросов"""
+        calls = []
+        groups = {}
+        for query in self.queries:
+            if query.standalone:
+                calls.append(PlannedCall([query], query.dimensions, query.metrics))
+            else:
+                groups.setdefault(query.group_key, []).append(query)
+
+        for queries in groups.values():
+            # Неаддитивные запросы объединяются только с запросами с тем же набором группировок
+            buckets = {}
+            pool = []
+            for query in queries:
+                if not query.additive:
+                    buckets.setdefault(frozenset(query.full_dimensions), []).append(query)
+            for query in queries:
+                if query.additive:
+                    target = next((b for dims, b in buckets.items() if dims >= set(query.full_dimensions)), None)
+                    (target if target is not None else pool).append(query)
+            if pool:
+                buckets[None] = pool
+
+            for bucket in buckets.values():
+                calls.extend(self._pack(bucket))
+
+        return calls
+
+    def _pack(self, queries: list) -> list:
+        """Раскладывает запросы по вызовам в пределах лимитов на метрики и группировки"""
+        calls = []
+        current, dims, metrics = [], [], []
+        for query in queries:
+            new_dims = dims + [d for d in query.full_dimensions if d not in dims]
+            new_metrics = metrics + [m for m in query.metrics if m not in metrics]
+            too_big = len(new_dims) > MAX_DIMENSIONS_PER_REQUEST or len(new_metrics) > MAX_METRICS_PER_REQUEST
+            if current and too_big:
+                calls.append(PlannedCall(current, tuple(dims), tuple(metrics)))
+                current = []
+                new_dims = list(query.full_dimensions)
+                new_metrics = list(query.metrics)
+            current.append(query)
+            dims, metrics = new_dims, new_metrics
+        if current:
+            calls.append(PlannedCall(current, tuple(dims), tuple(metrics)))
+        return calls
+
+    def execute(self) -> int:
+        """Выполняет запланированные вызовы. Возвращает количество реальных запросов к API"""
+        calls = self.plan()
+        for call in calls:
+            data = self.metrika._request(
+                "GET",
+                self.metrika.base_metrika_url,
+                params=call.params(self.metrika.counter_id, self.max_rows)
+            )
+            call.route(data)
+        self.queries = []
+        return len(calls)
+
+
+class YandexMetrika(BaseYandexClient):
+    def __init__(self, token: str, counter_id: str, timeout: int = 20, api_url: str = None,
+                 hedge: bool = None, rate_limit: float = None):
+        super().__init__(token, timeout, hedge, rate_limit)
         self.counter_id = counter_id
         self.base_metrika_url = '/stat/v1/data'
+        self.api_url = api_url or os.getenv('METRIKA_API_URL', METRIKA_API_URL)
 
-    def _request(self, method: str, url: str, **kwargs) -> dict:
-        """Базовый метод запроса"""
-        try:
-            response = self.session.request(
-                method,
-                f"https://api-metrika.yandex.net{url}",
-                timeout=self.timeout,
-                **kwargs
-            )
-            
-            if response.status_code == 403:
-                raise MetrikaAuthError("Access denied. Check token permissions")
-            response.raise_for_status()
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            raise MetrikaAPIError(f"Request failed: {str(e)}")
+    def _request(self, method: str, url: str, stream: bool = False, **kwargs):
+        """Базовый метод запроса. С stream=True возвращает JsonStream по строкам 'data'"""
+        if stream:
+            return self._request_stream(method, f"{self.api_url}{url}", url, 'data', **kwargs)
+        return self._request_json(method, f"{self.api_url}{url}", url, **kwargs)
 
     def get_counters(self) -> list:
         """Получить список доступных счётчиков"""
@@ -147,6 +559,30 @@ class YandexMetrika:
         )
     
 
+    def plan_all_traffic_by_url(self, planner: MetrikaQueryPlanner, date_from: str, date_to: str, url: str):
+        """
+        Планирует запросы визитов по всем типам трафика за период по урлу.
+        Планировщик сводит их в один вызов с группировкой по ym:s:trafficSource.
+
+        :return: Функция без аргументов, которая после planner.execute() вернёт {тип_трафика: количество_визитов}
+        """
+        queries = {
+            name: planner.add(MetrikaQuery(
+                date_from, date_to, ["ym:s:visits"],
+                filters=f"ym:s:startURLPathLevel2=='{url}'",
+                where={"ym:s:trafficSource": source}
+            ))
+            for name, source in TRAFFIC_TYPES.items()
+        }
+
+        def result() -> dict:
+            return {
+                name: query.result["data"][0]["metrics"][0] if query.result["data"] else 0
+                for name, query in queries.items()
+            }
+
+        return result
+
     def get_all_traffic_by_url(self, date_from: str, date_to: str, url: str) -> dict:
         """
         Получает визиты по всем типам трафика за период по урлу.
@@ -155,35 +591,10 @@ class YandexMetrika:
         :param date_to: Конечная дата (YYYY-MM-DD)
         :return: Словарь {тип_трафика: количество_визитов}
         """
-        
-        # Основные типы трафика для анализа
-        traffic_types = {
-            'organic': 'organic',          # Поисковые системы
-            'direct': 'direct',            # Прямые заходы
-            'social': 'social',            # Соцсети
-            'referral': 'referral',        # Рефералы
-            'ad': 'ad',                    # Реклама
-            'internal': 'internal',        # Внутренние переходы
-            'email': 'email'               # Email-рассылки
-        }
-        
-        result = {}
-        
-        for name, source in traffic_types.items():
-            data = self._request(
-                "GET",
-                self.base_metrika_url,
-                params={
-                    "ids": self.counter_id,
-                    "metrics": "ym:s:visits",
-                    "date1": date_from,
-                    "date2": date_to,
-                    "filters": f"ym:s:trafficSource=='{source}' AND ym:s:startURLPathLevel2=='{url}'"
-                }
-            )
-            result[name] = data["data"][0]["metrics"][0] if data["data"] else 0
-        
-        return result
+        planner = MetrikaQueryPlanner(self)
+        result = self.plan_all_traffic_by_url(planner, date_from, date_to, url)
+        planner.execute()
+        return result()
     
 
     
@@ -217,6 +628,32 @@ class YandexMetrika:
         return data["data"][0]["metrics"][0] if data["data"] else 0
     
 
+    def plan_search_engines_traffic(self, planner: MetrikaQueryPlanner, date_from: str, date_to: str,
+                                    url: str = False):
+        """
+        Планирует запрос визитов из поисковых систем (Яндекс и Google) за период.
+        Для раздела используется тот же фильтр по странице входа, что и в plan_all_traffic_by_url,
+        поэтому оба запроса уходят одним вызовом.
+
+        :return: Функция без аргументов, которая после planner.execute() вернёт
+            {'yandex': X, 'google': Y, 'other_search': Z}
+        """
+        query = planner.add(MetrikaQuery(
+            date_from, date_to, ["ym:s:visits"],
+            dimensions=["ym:s:searchEngine"],
+            filters=f"ym:s:startURLPathLevel2=='{url}'" if url else None,
+            where={"ym:s:trafficSource": "organic"}
+        ))
+
+        def result() -> dict:
+            columns = to_columns(query.result)
+            if not len(columns):
+                return {'yandex': 0, 'google': 0, 'other_search': 0}
+            sums = bucket_sums(columns.codes[0], columns.labels[0], columns.metric(0), _search_engine_bucket, 3)
+            return {'yandex': float(sums[0]), 'google': float(sums[1]), 'other_search': float(sums[2])}
+
+        return result
+
     def get_search_engines_traffic(self, date_from: str, date_to: str, url:str = False) -> dict:
         """
         Получает визиты из поисковых систем (Яндекс и Google) за период
@@ -226,42 +663,10 @@ class YandexMetrika:
         :param url: URL второго уровня. По-умолчанию вернёт весь поисковый трафик
         :return: Словарь {'yandex': X, 'google': Y, 'other_search': Z}
         """
-        
-        # Фильтр для органического трафика из поисковиков
-        search_filter = f"ym:s:trafficSource=='organic' AND ym:s:searchEngine!='(none)'"
-        if url:
-            search_filter += f" AND ym:pv:URLPathLevel2=='{url}'"
-        
-        # Запрос данных с разбивкой по поисковым системам
-        data = self._request(
-            "GET",
-            self.base_metrika_url,
-            params={
-                "ids": self.counter_id,
-                "metrics": "ym:s:visits",
-                "dimensions": "ym:s:searchEngine",
-                "date1": date_from,
-                "date2": date_to,
-                "filters": search_filter,
-                "limit": 10
-            }
-        )
-        
-        # Обработка результатов
-        result = {'yandex': 0, 'google': 0, 'other_search': 0}
-        
-        for row in data.get("data", []):
-            engine = row["dimensions"][0]["name"].lower()
-            visits = row["metrics"][0]
-            
-            if 'yandex' in engine:
-                result['yandex'] += visits
-            elif 'google' in engine:
-                result['google'] += visits
-            else:
-                result['other_search'] += visits
-        
-        return result
+        planner = MetrikaQueryPlanner(self)
+        result = self.plan_search_engines_traffic(planner, date_from, date_to, url)
+        planner.execute()
+        return result()
 
     def get_organic_pages_from_url(self, date_from: str, date_to: str, base_url: str, limit: int = 100) -> list:
         """
@@ -297,26 +702,67 @@ class YandexMetrika:
                 "limit": limit,
                 "sort": "-ym:s:visits",  # Сортировка по визитам
                 "accuracy": "full"
-            }
+            },
+            stream=True
         )
         
-        result = []
-        total_visits = sum(row['metrics'][0] for row in data.get('data', []))
-        
-        for row in data.get('data', []):
-            url = row['dimensions'][0]['name']
-            visits = row['metrics'][0]
-            bounce_rate = row['metrics'][1]
-            
-            result.append({
-                'page_url': url,
-                'visits': visits,
-                'bounce_rate': round(bounce_rate, 1),
-                'traffic_share': round((visits / total_visits * 100), 1) if total_visits > 0 else 0
-            })
-        
+        columns = to_columns(data)
+        if not len(columns):
+            return []
+        visits = columns.metric(0)
+        return [
+            {'page_url': url, 'visits': v, 'bounce_rate': bounce_rate, 'traffic_share': share}
+            for url, v, bounce_rate, share in zip(
+                columns.dimension(0).tolist(),
+                visits.tolist(),
+                np.round(columns.metric(1), 1).tolist(),
+                shares(visits).tolist()
+            )
+        ]
+
+    def plan_behavior_metrics(self, planner: MetrikaQueryPlanner, date_from: str, date_to: str,
+                              base_url: str = None):
+        """
+        Планирует запрос поведенческих метрик (см. get_behavior_metrics)
+
+        :return: Функция без аргументов, которая после planner.execute() вернёт словарь метрик
+        """
+        filters = None
+        if base_url:
+            parsed = urlparse(base_url)
+            clean_base_url = urlunparse(parsed._replace(query='', fragment=''))
+            filters = f"ym:s:startURL=~'^{clean_base_url}[^/]*/?$'"
+
+        query = planner.add(MetrikaQuery(
+            date_from, date_to,
+            ["ym:s:visits", "ym:s:bounceRate", "ym:s:pageDepth", "ym:s:avgVisitDurationSeconds"],
+            filters=filters
+        ))
+
+        def result() -> dict:
+            data = query.result
+            return self._behavior_from_metrics(data['data'][0]['metrics'] if data.get('data') else None)
+
         return result
 
+    @staticmethod
+    def _behavior_from_metrics(metrics: list) -> dict:
+        """Словарь поведенческих метрик из [visits, bounceRate, pageDepth, avgVisitDurationSeconds]"""
+        if not metrics:
+            return {
+                'bounce_rate': 0,
+                'page_depth': 0,
+                'avg_visit': 0,
+                'visits': 0
+            }
+
+        return {
+            'bounce_rate': round(metrics[1], 1),       # Процент отказов
+            'page_depth': round(metrics[2], 2),        # Глубина просмотра
+            'avg_visit': int(metrics[3]),              # Продолжительность (сек)
+            'visits': int(metrics[0])                  # Количество визитов
+        }
+
     def get_behavior_metrics(self, date_from: str, date_to: str, base_url: str = None) -> dict:
         """
         :param base_url: URL второго уровня (например 'https://zaruku.ru/rak-lyogkogo/').
@@ -330,43 +776,123 @@ class YandexMetrika:
             'visits': int          # Количество визитов
         }
         """
+        planner = MetrikaQueryPlanner(self)
+        result = self.plan_behavior_metrics(planner, date_from, date_to, base_url)
+        planner.execute()
+        return result()
+
+    def compare_segments(self, date_from: str, date_to: str, metrics: list, segments: tuple = ('organic', 'all'),
+                         dimensions: list = None, filters: str = None, limit: int = None, sort: str = None) -> dict:
+        """
+        Запрашивает два сегмента трафика одним вызовом /stat/v1/data/comparison
+
+        :param segments: Пара имён из SEGMENTS (сегмент a, сегмент b)
+        :param filters: Общий для обоих сегментов фильтр
+        :return: Ответ API: в строках и totals метрики лежат по ключам 'a' и 'b'
+        """
+        segment_a, segment_b = segments
         params = {
             "ids": self.counter_id,
-            "metrics": "ym:s:visits,ym:s:bounceRate,ym:s:pageDepth,ym:s:avgVisitDurationSeconds",
-            "date1": date_from,
-            "date2": date_to
+            "metrics": ",".join(metrics),
+            "date1_a": date_from,
+            "date2_a": date_to,
+            "date1_b": date_from,
+            "date2_b": date_to,
+            "accuracy": "full"
         }
+        if dimensions:
+            params["dimensions"] = ",".join(dimensions)
+        for key, segment in (("filters_a", segment_a), ("filters_b", segment_b)):
+            segment_filter = _and_filters(filters, SEGMENTS[segment])
+            if segment_filter:
+                params[key] = segment_filter
+        if limit:
+            params["limit"] = limit
+        if sort:
+            params["sort"] = sort
+
+        return self._request("GET", f"{self.base_metrika_url}/comparison", params=params)
 
+    def get_traffic_by_urls_pair(self, date_from: str, date_to: str, url: str,
+                                 segments: tuple = ('organic', 'all')) -> dict:
+        """
+        Визиты раздела в двух сегментах одним вызовом (вместо двух get_traffic_by_urls)
+
+        :param url: URL второго уровня (например 'https://zaruku.ru/pitanie/')
+        :return: {сегмент_a: визиты, сегмент_b: визиты}
+        """
+        data = self.compare_segments(
+            date_from, date_to, ["ym:s:visits"], segments,
+            filters=f"ym:s:startURLPathLevel2=='{url}'"
+        )
+        rows = data.get("data", [])
+        metrics = rows[0]["metrics"] if rows else {"a": [0], "b": [0]}
+        return {segments[0]: metrics["a"][0], segments[1]: metrics["b"][0]}
+
+    def get_behavior_metrics_pair(self, date_from: str, date_to: str, base_url: str = None,
+                                  segments: tuple = ('organic', 'all')) -> dict:
+        """
+        Поведенческие метрики (см. get_behavior_metrics) в двух сегментах одним вызовом
+
+        :return: {сегмент_a: {...}, сегмент_b: {...}}
+        """
+        filters = None
         if base_url:
-            from urllib.parse import urlparse, urlunparse
             parsed = urlparse(base_url)
             clean_base_url = urlunparse(parsed._replace(query='', fragment=''))
-            params["filters"] = f"ym:s:startURL=~'^{clean_base_url}[^/]*/?$'"
+            filters = f"ym:s:startURL=~'^{clean_base_url}[^/]*/?$'"
 
-        data = self._request("GET", "/stat/v1/data", params=params)
-
-        if not data.get('data'):
-            return {
-                'bounce_rate': 0,
-                'page_depth': 0,
-                'avg_visit': 0,
-                'visits': 0
-            }
-
-        metrics = data['data'][0]['metrics']
-        
+        data = self.compare_segments(
+            date_from, date_to,
+            ["ym:s:visits", "ym:s:bounceRate", "ym:s:pageDepth", "ym:s:avgVisitDurationSeconds"],
+            segments, filters=filters
+        )
+        rows = data.get("data", [])
         return {
-            'bounce_rate': round(metrics[1], 1),       # Процент отказов
-            'page_depth': round(metrics[2], 2),        # Глубина просмотра
-            'avg_visit': int(metrics[3]),              # Продолжительность (сек)
-            'visits': int(metrics[0])                  # Количество визитов
+            segment: self._behavior_from_metrics(rows[0]["metrics"][key] if rows else None)
+            for segment, key in zip(segments, ("a", "b"))
         }
+
+    def get_pages_from_url_pair(self, date_from: str, date_to: str, base_url: str,
+                                segments: tuple = ('organic', 'all'), limit: int = 100) -> list:
+        """
+        Страницы входа раздела (см. get_organic_pages_from_url) в двух сегментах одним вызовом.
+        Страницы упорядочены по визитам сегмента a
+
+        :return: Список словарей {'page_url': str, сегмент_a: {'visits', 'bounce_rate', 'traffic_share'}, сегмент_b: {...}}
+        """
+        parsed = urlparse(base_url)
+        clean_base_url = urlunparse(parsed._replace(query='', fragment=''))
+
+        data = self.compare_segments(
+            date_from, date_to, ["ym:s:visits", "ym:s:bounceRate"], segments,
+            dimensions=["ym:s:startURL"],
+            filters=f"ym:s:startURL=~'^{clean_base_url}[^/]+/.*'",
+            limit=limit,
+            sort="-ym:s:visits"
+        )
+
+        rows = data.get("data", [])
+        totals = {key: sum(row["metrics"][key][0] for row in rows) for key in ("a", "b")}
+        result = []
+        for row in rows:
+            page = {'page_url': row['dimensions'][0]['name']}
+            for segment, key in zip(segments, ("a", "b")):
+                visits, bounce_rate = row["metrics"][key][0], row["metrics"][key][1]
+                page[segment] = {
+                    'visits': visits,
+                    'bounce_rate': round(bounce_rate, 1),
+                    'traffic_share': round((visits / totals[key] * 100), 1) if totals[key] > 0 else 0
+                }
+            result.append(page)
+        return result
     
     def get_referral_traffic(
         self,
         date_from: str,
         date_to: str,
-        entry_url: str = None
+        entry_url: str = None,
+        top: int = None
         ) -> dict:
         """
         Получить переходы с других сайтов (реферальный трафик) за период.
@@ -374,6 +900,7 @@ class YandexMetrika:
         :param date_from: Начальная дата периода в формате YYYY-MM-DD
         :param date_to: Конечная дата периода в формате YYYY-MM-DD
         :param entry_url: (опционально) URL точки входа для фильтрации (например 'https://zaruku.ru/rak-molochnoj-zhelezy/')
+        :param top: (опционально) Оставить только столько рефереров с наибольшим числом визитов
         :return: Словарь вида {'реферальный_домен': количество_визитов}
         """
         params = {
@@ -387,14 +914,44 @@ class YandexMetrika:
         if entry_url:
             params["filters"] = f"ym:s:startURL=='{entry_url}'"
         
-        data = self._request("GET", self.base_metrika_url, params=params)
-        
-        referral_traffic = {}
-        for row in data.get("data", []):
-            domain = row["dimensions"][0]["name"]
-            visits = row["metrics"][0]
-            referral_traffic[domain] = visits
+        data = self._request("GET", self.base_metrika_url, stream=True, params=params)
         
-        return referral_traffic
+        columns = to_columns(data)
+        if not len(columns):
+            return {}
+        visits = columns.metric(0)
+        order = top_n(visits, top) if top else slice(None)
+        return dict(zip(columns.dimension(0)[order].tolist(), visits[order].tolist()))
+
+    def get_top_sections(self, date_from: str, date_to: str, limit: int = 500) -> list:
+        """
+        Топ разделов сайта (URL второго уровня) по визитам за период
+
+        :param date_from: Начальная дата (YYYY-MM-DD)
+        :param date_to: Конечная дата (YYYY-MM-DD)
+        :param limit: Максимальное количество разделов
+        :return: Список кортежей (url_раздела, визиты), по убыванию визитов
+        """
+        data = self._request(
+            "GET",
+            self.base_metrika_url,
+            params={
+                "ids": self.counter_id,
+                "metrics": "ym:s:visits",
+                "dimensions": "ym:s:startURLPathLevel2",
+                "date1": date_from,
+                "date2": date_to,
+                "limit": limit,
+                "sort": "-ym:s:visits",
+                "accuracy": "full"
+            },
+            stream=True
+        )
+
+        sections = []
+        for row in data:
+            url = row["dimensions"][0]["name"]
+            if url:
+                sections.append((url, int(row["metrics"][0])))
 
-    
\ No newline at end of file
+        return sections
@@ -0,0 +1,338 @@
+import argparse
+import budget
+import heapq
+import itertools
+import json
+import logging
+import main
+import os
+import signal
+import threading
+import time
+
+from collections import Counter
+from core import YandexMetrika, YandexWebmaster
+from datetime import date, datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from dotenv import load_dotenv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logs import setup_logging
+from resilience import TokenPool
+from sinks import get_sink
+from urllib.parse import parse_qs, urlparse
+from utils import get_current_month_period
+
+logger = logging.getLogger('daemon')
+
+load_dotenv()
+DAEMON_HOST = os.getenv('DAEMON_HOST', '127.0.0.1')
+DAEMON_PORT = int(os.getenv('DAEMON_PORT', 8780))
+# Как часто обновлять открытый месяц
+DAEMON_OPEN_MONTH_MINUTES = float(os.getenv('DAEMON_OPEN_MONTH_MINUTES', 60))
+# Начало исторической догрузки (YYYY-MM-DD). Без него догрузки нет
+DAEMON_BACKFILL_FROM = os.getenv('DAEMON_BACKFILL_FROM')
+# Сколько единиц работы догрузки выполнять за раз, чтобы не задерживать срочные задачи
+DAEMON_BACKFILL_BATCH = int(os.getenv('DAEMON_BACKFILL_BATCH', 10))
+# Пауза догрузки, когда всё уже загружено или квота на сегодня кончилась
+DAEMON_BACKFILL_IDLE_MINUTES = float(os.getenv('DAEMON_BACKFILL_IDLE_MINUTES', 60))
+
+# Как часто повторять невыполненные единицы работы из dead_letters
+DAEMON_RETRY_MINUTES = float(os.getenv('DAEMON_RETRY_MINUTES', 15))
+
+# Меньше - важнее
+JOB_PRIORITIES = {
+    'open_month': 0,
+    'yesterday': 1,
+    'retry': 2,
+    'backfill': 3
+}
+
+
+def month_bounds(day: date) -> tuple:
+    """Первый и последний день месяца, в который попадает day"""
+    start = day.replace(day=1)
+    end = start + relativedelta(months=1) - timedelta(days=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+class SchedulerDaemon:
+    """
+    Долгоживущий планировщик выгрузки.
+
+    Держит открытыми сессии API и пул подключений к БД и выполняет задачи
+    из очереди с приоритетами: открытый месяц раз в ``open_month_minutes``,
+    вчерашний день - один раз, когда он устоится (DAILY_SETTLE_DAYS),
+    повтор невыполненного (dead_letters) раз в ``retry_minutes``,
+    историческую догрузку - небольшими порциями, когда очередь пуста.
+    Все задачи раскладываются в дневную квоту API (см. budget), поэтому
+    нагрузка на API размазывается по суткам.
+    """
+
+    def __init__(self, tokens: list, counter_id: str, webmaster_host: str, storage: str = None,
+                 grain: str = 'monthly', open_month_minutes: float = DAEMON_OPEN_MONTH_MINUTES,
+                 backfill_from: str = DAEMON_BACKFILL_FROM, backfill_batch: int = DAEMON_BACKFILL_BATCH,
+                 backfill_idle_minutes: float = DAEMON_BACKFILL_IDLE_MINUTES,
+                 retry_minutes: float = DAEMON_RETRY_MINUTES):
+        self.tokens = tokens
+        self.counter_id = counter_id
+        self.webmaster_host = webmaster_host
+        self.storage = storage
+        self.grain = grain
+        self.open_month_interval = open_month_minutes * 60
+        self.backfill_from = backfill_from
+        self.backfill_batch = backfill_batch
+        self.backfill_idle = backfill_idle_minutes * 60
+        self.retry_interval = retry_minutes * 60
+        self.budgets = budget.default_budgets(len(tokens))
+
+        self.queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.paused = False
+        self.running = None
+        self.runs = Counter()
+        self.last_runs = {}
+        self.last_error = None
+        self.next_open_month = 0.0
+        self.next_backfill = 0.0
+        self.next_retry = 0.0
+        self.settled_day = None
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        # Клиенты API создаются в run()
+        self.metrika = None
+        self.webmaster = None
+
+    def enqueue(self, job: str) -> bool:
+        """Ставит задачу в очередь. Возвращает False, если такая задача уже ждёт"""
+        if job not in JOB_PRIORITIES:
+            raise ValueError(f"Неизвестная задача: {job}. Доступны: {', '.join(JOB_PRIORITIES)}")
+        with self._lock:
+            if any(queued == job for _, _, queued in self.queue):
+                return False
+            heapq.heappush(self.queue, (JOB_PRIORITIES[job], next(self._seq), job))
+        self._wake.set()
+        return True
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def status(self) -> dict:
+        with self._lock:
+            queued = [job for _, _, job in sorted(self.queue)]
+        return {
+            'started_at': self.started_at,
+            'paused': self.paused,
+            'running': self.running,
+            'queue_depth': len(queued),
+            'queue': queued,
+            'runs': dict(self.runs),
+            'last_runs': self.last_runs,
+            'last_error': self.last_error,
+            'tokens': {
+                service: [
+                    {'token': token, 'calls_today': calls, 'quarantined': blocked}
+                    for token, calls, blocked in client.tokens.stats()
+                ]
+                for service, client in (('metrika', self.metrika), ('webmaster', self.webmaster)) if client
+            }
+        }
+
+    def _enqueue_due(self):
+        """Ставит в очередь задачи, срок которых подошёл"""
+        now = time.monotonic()
+        if now >= self.next_open_month:
+            self.next_open_month = now + self.open_month_interval
+            self.enqueue('open_month')
+
+        settled = date.today() - timedelta(days=main.DAILY_SETTLE_DAYS)
+        if settled != self.settled_day:
+            self.settled_day = settled
+            self.enqueue('yesterday')
+
+        if now >= self.next_retry:
+            self.next_retry = now + self.retry_interval
+            self.enqueue('retry')
+
+        if self.backfill_from and not self.queue and now >= self.next_backfill:
+            self.enqueue('backfill')
+
+    def _pop(self):
+        with self._lock:
+            return heapq.heappop(self.queue)[2] if self.queue else None
+
+    def run(self):
+        """Основной цикл. Клиенты API и sink создаются здесь и живут всё время работы"""
+        self.sink = get_sink(self.storage)
+        self.sink.keep_warm()
+        self.sink.create_tables()
+        self.metrika = YandexMetrika(TokenPool(self.tokens, budget.METRIKA_CALLS_PER_DAY), self.counter_id,
+                                     rate_limit=self.budgets['metrika'].per_second)
+        self.webmaster = YandexWebmaster(TokenPool(self.tokens, budget.WEBMASTER_CALLS_PER_DAY), self.webmaster_host,
+                                         rate_limit=self.budgets['webmaster'].per_second)
+        try:
+            while not self._stop.is_set():
+                self._enqueue_due()
+                job = None if self.paused else self._pop()
+                if job is None:
+                    self._wake.wait(timeout=1.0)
+                    self._wake.clear()
+                    continue
+                self._run_job(job)
+        finally:
+            main.record_api_usage(self.sink, metrika=self.metrika, webmaster=self.webmaster)
+            self.sink.close()
+
+    def _run_job(self, job: str):
+        self.running = job
+        started = time.perf_counter()
+        try:
+            done = getattr(self, f'_job_{job}')()
+            self.runs[job] += 1
+            self.last_runs[job] = {
+                'finished_at': datetime.now().isoformat(timespec='seconds'),
+                'seconds': round(time.perf_counter() - started, 2),
+                'units': done
+            }
+        except Exception as e:
+            # Демон не падает из-за одной задачи: ошибка видна в /status, задача повторится по расписанию
+            self.last_error = {'job': job, 'error': repr(e), 'at': datetime.now().isoformat(timespec='seconds')}
+            logger.exception('Задача %s завершилась ошибкой', job)
+        finally:
+            self.running = None
+
+    def _run_range(self, date_from: str, date_to: str, grain: str, limit: int = None) -> tuple:
+        """Выгружает невыгруженное за период в пределах квоты. Возвращает (выполнено, осталось)"""
+        sections = self.sink.get_active_sections(main.SECTION_MAX_AGE_DAYS)
+        if not sections:
+            sections = main.discover_sections(self.metrika, self.sink)
+            main.record_api_usage(self.sink, metrika=self.metrika)
+
+        units, _ = budget.enumerate_units(self.metrika, self.sink, sections, date_from, date_to, grain,
+                                          main.DAILY_SETTLE_DAYS)
+        used = self.sink.get_api_usage(date.today().strftime('%Y-%m-%d'))
+        schedule = budget.schedule_units(units, self.budgets, used)
+        scheduled = schedule.scheduled[:limit] if limit else schedule.scheduled
+        main.run_units(self.metrika, self.webmaster, self.sink, scheduled)
+        return len(scheduled), len(schedule.scheduled) - len(scheduled) + len(schedule.deferred)
+
+    def _job_open_month(self) -> int:
+        date_from, date_to = get_current_month_period()
+        return self._run_range(date_from, date_to, self.grain)[0]
+
+    def _job_yesterday(self) -> int:
+        if self.grain == 'daily':
+            day = self.settled_day.strftime('%Y-%m-%d')
+            return self._run_range(day, day, 'daily')[0]
+        # Месяц целиком: устоявшийся день закрытого месяца - повод перезаписать месяц окончательными данными
+        if self.settled_day.replace(day=1) == date.today().replace(day=1):
+            return 0
+        return self._run_range(*month_bounds(self.settled_day), 'monthly')[0]
+
+    def _job_retry(self) -> int:
+        units = main.dead_letter_units(self.sink)
+        if not units:
+            return 0
+        used = self.sink.get_api_usage(date.today().strftime('%Y-%m-%d'))
+        scheduled = budget.schedule_units(units, self.budgets, used).scheduled
+        main.run_units(self.metrika, self.webmaster, self.sink, scheduled)
+        return len(scheduled)
+
+    def _job_backfill(self) -> int:
+        if self.grain == 'daily':
+            date_to = self.settled_day.strftime('%Y-%m-%d')
+        else:
+            # Открытый месяц обновляет отдельная задача
+            date_to = (date.today().replace(day=1) - timedelta(days=1)).strftime('%Y-%m-%d')
+        if self.backfill_from > date_to:
+            self.next_backfill = time.monotonic() + self.backfill_idle
+            return 0
+        done, left = self._run_range(self.backfill_from, date_to, self.grain, self.backfill_batch)
+        if not done or not left:
+            # Всё загружено или квота на сегодня исчерпана - догрузка ждёт
+            self.next_backfill = time.monotonic() + self.backfill_idle
+        return done
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    Управление демоном по HTTP (только localhost):
+    GET /status, POST /trigger?job=open_month|yesterday|retry|backfill, POST /pause, POST /resume
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/status':
+            return self._send(200, self.server.daemon.status())
+        self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        parsed = urlparse(self.path)
+        if parsed.path == '/trigger':
+            job = parse_qs(parsed.query).get('job', [''])[0]
+            try:
+                queued = daemon.enqueue(job)
+            except ValueError as e:
+                return self._send(400, {'error': str(e)})
+            return self._send(200, {'job': job, 'queued': queued, 'queue_depth': len(daemon.queue)})
+        if parsed.path == '/pause':
+            daemon.pause()
+            return self._send(200, {'paused': True})
+        if parsed.path == '/resume':
+            daemon.resume()
+            return self._send(200, {'paused': False})
+        self._send(404, {'error': 'Not found'})
+
+    def _send(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ControlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, daemon: SchedulerDaemon, host: str = DAEMON_HOST, port: int = DAEMON_PORT):
+        super().__init__((host, port), ControlHandler)
+        self.daemon = daemon
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Демон выгрузки Метрики и Вебмастера с очередью задач')
+    parser.add_argument('--storage', choices=['postgres', 'sqlite', 'null'],
+                        help='Хранилище для записи (по умолчанию STORAGE_BACKEND или postgres)')
+    parser.add_argument('--grain', choices=['monthly', 'daily'], default='monthly')
+    parser.add_argument('--host', default=DAEMON_HOST, help='Адрес управляющего HTTP-эндпоинта')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT)
+    parser.add_argument('--open-month-minutes', type=float, default=DAEMON_OPEN_MONTH_MINUTES)
+    parser.add_argument('--backfill-from', default=DAEMON_BACKFILL_FROM, help='Начало исторической догрузки (YYYY-MM-DD)')
+    args = parser.parse_args()
+    setup_logging()
+
+    daemon = SchedulerDaemon(main.OAUTH_TOKENS, main.COUNTER_ID, main.WEBMASTER_HOST, args.storage, args.grain,
+                             args.open_month_minutes, args.backfill_from)
+    control = ControlServer(daemon, args.host, args.port)
+    threading.Thread(target=control.serve_forever, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    logger.info('Демон запущен, управление на http://%s:%s', args.host, args.port)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+    finally:
+        control.shutdown()
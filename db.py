@@ -1,38 +1,20 @@
+import gzip
 import psycopg2
 import os
 import logging
+import threading
 
+from collections import OrderedDict
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
+from exceptions import SchemaMigrationRequired
+from logs import log_event, setup_logging
+from models import DeadLetter, OrganicPageRow, ReferralUrlRow, SearchQueryRow, TopNSummaryRow, TrafficRow
+from profiling import profiler
+from psycopg2.extras import Json, execute_batch
+from psycopg2.pool import ThreadedConnectionPool
 from typing import Dict, Optional
 
-def setup_logger():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    # Ротация логов (10 МБ, максимум 5 файлов)
-    file_handler = RotatingFileHandler(
-        'bd.log', 
-        maxBytes=10*1024*1024, 
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setFormatter(formatter)
-    
-    # Вывод в консоль
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    return logger
-
-logger = setup_logger()
+logger = logging.getLogger('db')
 
 load_dotenv()
 
@@ -44,6 +26,126 @@ DB_CONFIG ={
     "port": os.getenv('PORT')
 }
 
+# Пул подключений для долгоживущего процесса (демон). Без пула каждая функция открывает новое подключение
+_pool = None
+
+def init_pool(minconn: int = 1, maxconn: int = 4):
+    """Поднимает пул подключений; дальше все функции модуля берут подключения из него"""
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(minconn, maxconn, **DB_CONFIG)
+        logger.info("Пул подключений к БД: %s-%s", minconn, maxconn)
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+def _connect():
+    return _pool.getconn() if _pool is not None else psycopg2.connect(**DB_CONFIG)
+
+def _release(conn):
+    if _pool is not None:
+        _pool.putconn(conn)
+    else:
+        conn.close()
+
+# Строки с высокой кардинальностью (тексты запросов, URL страниц и рефереров) хранятся
+# один раз в справочниках dim_*, а таблицы фактов *_facts ссылаются на них целыми id.
+# Представления со старыми именами таблиц отдают строки в прежнем виде, поэтому чтение не меняется.
+# Таблица -> (таблица фактов, колонка-строка, справочник, колонка-ссылка)
+DIMENSIONS = {
+    'organic_pages_by_url': ('organic_pages_by_url_facts', 'page_url', 'dim_page_url', 'page_id'),
+    'search_queries_webmaster': ('search_queries_webmaster_facts', 'query_text', 'dim_query_text', 'query_id'),
+    'referral_urls': ('referral_urls_facts', 'referral_url', 'dim_referral_url', 'referral_id'),
+    'referral_urls_daily': ('referral_urls_daily_facts', 'referral_url', 'dim_referral_url', 'referral_id'),
+    'search_queries_webmaster_daily': ('search_queries_webmaster_daily_facts', 'query_text', 'dim_query_text',
+                                       'query_id')
+}
+# Сколько последних значений каждого справочника держать в памяти процесса
+DIM_CACHE_SIZE = int(os.getenv('DIM_CACHE_SIZE', 100000))
+
+DIMENSION_COMMANDS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS public.{dim} (
+        id SERIAL PRIMARY KEY,
+        value VARCHAR(512) NOT NULL UNIQUE
+    )
+    """
+    for dim in ('dim_page_url', 'dim_query_text', 'dim_referral_url')
+] + [
+    """
+    CREATE TABLE IF NOT EXISTS public.organic_pages_by_url_facts (
+        id BIGSERIAL PRIMARY KEY,
+        base_url VARCHAR(512),
+        page_id INTEGER REFERENCES public.dim_page_url (id),
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        bounce_rate NUMERIC(5,2) NOT NULL,      -- Проценты
+        visits INTEGER NOT NULL,
+        traffic_share NUMERIC(5,2) NOT NULL,    -- Проценты
+        month_year VARCHAR(512) NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_date_range_page_id UNIQUE (date_from, date_to, page_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.search_queries_webmaster_facts (
+        id BIGSERIAL PRIMARY KEY,
+        query_id INTEGER REFERENCES public.dim_query_text (id),
+        shows INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        avg_show_position NUMERIC(5,2) NOT NULL,  -- Позиция с 2 знаками
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        month_year VARCHAR(512) NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_query_id_date UNIQUE (date_from, date_to, query_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.referral_urls_facts (
+        id BIGSERIAL PRIMARY KEY,
+        referral_id INTEGER REFERENCES public.dim_referral_url (id),
+        visits INTEGER NOT NULL,
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        month_year VARCHAR(512) NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_date_range_referral_id UNIQUE (date_from, date_to, referral_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.referral_urls_daily_facts (
+        id BIGSERIAL PRIMARY KEY,
+        referral_id INTEGER REFERENCES public.dim_referral_url (id),
+        visits INTEGER NOT NULL,
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        month_year VARCHAR(512) NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_day_referral_id UNIQUE (date_from, referral_id),
+        CONSTRAINT referral_urls_daily_facts_one_day CHECK (date_from = date_to)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.search_queries_webmaster_daily_facts (
+        id BIGSERIAL PRIMARY KEY,
+        query_id INTEGER REFERENCES public.dim_query_text (id),
+        shows INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        avg_show_position NUMERIC(5,2) NOT NULL,
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        month_year VARCHAR(512) NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_day_query_id UNIQUE (date_from, query_id),
+        CONSTRAINT search_queries_webmaster_daily_facts_one_day CHECK (date_from = date_to)
+    )
+    """
+]
+
 SQL_COMMANDS = [
     """
     CREATE TABLE IF NOT EXISTS public.all_traffic_by_url (
@@ -70,80 +172,344 @@ SQL_COMMANDS = [
     )
     """,
     """
-    CREATE TABLE IF NOT EXISTS public.organic_pages_by_url (
+    CREATE OR REPLACE VIEW public.organic_pages_by_url AS
+    SELECT f.id, f.base_url, d.value AS page_url, f.date_from, f.date_to, f.bounce_rate, f.visits,
+           f.traffic_share, f.month_year, f.updated_at
+    FROM public.organic_pages_by_url_facts f
+    LEFT JOIN public.dim_page_url d ON d.id = f.page_id
+    """,
+    """
+    CREATE OR REPLACE VIEW public.search_queries_webmaster AS
+    SELECT f.id, d.value AS query_text, f.shows, f.clicks, f.avg_show_position, f.date_from, f.date_to,
+           f.month_year, f.updated_at
+    FROM public.search_queries_webmaster_facts f
+    LEFT JOIN public.dim_query_text d ON d.id = f.query_id
+    """,
+    """
+    CREATE OR REPLACE VIEW public.referral_urls AS
+    SELECT f.id, d.value AS referral_url, f.visits, f.date_from, f.date_to, f.month_year, f.updated_at
+    FROM public.referral_urls_facts f
+    LEFT JOIN public.dim_referral_url d ON d.id = f.referral_id
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.sections (
+        url VARCHAR(512) PRIMARY KEY,
+        visits INTEGER NOT NULL,
+        window_from DATE NOT NULL,         -- Окно, за которое считались визиты
+        window_to DATE NOT NULL,
+        min_visits INTEGER NOT NULL,       -- Порог активности на момент обнаружения
+        active BOOLEAN NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Дневная детализация: те же поля, date_from = date_to = день
+    """
+    CREATE TABLE IF NOT EXISTS public.all_traffic_by_url_daily (
         id BIGSERIAL PRIMARY KEY,
-        base_url VARCHAR(512),
-        page_url VARCHAR(512),
+        url VARCHAR(512) NOT NULL,
         date_from DATE NOT NULL,
         date_to DATE NOT NULL,
-        bounce_rate NUMERIC(5,2) NOT NULL,      -- Проценты
+        organic INTEGER NOT NULL,
+        direct INTEGER NOT NULL,
+        social INTEGER NOT NULL,
+        referral INTEGER NOT NULL,
+        ad INTEGER NOT NULL,
+        internal INTEGER NOT NULL,
+        email INTEGER NOT NULL,
+        google_traffic INTEGER NOT NULL,
+        yandex_traffic INTEGER NOT NULL,
+        bounce_rate NUMERIC(5,2) NOT NULL,
+        page_depth NUMERIC(5,2) NOT NULL,
+        avg_visit NUMERIC(10,2) NOT NULL,
         visits INTEGER NOT NULL,
-        traffic_share NUMERIC(5,2) NOT NULL,    -- Проценты
         month_year VARCHAR(512) NOT NULL,
         updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        CONSTRAINT unique_date_range_page_url UNIQUE (date_from, date_to, page_url)
+        CONSTRAINT unique_day_url UNIQUE (date_from, url),
+        CONSTRAINT all_traffic_by_url_daily_one_day CHECK (date_from = date_to)
     )
     """,
     """
-    CREATE TABLE IF NOT EXISTS public.search_queries_webmaster (
-        id BIGSERIAL PRIMARY KEY,
-        query_text VARCHAR(512),
-        shows INTEGER NOT NULL,
-        clicks INTEGER NOT NULL,
-        avg_show_position NUMERIC(5,2) NOT NULL,  -- Позиция с 2 знаками
+    CREATE OR REPLACE VIEW public.referral_urls_daily AS
+    SELECT f.id, d.value AS referral_url, f.visits, f.date_from, f.date_to, f.month_year, f.updated_at
+    FROM public.referral_urls_daily_facts f
+    LEFT JOIN public.dim_referral_url d ON d.id = f.referral_id
+    """,
+    """
+    CREATE OR REPLACE VIEW public.search_queries_webmaster_daily AS
+    SELECT f.id, d.value AS query_text, f.shows, f.clicks, f.avg_show_position, f.date_from, f.date_to,
+           f.month_year, f.updated_at
+    FROM public.search_queries_webmaster_daily_facts f
+    LEFT JOIN public.dim_query_text d ON d.id = f.query_id
+    """,
+    # Месячные свёртки дневных данных. Счётчики суммируются,
+    # средние взвешиваются визитами (для запросов - показами)
+    """
+    CREATE OR REPLACE VIEW public.all_traffic_by_url_monthly AS
+    SELECT
+        url,
+        date_trunc('month', date_from)::date AS date_from,
+        (date_trunc('month', date_from) + INTERVAL '1 month - 1 day')::date AS date_to,
+        SUM(organic) AS organic,
+        SUM(direct) AS direct,
+        SUM(social) AS social,
+        SUM(referral) AS referral,
+        SUM(ad) AS ad,
+        SUM(internal) AS internal,
+        SUM(email) AS email,
+        SUM(google_traffic) AS google_traffic,
+        SUM(yandex_traffic) AS yandex_traffic,
+        ROUND(SUM(bounce_rate * visits) / NULLIF(SUM(visits), 0), 2) AS bounce_rate,
+        ROUND(SUM(page_depth * visits) / NULLIF(SUM(visits), 0), 2) AS page_depth,
+        ROUND(SUM(avg_visit * visits) / NULLIF(SUM(visits), 0), 2) AS avg_visit,
+        SUM(visits) AS visits,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM public.all_traffic_by_url_daily
+    GROUP BY url, date_trunc('month', date_from)
+    """,
+    """
+    CREATE OR REPLACE VIEW public.referral_urls_monthly AS
+    SELECT
+        referral_url,
+        SUM(visits) AS visits,
+        date_trunc('month', date_from)::date AS date_from,
+        (date_trunc('month', date_from) + INTERVAL '1 month - 1 day')::date AS date_to,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM public.referral_urls_daily
+    GROUP BY referral_url, date_trunc('month', date_from)
+    """,
+    """
+    CREATE OR REPLACE VIEW public.search_queries_webmaster_monthly AS
+    SELECT
+        query_text,
+        SUM(shows) AS shows,
+        SUM(clicks) AS clicks,
+        ROUND(SUM(avg_show_position * shows) / NULLIF(SUM(shows), 0), 2) AS avg_show_position,
+        date_trunc('month', date_from)::date AS date_from,
+        (date_trunc('month', date_from) + INTERVAL '1 month - 1 day')::date AS date_to,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM public.search_queries_webmaster_daily
+    GROUP BY query_text, date_trunc('month', date_from)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.api_usage (
+        day DATE NOT NULL,
+        service VARCHAR(32) NOT NULL,
+        endpoint VARCHAR(255) NOT NULL,
+        calls INTEGER NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_api_usage UNIQUE (day, service, endpoint)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.load_log (
+        table_name VARCHAR(64) NOT NULL,
+        url VARCHAR(512) NOT NULL DEFAULT '',
         date_from DATE NOT NULL,
         date_to DATE NOT NULL,
-        month_year VARCHAR(512) NOT NULL,
-        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        CONSTRAINT unique_query_text_date UNIQUE (date_from, date_to, query_text)
+        rows INTEGER NOT NULL DEFAULT 0,
+        loaded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_load_log UNIQUE (table_name, url, date_from, date_to)
     )
     """,
     """
-    CREATE TABLE IF NOT EXISTS public.referral_urls (
-        id BIGSERIAL PRIMARY KEY,
-        referral_url VARCHAR(512),
-        visits INTEGER NOT NULL,
+    CREATE TABLE IF NOT EXISTS public.export_watermarks (
+        consumer VARCHAR(64) NOT NULL,
+        table_name VARCHAR(64) NOT NULL,
+        watermark TIMESTAMP WITH TIME ZONE NOT NULL,
+        rows_exported INTEGER NOT NULL DEFAULT 0,
+        exported_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT unique_export_watermark UNIQUE (consumer, table_name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.dead_letters (
+        unit_key VARCHAR(1024) PRIMARY KEY,
+        kind VARCHAR(32) NOT NULL,
+        params JSONB NOT NULL,
+        stage VARCHAR(16) NOT NULL,
+        error TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        next_retry_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public.topn_summaries (
+        table_name VARCHAR(64) NOT NULL,
+        metric VARCHAR(32) NOT NULL,
+        scope VARCHAR(512) NOT NULL DEFAULT '',
         date_from DATE NOT NULL,
         date_to DATE NOT NULL,
-        month_year VARCHAR(512) NOT NULL,
+        floor DOUBLE PRECISION NOT NULL,
+        total DOUBLE PRECISION NOT NULL,
+        items JSONB NOT NULL,
         updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        CONSTRAINT unique_date_range_referral_urls UNIQUE (date_from, date_to, referral_url)
+        CONSTRAINT unique_topn_summary UNIQUE (table_name, metric, scope, date_from)
     )
     """
 ]
 
-def create_tables():
-    """Создаёт таблицы и индексы в БД"""
+# Таблицы, изменения которых выгружает export_changes. Индекс по updated_at
+# позволяет выбирать изменённые строки, не читая таблицу целиком
+EXPORT_TABLES = [
+    'all_traffic_by_url',
+    'organic_pages_by_url',
+    'referral_urls',
+    'search_queries_webmaster',
+    'all_traffic_by_url_daily',
+    'referral_urls_daily',
+    'search_queries_webmaster_daily'
+]
+SQL_COMMANDS += [
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON public.{DIMENSIONS.get(table, (table,))[0]} (updated_at)"
+    for table in EXPORT_TABLES
+]
+# Формат COPY и расширение файла выгрузки (файлы сжимаются gzip)
+EXPORT_FORMATS = {
+    'csv': ("FORMAT csv, HEADER", 'csv.gz'),
+    'binary': ("FORMAT binary", 'pgcopy.gz')
+}
+# Строки моложе этого не выгружаются (запас сверх границы по незавершённым транзакциям, см. _export_horizon)
+EXPORT_LAG_SECONDS = int(os.getenv('EXPORT_LAG_SECONDS', 60))
+
+def _legacy_tables(cursor) -> list:
+    """Таблицы из DIMENSIONS, которые ещё хранятся прежним образом - обычной таблицей со строковой колонкой"""
+    legacy = []
+    for table in DIMENSIONS:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (f'public.{table}',))
+        found = cursor.fetchone()
+        if found and found[0] == 'r':
+            legacy.append(table)
+    return legacy
+
+def _dependent_views(cursor, table: str) -> list:
+    """Представления, построенные на таблице"""
+    cursor.execute(
+        """
+        SELECT DISTINCT v.oid::regclass::text
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.refobjid = to_regclass(%s) AND v.oid <> d.refobjid
+        """,
+        (f'public.{table}',)
+    )
+    return sorted(name for (name,) in cursor.fetchall())
+
+def _migrate_table(cursor, table: str) -> int:
+    """
+    Переносит строки прежней таблицы в справочник и таблицу фактов с сохранением id (потребители
+    выгрузок изменений видят те же ключи) и переименовывает её в <table>_legacy, освобождая имя
+    для представления. Прежняя таблица не удаляется: она остаётся резервной копией
+    """
+    facts, column, dim, ref = DIMENSIONS[table]
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position",
+        (facts,)
+    )
+    columns = [name for (name,) in cursor.fetchall()]
+    select = ', '.join('d.id' if name == ref else f't.{name}' for name in columns)
+    cursor.execute(
+        f"INSERT INTO public.{dim} (value) SELECT DISTINCT {column} FROM public.{table} "
+        f"WHERE {column} IS NOT NULL ON CONFLICT (value) DO NOTHING"
+    )
+    cursor.execute(
+        f"INSERT INTO public.{facts} ({', '.join(columns)}) SELECT {select} FROM public.{table} t "
+        f"LEFT JOIN public.{dim} d ON d.value = t.{column} ON CONFLICT DO NOTHING"
+    )
+    moved = cursor.rowcount
+    cursor.execute(
+        f"SELECT setval(pg_get_serial_sequence('public.{facts}', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+        f"FROM public.{facts}"
+    )
+    # Индекс по updated_at с тем же именем строится на таблице фактов
+    cursor.execute(f"ALTER INDEX IF EXISTS public.idx_{table}_updated_at RENAME TO idx_{table}_legacy_updated_at")
+    cursor.execute(f"ALTER TABLE public.{table} RENAME TO {table}_legacy")
+    return moved
+
+def migrate_to_dimensions(apply: bool = False) -> list:
+    """
+    Переводит прежние таблицы со строками на справочники и таблицы фактов и создаёт остальную схему.
+    Всё выполняется одной транзакцией; без apply она откатывается (пробный прогон).
+    Представления, построенные на прежних таблицах, после переименования смотрят на <table>_legacy;
+    месячные представления пайплайна пересоздаются поверх новых, пользовательские нужно перенести вручную
+
+    Returns:
+        list: (таблица, перенесено строк, зависимые представления) по каждой прежней таблице
+    """
+    conn = _connect()
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
         cursor = conn.cursor()
-        
+        for command in DIMENSION_COMMANDS:
+            cursor.execute(command)
+        result = []
+        for table in _legacy_tables(cursor):
+            views = _dependent_views(cursor, table)
+            moved = _migrate_table(cursor, table)
+            result.append((table, moved, views))
+            logger.info("Таблица %s переведена на справочник %s: %s строк", table, DIMENSIONS[table][2], moved)
         for command in SQL_COMMANDS:
             cursor.execute(command)
-            logger.info("Выполнена команда: %s", command.split()[0:4] + ["..."])
+        if apply:
+            conn.commit()
+        else:
+            conn.rollback()
+        return result
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        _release(conn)
+
+def create_tables():
+    """
+    Создаёт недостающие таблицы, представления и индексы в БД (только CREATE ... IF NOT EXISTS
+    и CREATE OR REPLACE VIEW). Если в БД остались таблицы прежнего вида, ничего не создаёт
+    и поднимает SchemaMigrationRequired: перенос данных запускается отдельно, ``python db.py migrate``
+    """
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+
+        legacy = _legacy_tables(cursor)
+        if legacy:
+            raise SchemaMigrationRequired(
+                f"Таблицы {', '.join(legacy)} хранятся без справочников: "
+                f"проверьте перенос (python db.py migrate) и выполните его (python db.py migrate --apply)"
+            )
+        for command in DIMENSION_COMMANDS + SQL_COMMANDS:
+            cursor.execute(command)
+            logger.debug("Выполнена команда: %s", command.split()[0:4] + ["..."])
         
         conn.commit()
-        logger.info("Все таблицы успешно созданы")
+        logger.info("Все таблицы успешно созданы (команд: %s)", len(DIMENSION_COMMANDS) + len(SQL_COMMANDS))
         
     except psycopg2.Error as e:
-        logger.error(f"Ошибка при создании таблиц: {e}")
+        logger.error("Ошибка при создании таблиц: %s", e)
         if 'conn' in locals():
             conn.rollback()
     finally:
         if 'conn' in locals():
-            conn.close()
-
+            _release(conn)
 
 def check_database():
     """Проверяет подключение к БД и список таблиц"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = _connect()
         cursor = conn.cursor()
         
         # Проверяем текущую БД
         cursor.execute("SELECT current_database()")
         db_name = cursor.fetchone()[0]
-        logger.info(f"Подключены к БД: {db_name}")
+        logger.info("Подключены к БД: %s", db_name)
         
         # Проверяем существование таблиц
         cursor.execute("""
@@ -162,39 +528,119 @@ def check_database():
                     FROM information_schema.columns
                     WHERE table_name = '{table}'
                 """)
-                logger.info(f"Структура таблицы {table}: {cursor.fetchall()}")
+                logger.info("Структура таблицы %s: %s", table, cursor.fetchall())
         
     except psycopg2.Error as e:
-        logger.error(f"Ошибка проверки: {e}")
+        logger.error("Ошибка проверки: %s", e)
     finally:
         if 'conn' in locals():
-            conn.close()
+            _release(conn)
 
-def upsert_traffic_data(data: dict) -> Optional[int]:
+TRAFFIC_UPSERT_QUERY = """
+    INSERT INTO public.all_traffic_by_url (
+        url, date_from, date_to, organic, direct, social, 
+        referral, ad, internal, email, google_traffic, 
+        yandex_traffic, bounce_rate, page_depth, avg_visit, visits, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s, %s, %s, %s,
+        %s, %s, %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, date_to, url)
+    DO UPDATE SET
+        organic = EXCLUDED.organic,
+        direct = EXCLUDED.direct,
+        social = EXCLUDED.social,
+        referral = EXCLUDED.referral,
+        ad = EXCLUDED.ad,
+        internal = EXCLUDED.internal,
+        email = EXCLUDED.email,
+        google_traffic = EXCLUDED.google_traffic,
+        yandex_traffic = EXCLUDED.yandex_traffic,
+        bounce_rate = EXCLUDED.bounce_rate,
+        page_depth = EXCLUDED.page_depth,
+        avg_visit = EXCLUDED.avg_visit,
+        visits = EXCLUDED.visits,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
     """
-    Вставляет или обновляет данные трафика по периоду дат
-    
-    Args:
-        data: Словарь с данными
 
-    
-    Returns:
-        int: ID обновленной/созданной записи
-        None: В случае ошибки
+ORGANIC_PAGES_UPSERT_QUERY = """
+    INSERT INTO public.organic_pages_by_url_facts (
+        base_url, page_id, date_from, date_to, 
+        bounce_rate, visits, traffic_share, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, date_to, page_id)
+    DO UPDATE SET
+        base_url = EXCLUDED.base_url,
+        bounce_rate = EXCLUDED.bounce_rate,
+        visits = EXCLUDED.visits,
+        traffic_share = EXCLUDED.traffic_share,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
     """
 
-    query = """
-    INSERT INTO public.all_traffic_by_url (
+REFERRAL_URLS_UPSERT_QUERY = """
+    INSERT INTO public.referral_urls_facts (
+        referral_id, visits, 
+        date_from, date_to, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, date_to, referral_id)
+    DO UPDATE SET
+        visits = EXCLUDED.visits,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
+    """
+
+SEARCH_QUERIES_UPSERT_QUERY = """
+    INSERT INTO public.search_queries_webmaster_facts (
+        query_id, shows, clicks, avg_show_position, 
+        date_from, date_to, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, date_to, query_id)
+    DO UPDATE SET
+        shows = EXCLUDED.shows,
+        clicks = EXCLUDED.clicks,
+        avg_show_position = EXCLUDED.avg_show_position,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
+    """
+
+SECTIONS_UPSERT_QUERY = """
+    INSERT INTO public.sections (
+        url, visits, window_from, window_to, min_visits, active
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (url)
+    DO UPDATE SET
+        visits = EXCLUDED.visits,
+        window_from = EXCLUDED.window_from,
+        window_to = EXCLUDED.window_to,
+        min_visits = EXCLUDED.min_visits,
+        active = EXCLUDED.active,
+        updated_at = NOW()
+    """
+
+TRAFFIC_DAILY_UPSERT_QUERY = """
+    INSERT INTO public.all_traffic_by_url_daily (
         url, date_from, date_to, organic, direct, social, 
         referral, ad, internal, email, google_traffic, 
         yandex_traffic, bounce_rate, page_depth, avg_visit, visits, month_year
     ) VALUES (
-        %(url)s, %(date_from)s, %(date_to)s, %(organic)s, %(direct)s,
-        %(social)s, %(referral)s, %(ad)s, %(internal)s, %(email)s,
-        %(google_traffic)s, %(yandex_traffic)s, %(bounce_rate)s,
-        %(page_depth)s, %(avg_visit)s, %(visits)s, %(month_year)s
+        %s, %s, %s, %s, %s, %s, %s, %s, %s,
+        %s, %s, %s, %s, %s, %s, %s, %s
     )
-    ON CONFLICT (date_from, date_to, url)
+    ON CONFLICT (date_from, url)
     DO UPDATE SET
         organic = EXCLUDED.organic,
         direct = EXCLUDED.direct,
@@ -213,159 +659,620 @@ def upsert_traffic_data(data: dict) -> Optional[int]:
         updated_at = NOW()
     RETURNING id
     """
-    
+
+REFERRAL_URLS_DAILY_UPSERT_QUERY = """
+    INSERT INTO public.referral_urls_daily_facts (
+        referral_id, visits, 
+        date_from, date_to, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, referral_id)
+    DO UPDATE SET
+        visits = EXCLUDED.visits,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
+    """
+
+SEARCH_QUERIES_DAILY_UPSERT_QUERY = """
+    INSERT INTO public.search_queries_webmaster_daily_facts (
+        query_id, shows, clicks, avg_show_position, 
+        date_from, date_to, month_year
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (date_from, query_id)
+    DO UPDATE SET
+        shows = EXCLUDED.shows,
+        clicks = EXCLUDED.clicks,
+        avg_show_position = EXCLUDED.avg_show_position,
+        month_year = EXCLUDED.month_year,
+        updated_at = NOW()
+    RETURNING id
+    """
+
+UPSERT_QUERIES = {
+    'all_traffic_by_url': TRAFFIC_UPSERT_QUERY,
+    'organic_pages_by_url': ORGANIC_PAGES_UPSERT_QUERY,
+    'referral_urls': REFERRAL_URLS_UPSERT_QUERY,
+    'search_queries_webmaster': SEARCH_QUERIES_UPSERT_QUERY,
+    'all_traffic_by_url_daily': TRAFFIC_DAILY_UPSERT_QUERY,
+    'referral_urls_daily': REFERRAL_URLS_DAILY_UPSERT_QUERY,
+    'search_queries_webmaster_daily': SEARCH_QUERIES_DAILY_UPSERT_QUERY
+}
+
+
+class InternCache:
+    """
+    LRU-кеш справочника в памяти процесса: строка -> id. Новые id кладутся сюда
+    только после коммита транзакции, в которой созданы, чтобы откат не оставил в кеше
+    несуществующих id
+    """
+
+    def __init__(self, size: int = DIM_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, values) -> tuple:
+        """(значение -> id для найденных, список ненайденных)"""
+        found, missing = {}, []
+        with self._lock:
+            for value in values:
+                record_id = self._ids.get(value)
+                if record_id is None:
+                    missing.append(value)
+                else:
+                    self._ids.move_to_end(value)
+                    found[value] = record_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def update(self, ids: dict):
+        with self._lock:
+            self._ids.update(ids)
+            for value in ids:
+                self._ids.move_to_end(value)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+
+_intern_caches = {dim: InternCache() for _, _, dim, _ in DIMENSIONS.values()}
+
+def _resolve_ids(cursor, dim: str, values: set) -> tuple:
+    """
+    id значений справочника для всей пачки: из кеша, остальные одним SELECT,
+    отсутствующие в справочнике - одним INSERT
+
+    :return: (значение -> id для всех values, новые для кеша соответствия)
+    """
+    ids, missing = _intern_caches[dim].lookup(values)
+    fresh = {}
+    if missing:
+        cursor.execute(f"SELECT value, id FROM public.{dim} WHERE value = ANY(%s)", (missing,))
+        fresh.update(cursor.fetchall())
+        new = [value for value in missing if value not in fresh]
+        if new:
+            cursor.execute(
+                f"INSERT INTO public.{dim} (value) SELECT unnest(%s::varchar[]) "
+                f"ON CONFLICT (value) DO NOTHING RETURNING value, id",
+                (new,)
+            )
+            fresh.update(cursor.fetchall())
+            # Значения, которые одновременно вставила другая транзакция
+            late = [value for value in new if value not in fresh]
+            if late:
+                cursor.execute(f"SELECT value, id FROM public.{dim} WHERE value = ANY(%s)", (late,))
+                fresh.update(cursor.fetchall())
+        ids.update(fresh)
+    return ids, fresh
+
+def _encode_rows(cursor, table: str, rows: list) -> tuple:
+    """
+    Заменяет в строках пачки строковую колонку на id справочника (для таблиц из DIMENSIONS)
+
+    :return: (строки для таблицы фактов, новые id для кеша)
+    """
+    _, column, dim, _ = DIMENSIONS[table]
+    index = rows[0]._fields.index(column)
+    ids, fresh = _resolve_ids(cursor, dim, {row[index] for row in rows if row[index] is not None})
+    encoded = [row[:index] + (ids.get(row[index]),) + row[index + 1:] for row in rows]
+    return encoded, fresh
+
+def _upsert_row(table: str, row: tuple) -> Optional[int]:
+    """Выполняет upsert одной строки с позиционными параметрами и возвращает её ID"""
+    with profiler.stage('db_connect'):
+        conn = _connect()
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, data)
+        fresh = None
+        with conn.cursor() as cursor:
+            with profiler.stage('db_execute'):
+                if table in DIMENSIONS:
+                    (row,), fresh = _encode_rows(cursor, table, [row])
+                cursor.execute(UPSERT_QUERIES[table], row)
                 record_id = cursor.fetchone()[0]
-                conn.commit()
-                logging.info(f"Данные за период {data['date_from']}-{data['date_to']} обновлены. ID: {record_id}")
-                return record_id
+        with profiler.stage('commit'):
+            conn.commit()
+        if fresh:
+            _intern_caches[DIMENSIONS[table][2]].update(fresh)
+        return record_id
+    finally:
+        _release(conn)
+
+
+def upsert_traffic_data(data: TrafficRow) -> Optional[int]:
+    """
+    Вставляет или обновляет данные трафика по периоду дат
+    
+    Args:
+        data: Строка TrafficRow
+
+    
+    Returns:
+        int: ID обновленной/созданной записи
+        None: В случае ошибки
+    """
+    try:
+        record_id = _upsert_row('all_traffic_by_url', data)
+        with profiler.stage('logging'):
+            log_event(logger, 'row_written', table='all_traffic_by_url', id=record_id,
+                      date_from=data.date_from, date_to=data.date_to)
+        return record_id
                 
     except psycopg2.Error as e:
-        logging.error(f"Ошибка при обновлении данных: {e}")
+        logger.error("Ошибка при обновлении данных: %s", e)
         return None
 
-def upsert_organic_pages_data(data: dict) -> Optional[int]:
+def upsert_organic_pages_data(data: OrganicPageRow) -> Optional[int]:
     """
     Вставляет или обновляет данные органического трафика по страницам
     
     Args:
-        data: Словарь с данными
+        data: Строка OrganicPageRow
             
     
     Returns:
         int: ID обновленной/созданной записи
         None: В случае ошибки
     """
-
-
-    # 3. UPSERT запрос
-    query = """
-    INSERT INTO public.organic_pages_by_url (
-        base_url, page_url, date_from, date_to, 
-        bounce_rate, visits, traffic_share, month_year
-    ) VALUES (
-        %(base_url)s, %(page_url)s, %(date_from)s, %(date_to)s,
-        %(bounce_rate)s, %(visits)s, %(traffic_share)s, %(month_year)s
-    )
-    ON CONFLICT (date_from, date_to, page_url)
-    DO UPDATE SET
-        base_url = EXCLUDED.base_url,
-        page_url = EXCLUDED.page_url,
-        bounce_rate = EXCLUDED.bounce_rate,
-        visits = EXCLUDED.visits,
-        traffic_share = EXCLUDED.traffic_share,
-        month_year = EXCLUDED.month_year,
-        updated_at = NOW()
-    RETURNING id
-    """
-    
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, data)
-                record_id = cursor.fetchone()[0]
-                conn.commit()
-                logging.info(f"Данные за {data['date_from']}-{data['date_to']} обновлены. ID: {record_id}")
-                return record_id
+        record_id = _upsert_row('organic_pages_by_url', data)
+        with profiler.stage('logging'):
+            log_event(logger, 'row_written', table='organic_pages_by_url', id=record_id,
+                      date_from=data.date_from, date_to=data.date_to)
+        return record_id
                 
     except psycopg2.Error as e:
-        logging.error(f"Ошибка базы данных: {e}")
+        logger.error("Ошибка базы данных: %s", e)
         return None
 
-def upsert_referral_urls_data(data: dict) -> Optional[int]: # лучше оптимизировать функцию (пакетное обновление), чтобы не создавать новое подключения для каждого урла в рамках одной даты
+def upsert_referral_urls_data(data: ReferralUrlRow) -> Optional[int]:
     """
     Вставляет или обновляет данные url рефереров
     
     Args:
-        data: Словарь с данными
+        data: Строка ReferralUrlRow
     
     Returns:
         int: ID обновленной/созданной записи
         None: В случае ошибки
     """
-
-    query = """
-    INSERT INTO public.referral_urls (
-        referral_url, visits, 
-        date_from, date_to, month_year
-    ) VALUES (
-        %(referral_url)s, %(visits)s,
-        %(date_from)s, %(date_to)s, %(month_year)s
-    )
-    ON CONFLICT (date_from, date_to, referral_url)
-    DO UPDATE SET
-        referral_url = EXCLUDED.referral_url,
-        visits = EXCLUDED.visits,
-        date_from = EXCLUDED.date_from,
-        date_to = EXCLUDED.date_to,
-        month_year = EXCLUDED.month_year,
-        updated_at = NOW()
-    RETURNING id
-    """
-    
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, data)
-                record_id = cursor.fetchone()[0]
-                conn.commit()
-                logging.info(f"Данные за {data['date_from']}-{data['date_to']} обновлены. ID: {record_id}")
-                return record_id
+        record_id = _upsert_row('referral_urls', data)
+        with profiler.stage('logging'):
+            log_event(logger, 'row_written', table='referral_urls', id=record_id,
+                      date_from=data.date_from, date_to=data.date_to)
+        return record_id
                 
     except psycopg2.Error as e:
-        logging.error(f"Ошибка базы данных: {e}")
+        logger.error("Ошибка базы данных: %s", e)
         return None
     
-def upsert_search_queries_webmaster_data(data: dict) -> Optional[int]:
+def upsert_search_queries_webmaster_data(data: SearchQueryRow) -> Optional[int]:
     """
     Вставляет или обновляет данные запросов с вебмастера
     
     Args:
-        data: Словарь с данными
+        data: Строка SearchQueryRow
     
     Returns:
         int: ID обновленной/созданной записи
         None: В случае ошибки
     """
-    # 1. Проверка обязательных полей
+    try:
+        record_id = _upsert_row('search_queries_webmaster', data)
+        with profiler.stage('logging'):
+            log_event(logger, 'row_written', table='search_queries_webmaster', id=record_id,
+                      date_from=data.date_from, date_to=data.date_to)
+        return record_id
+                
+    except psycopg2.Error as e:
+        logger.error("Ошибка базы данных: %s", e)
+        return None
+
+def upsert_many(table: str, rows: list, page_size: int = 500, raise_errors: bool = False) -> int:
+    """
+    Пакетный upsert строк одной таблицы: одно подключение, один коммит.
+    Строки (NamedTuple из models) передаются драйверу как кортежи.
+    
+    Args:
+        table: Имя таблицы из UPSERT_QUERIES
+        rows: Список строк
+        page_size: Сколько строк отправлять на сервер за один раз
+        raise_errors: Пробросить ошибку БД после отката вместо возврата 0
+    
+    Returns:
+        int: Количество записанных строк (0 в случае ошибки)
+    """
+    if not rows:
+        return 0
+
+    conn = None
+    try:
+        with profiler.stage('db_connect'):
+            conn = _connect()
+        fresh = None
+        with conn.cursor() as cursor:
+            with profiler.stage('db_execute'):
+                if table in DIMENSIONS:
+                    rows, fresh = _encode_rows(cursor, table, rows)
+                execute_batch(cursor, UPSERT_QUERIES[table], rows, page_size=page_size)
+        with profiler.stage('commit'):
+            conn.commit()
+        if fresh:
+            _intern_caches[DIMENSIONS[table][2]].update(fresh)
+        with profiler.stage('logging'):
+            log_event(logger, 'batch_written', logging.INFO, table=table, rows=len(rows))
+        return len(rows)
 
+    except psycopg2.Error as e:
+        logger.error("Ошибка пакетной записи в %s: %s", table, e)
+        if conn:
+            conn.rollback()
+        if raise_errors:
+            raise
+        return 0
+    finally:
+        if conn:
+            _release(conn)
 
+def replace_sections(rows: list) -> int:
+    """
+    Обновляет каталог разделов результатами обнаружения.
+    Разделы, которых нет в новом списке, помечаются неактивными.
+    
+    Args:
+        rows: Список SectionRow
+    
+    Returns:
+        int: Количество активных разделов (0 в случае ошибки)
+    """
+    conn = None
+    try:
+        conn = _connect()
+        with conn.cursor() as cursor:
+            cursor.execute("UPDATE public.sections SET active = FALSE, updated_at = NOW()")
+            execute_batch(cursor, SECTIONS_UPSERT_QUERY, rows)
+        conn.commit()
+        active = sum(1 for row in rows if row.active)
+        logger.info("Каталог разделов обновлён: всего %s, активных %s", len(rows), active)
+        return active
 
-    # 3. UPSERT запрос
+    except psycopg2.Error as e:
+        logger.error("Ошибка обновления каталога разделов: %s", e)
+        if conn:
+            conn.rollback()
+        return 0
+    finally:
+        if conn:
+            _release(conn)
+
+def get_active_sections(max_age_days: int = None) -> list:
+    """
+    Возвращает URL активных разделов по убыванию визитов
+    
+    Args:
+        max_age_days: Если задано, учитывается только каталог, обновлённый не раньше чем столько дней назад
+    
+    Returns:
+        list: Список URL (пустой, если каталога нет или он устарел)
+    """
+    query = "SELECT url FROM public.sections WHERE active"
+    params = None
+    if max_age_days is not None:
+        query += " AND updated_at > NOW() - %s * INTERVAL '1 day'"
+        params = (max_age_days,)
+    query += " ORDER BY visits DESC"
+    return [row[0] for row in execute_sql_query(query, params)]
+
+def get_loaded_days(table: str, date_from: str, date_to: str, url: str = None, settle_days: int = None) -> set:
+    """
+    Возвращает периоды (date_from, date_to), за которые выгрузка уже выполнена:
+    по журналу load_log, а для данных, загруженных до него, - по строкам самой таблицы.
+    Журнал отмечает и периоды, за которые API не вернул ни одной строки
+    
+    Args:
+        table: Таблица с колонками date_from/date_to (дневная или месячная)
+        date_from: Начальная дата (YYYY-MM-DD)
+        date_to: Конечная дата (YYYY-MM-DD)
+        url: Для all_traffic_by_url(_daily) - только этот раздел
+        settle_days: Если задано, учитываются только выгрузки, выполненные не раньше
+            чем через столько дней после конца периода (окончательные данные)
+    
+    Returns:
+        set: Пары дат (date_from, date_to) в формате YYYY-MM-DD. Частично выгруженный месяц
+            (date_to раньше конца месяца) отличается от полного по date_to
+    """
+    log_query = "SELECT date_from, date_to FROM public.load_log WHERE table_name = %s AND url = %s AND date_from BETWEEN %s AND %s"
+    log_params = [table, url or '', date_from, date_to]
+    query = f"SELECT date_from, date_to FROM public.{table} WHERE date_from BETWEEN %s AND %s"
+    params = [date_from, date_to]
+    if url is not None:
+        query += " AND url = %s"
+        params.append(url)
+    if settle_days is not None:
+        log_query += " AND loaded_at >= date_to + %s"
+        log_params.append(settle_days)
+        query += " AND updated_at >= date_to + %s"
+        params.append(settle_days)
+    rows = execute_sql_query(f"{log_query} UNION {query}", log_params + params)
+    return {(row[0].strftime("%Y-%m-%d"), row[1].strftime("%Y-%m-%d")) for row in rows}
+
+def mark_loaded(table: str, url: Optional[str], date_from: str, date_to: str, rows: int):
+    """
+    Отмечает в load_log выполненную выгрузку периода (в том числе без строк),
+    чтобы следующие запуски её пропускали
+
+    Raises:
+        psycopg2.Error: Если запись не удалась
+    """
     query = """
-    INSERT INTO public.search_queries_webmaster (
-        query_text, shows, clicks, avg_show_position, 
-        date_from, date_to, month_year
-    ) VALUES (
-        %(query_text)s, %(shows)s, %(clicks)s, %(avg_show_position)s,
-        %(date_from)s, %(date_to)s, %(month_year)s
-    )
-    ON CONFLICT (date_from, date_to, query_text)
-    DO UPDATE SET
-        query_text = EXCLUDED.query_text,
-        shows = EXCLUDED.shows,
-        clicks = EXCLUDED.clicks,
-        avg_show_position = EXCLUDED.avg_show_position,
-        month_year = EXCLUDED.month_year,
+    INSERT INTO public.load_log (table_name, url, date_from, date_to, rows)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (table_name, url, date_from, date_to)
+    DO UPDATE SET rows = EXCLUDED.rows, loaded_at = NOW()
+    """
+    execute_sql_query(query, (table, url or '', date_from, date_to, rows))
+
+def add_api_usage(day: str, service: str, calls: dict):
+    """
+    Прибавляет израсходованные вызовы API к счётчикам за день
+    
+    Args:
+        day: Дата (YYYY-MM-DD)
+        service: 'metrika' или 'webmaster'
+        calls: Словарь эндпоинт -> количество вызовов
+    """
+    rows = [(day, service, endpoint, count) for endpoint, count in calls.items() if count]
+    if not rows:
+        return
+    query = """
+    INSERT INTO public.api_usage (day, service, endpoint, calls)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (day, service, endpoint)
+    DO UPDATE SET calls = public.api_usage.calls + EXCLUDED.calls, updated_at = NOW()
+    """
+    conn = None
+    try:
+        conn = _connect()
+        with conn.cursor() as cursor:
+            execute_batch(cursor, query, rows)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error("Ошибка записи расхода квоты API: %s", e)
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            _release(conn)
+
+def get_api_usage(day: str) -> dict:
+    """
+    Возвращает израсходованные за день вызовы API по сервисам
+    
+    Returns:
+        dict: service -> количество вызовов
+    """
+    query = "SELECT service, SUM(calls) FROM public.api_usage WHERE day = %s GROUP BY service"
+    return {service: int(calls) for service, calls in execute_sql_query(query, (day,))}
+
+def add_dead_letter(unit_key: str, kind: str, params: dict, stage: str, error: str,
+                    backoff_seconds: float, max_backoff_seconds: float) -> int:
+    """
+    Записывает невыполненную единицу работы в dead_letters. Повторная неудача
+    той же единицы увеличивает счётчик попыток и удваивает паузу до следующего повтора
+    
+    Args:
+        unit_key: Ключ единицы работы
+        kind: Вид единицы (section, referral, webmaster, ...)
+        params: Параметры для повтора
+        stage: 'fetch' (запрос к API) или 'write' (запись в БД)
+        error: Текст ошибки
+        backoff_seconds: Пауза после первой неудачи
+        max_backoff_seconds: Максимальная пауза
+    
+    Returns:
+        int: Номер попытки (0 в случае ошибки)
+    """
+    query = """
+    INSERT INTO public.dead_letters (unit_key, kind, params, stage, error, next_retry_at)
+    VALUES (%(key)s, %(kind)s, %(params)s, %(stage)s, %(error)s,
+            NOW() + LEAST(%(backoff)s, %(max_backoff)s) * INTERVAL '1 second')
+    ON CONFLICT (unit_key) DO UPDATE SET
+        params = EXCLUDED.params,
+        stage = EXCLUDED.stage,
+        error = EXCLUDED.error,
+        attempts = public.dead_letters.attempts + 1,
+        next_retry_at = NOW() + LEAST(%(backoff)s * POWER(2, public.dead_letters.attempts), %(max_backoff)s)
+            * INTERVAL '1 second',
         updated_at = NOW()
-    RETURNING id
+    RETURNING attempts
+    """
+    conn = None
+    try:
+        conn = _connect()
+        with conn.cursor() as cursor:
+            cursor.execute(query, {
+                'key': unit_key, 'kind': kind, 'params': Json(params), 'stage': stage, 'error': error,
+                'backoff': backoff_seconds, 'max_backoff': max_backoff_seconds
+            })
+            attempts = cursor.fetchone()[0]
+        conn.commit()
+        return attempts
+    except psycopg2.Error as e:
+        logger.error("Ошибка записи в dead_letters (%s): %s", unit_key, e)
+        if conn:
+            conn.rollback()
+        return 0
+    finally:
+        if conn:
+            _release(conn)
+
+def get_dead_letters(due_only: bool = True, max_attempts: int = None) -> list:
     """
+    Возвращает невыполненные единицы работы, от старых к новым
     
+    Args:
+        due_only: Только те, у которых истекла пауза до повтора
+        max_attempts: Если задано, пропускать единицы, исчерпавшие столько попыток
+    
+    Returns:
+        list: Список DeadLetter
+    """
+    query = """
+    SELECT unit_key, kind, params, stage, error, attempts, next_retry_at::text
+    FROM public.dead_letters WHERE TRUE
+    """
+    params = []
+    if due_only:
+        query += " AND next_retry_at <= NOW()"
+    if max_attempts is not None:
+        query += " AND attempts < %s"
+        params.append(max_attempts)
+    query += " ORDER BY created_at"
+    return [DeadLetter(*row) for row in execute_sql_query(query.strip(), params)]
+
+def remove_dead_letter(unit_key: str):
+    """Убирает единицу работы из dead_letters (после успешного выполнения)"""
+    execute_sql_query("DELETE FROM public.dead_letters WHERE unit_key = %s", (unit_key,))
+
+def put_topn_summaries(rows: list):
+    """
+    Записывает сводки топа (TopNSummaryRow). Сводка периода заменяет прежнюю,
+    в том числе сводку незакрытого месяца с более ранним date_to.
+    Ошибка БД пробрасывается после отката
+    """
+    if not rows:
+        return
+    query = """
+    INSERT INTO public.topn_summaries (table_name, metric, scope, date_from, date_to, floor, total, items)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (table_name, metric, scope, date_from)
+    DO UPDATE SET date_to = EXCLUDED.date_to, floor = EXCLUDED.floor, total = EXCLUDED.total,
+                  items = EXCLUDED.items, updated_at = NOW()
+    """
+    conn = None
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, data)
-                record_id = cursor.fetchone()[0]
-                conn.commit()
-                logging.info(f"Данные за {data['date_from']}-{data['date_to']} обновлены. ID: {record_id}")
-                return record_id
-                
+        conn = _connect()
+        with conn.cursor() as cursor:
+            execute_batch(cursor, query, [row[:-1] + (Json(row.items),) for row in rows])
+        conn.commit()
     except psycopg2.Error as e:
-        logging.error(f"Ошибка базы данных: {e}")
-        return None
+        logger.error("Ошибка записи сводок топа: %s", e)
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            _release(conn)
+
+def iter_topn_summaries(table: str, metric: str, date_from: str, date_to: str, scope: str = None):
+    """
+    Сводки топа таблицы за периоды внутри диапазона. Читаются серверным курсором
+    порциями, поэтому в памяти не держатся все сразу
+    
+    Yields:
+        TopNSummaryRow
+    """
+    query = """
+    SELECT table_name, metric, scope, date_from::text, date_to::text, floor, total, items
+    FROM public.topn_summaries
+    WHERE table_name = %s AND metric = %s AND date_from >= %s AND date_to <= %s
+    """
+    params = [table, metric, date_from, date_to]
+    if scope is not None:
+        query += " AND scope = %s"
+        params.append(scope)
+    conn = _connect()
+    try:
+        with conn.cursor(name='topn_summaries') as cursor:
+            cursor.itersize = 100
+            cursor.execute(query, params)
+            for row in cursor:
+                yield TopNSummaryRow(*row)
+        conn.commit()
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        _release(conn)
+
+def get_period_rows(table: str, row_type, date_from: str) -> list:
+    """
+    Строки таблицы за период, начинающийся с date_from. Если период записан несколько раз
+    (незакрытый месяц), берётся самая полная версия - с наибольшим date_to
+    """
+    columns = ', '.join(
+        f"{field}::text" if field in ('date_from', 'date_to') else field for field in row_type._fields
+    )
+    query = f"""
+    SELECT {columns} FROM public.{table}
+    WHERE date_from = %s AND date_to = (SELECT MAX(date_to) FROM public.{table} WHERE date_from = %s)
+    """
+    return [row_type(*row) for row in execute_sql_query(query.strip(), (date_from, date_from))]
+
+def get_month_versions(table: str) -> dict:
+    """
+    Версии месяцев таблицы: месяц (YYYY-MM) по date_from -> (строк, наибольший updated_at).
+    Изменение любой строки месяца меняет его версию
+    """
+    query = f"""
+    SELECT to_char(date_from, 'YYYY-MM'), COUNT(*), MAX(updated_at)::text
+    FROM public.{table}
+    GROUP BY 1
+    """
+    return {month: (rows, updated_at) for month, rows, updated_at in execute_sql_query(query.strip())}
+
+def iter_month_rows(table: str, row_type, month: str):
+    """
+    Строки таблицы, у которых date_from приходится на месяц (YYYY-MM). Читаются серверным
+    курсором порциями, поэтому месяц не держится в памяти строками целиком
+
+    Yields:
+        row_type
+    """
+    columns = ', '.join(
+        f"{field}::text" if field in ('date_from', 'date_to') else field for field in row_type._fields
+    )
+    query = f"""
+    SELECT {columns} FROM public.{table}
+    WHERE date_from >= %s::date AND date_from < %s::date + INTERVAL '1 month'
+    """
+    conn = _connect()
+    try:
+        with conn.cursor(name='month_rows') as cursor:
+            cursor.itersize = 10000
+            cursor.execute(query, (f"{month}-01", f"{month}-01"))
+            for row in cursor:
+                yield row_type(*row)
+        conn.commit()
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        _release(conn)
 
 def execute_sql_query(query, params=None):
     """
@@ -379,7 +1286,7 @@ def execute_sql_query(query, params=None):
     conn = None
     try:
         # Подключаемся к БД
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = _connect()
         with conn.cursor() as cursor:
             # Выполняем запрос
             if isinstance(query, str):
@@ -393,18 +1300,177 @@ def execute_sql_query(query, params=None):
             
             # Фиксируем изменения для DML-запросов
             conn.commit()
-            logger.info(f"Успешно выполнено: {query}")
+            logger.debug("Успешно выполнено: %s", query)
             return None
             
     except Exception as e:
-        logger.error(f"Ошибка при выполнении запроса: {e}")
+        logger.error("Ошибка при выполнении запроса: %s", e)
         if conn:
             conn.rollback()
         raise
     finally:
         if conn:
-            conn.close()
+            _release(conn)
+
+def _export_horizon(conn, lag_seconds: int = EXPORT_LAG_SECONDS):
+    """
+    Граница водяного знака: строго раньше начала самой старой незавершённой транзакции в этой БД
+    и не позже NOW() - lag_seconds.
+
+    updated_at = NOW() - время начала транзакции, а не коммита, поэтому транзакция, открытая дольше
+    запаса, закоммитит строки со временем позади уже выгруженного. Граница берётся отдельной транзакцией
+    до снимка выгрузки: транзакция, которая шла в этот момент, начата позже границы, а та, что уже
+    закончилась, видна в снимке. Читающие транзакции тоже сдерживают границу: заранее не известно,
+    будут ли они писать. xact_start чужих ролей виден с правами pg_read_all_stats
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT LEAST(NOW() - %s * INTERVAL '1 second', MIN(xact_start) - INTERVAL '1 microsecond')
+            FROM pg_stat_activity
+            WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL
+            """,
+            (lag_seconds,)
+        )
+        horizon = cursor.fetchone()[0]
+    conn.commit()
+    return horizon
+
+def export_changes(table: str, output_dir: str, fmt: str = 'csv', consumer: str = 'default') -> Optional[Dict]:
+    """
+    Выгружает строки таблицы, изменённые с прошлой выгрузки этого потребителя,
+    через COPY (SELECT ...) TO STDOUT в сжатый файл
+    
+    Водяной знак (граница по updated_at, до которой строки выгружены) сдвигается в той же транзакции,
+    что и чтение, и только после того, как файл полностью записан. Если выгрузка упала,
+    водяной знак не меняется и следующий запуск повторит те же строки (at-least-once).
+    Водяной знак не обгоняет незавершённые транзакции (см. _export_horizon)
+    
+    Args:
+        table: Таблица из EXPORT_TABLES
+        output_dir: Каталог для файла выгрузки
+        fmt: 'csv' (с заголовком) или 'binary' (бинарный формат COPY PostgreSQL)
+        consumer: Имя потребителя; у каждого свой водяной знак
+    
+    Returns:
+        dict: {'table', 'path', 'rows', 'watermark_from', 'watermark_to'} или None в случае ошибки
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Таблица {table} не выгружается. Доступны: {', '.join(EXPORT_TABLES)}")
+    copy_options, extension = EXPORT_FORMATS[fmt]
+
+    conn = None
+    tmp_path = None
+    try:
+        conn = _connect()
+        horizon = _export_horizon(conn)
+        conn.set_session(isolation_level='REPEATABLE READ')
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO public.export_watermarks (consumer, table_name, watermark)
+                VALUES (%s, %s, '-infinity')
+                ON CONFLICT (consumer, table_name) DO NOTHING
+                """,
+                (consumer, table)
+            )
+            # Блокировка строки водяного знака: параллельная выгрузка того же потребителя ждёт.
+            # Пока старая транзакция не закончилась, водяной знак стоит на месте, но не отступает
+            cursor.execute(
+                "SELECT watermark, GREATEST(watermark, %s) FROM public.export_watermarks "
+                "WHERE consumer = %s AND table_name = %s FOR UPDATE",
+                (horizon, consumer, table)
+            )
+            watermark_from, watermark_to = cursor.fetchone()
+
+            select = cursor.mogrify(
+                f"SELECT * FROM public.{table} WHERE updated_at > %s AND updated_at <= %s ORDER BY updated_at",
+                (watermark_from, watermark_to)
+            ).decode()
+            path = os.path.join(output_dir, f"{table}_{watermark_to:%Y%m%dT%H%M%S}.{extension}")
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wb') as f:
+                cursor.copy_expert(f"COPY ({select}) TO STDOUT WITH ({copy_options})", f)
+            rows = cursor.rowcount
+
+            cursor.execute(
+                """
+                UPDATE public.export_watermarks
+                SET watermark = %s, rows_exported = %s, exported_at = NOW()
+                WHERE consumer = %s AND table_name = %s
+                """,
+                (watermark_to, rows, consumer, table)
+            )
+            os.replace(tmp_path, path)
+            tmp_path = None
+        conn.commit()
+        log_event(logger, 'changes_exported', logging.INFO, table=table, rows=rows, path=path)
+        return {
+            'table': table,
+            'path': path,
+            'rows': rows,
+            'watermark_from': watermark_from,
+            'watermark_to': watermark_to
+        }
+
+    except (psycopg2.Error, OSError) as e:
+        logger.error("Ошибка выгрузки изменений %s: %s", table, e)
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if conn:
+            # Подключение может вернуться в пул: закрываем транзакцию и возвращаем уровень изоляции
+            conn.rollback()
+            conn.set_session(isolation_level='READ COMMITTED')
+            _release(conn)
+
+def export_all_changes(output_dir: str, fmt: str = 'csv', consumer: str = 'default', tables: list = None) -> list:
+    """
+    Выгружает изменения всех таблиц (или перечисленных) в output_dir
+    
+    Returns:
+        list: Результаты export_changes по таблицам, которые удалось выгрузить
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = [export_changes(table, output_dir, fmt, consumer) for table in tables or EXPORT_TABLES]
+    return [result for result in results if result]
+
 
 if __name__ == '__main__':
-    print(execute_sql_query('SHOW max_connections'))
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Служебные команды БД')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help='Выгрузить строки, изменённые с прошлой выгрузки')
+    export_parser.add_argument('--dir', default='export', help='Каталог для файлов выгрузки')
+    export_parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv')
+    export_parser.add_argument('--consumer', default='default', help='Имя потребителя (свой водяной знак)')
+    export_parser.add_argument('--tables', nargs='+', choices=EXPORT_TABLES, help='По умолчанию все')
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Перевести прежние таблицы со строками на справочники (без --apply - пробный прогон)'
+    )
+    migrate_parser.add_argument('--apply', action='store_true',
+                                help='Выполнить перенос; прежние таблицы сохраняются как <table>_legacy')
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.command == 'export':
+        create_tables()
+        for result in export_all_changes(args.dir, args.format, args.consumer, args.tables):
+            print(f"{result['table']}: {result['rows']} строк -> {result['path']}")
+    elif args.command == 'migrate':
+        migrated = migrate_to_dimensions(args.apply)
+        for table, moved, views in migrated:
+            print(f"{table}: {moved} строк -> {DIMENSIONS[table][0]}, прежняя таблица -> {table}_legacy")
+            if views:
+                print(f"  представления на прежней таблице: {', '.join(views)}")
+        if not migrated:
+            print('Переносить нечего: схема уже на справочниках')
+        elif not args.apply:
+            print('Пробный прогон: изменения откачены. Для переноса запустите с --apply')
+    else:
+        print(execute_sql_query('SHOW max_connections'))
 
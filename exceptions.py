@@ -8,4 +8,13 @@ class MetrikaAuthError(MetrikaAPIError):
     """Ошибки авторизации"""
 
 class MetrikaCounterNotFound(MetrikaAPIError):
-    """Счётчик не найден или нет доступа"""
\ No newline at end of file
+    """Счётчик не найден или нет доступа"""
+
+class MetrikaCircuitOpenError(MetrikaAPIError):
+    """Эндпоинт деградировал, запрос не отправлялся (работа откладывается)"""
+
+class SinkWriteError(Exception):
+    """Пачка строк не записалась в хранилище (транзакция откатана)"""
+
+class SchemaMigrationRequired(Exception):
+    """В БД остались таблицы прежнего вида; перенос запускается явно (python db.py migrate)"""
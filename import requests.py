@@ -1,7 +1,11 @@
+import os
 import requests
 
+from dotenv import load_dotenv
 
-TOKEN = 'y0__xDzrKqtAxjYpiogwqjv8xOscTs_r_2wDTSEF-WEiXOf4ASGeA'
+
+load_dotenv()
+TOKEN = os.getenv('OAUTH_TOKEN')
 METRICA_API_URL = "https://api-metrika.yandex.net/stat/v1/data"
 
 
@@ -0,0 +1,195 @@
+import codecs
+import json
+import re
+import requests
+
+from exceptions import MetrikaAPIError
+from profiling import profiler
+
+# Сколько байт читать из сокета за раз и сколько строк декодировать между выдачами
+CHUNK_SIZE = 64 * 1024
+ROWS_PER_BATCH = 500
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Символы, которыми может закончиться число: после любого другого оно могло оборваться на границе куска
+_NUMBER_END = ',]} \t\n\r'
+
+
+class JsonStream:
+    """
+    Потоковое декодирование ответа API вида ``{..., "<array_key>": [строки], ...}``.
+
+    Строки массива декодируются по мере чтения из сокета и выдаются итератором,
+    поэтому в памяти одновременно находятся только кусок ответа и текущая пачка строк,
+    независимо от размера ответа. Остальные ключи верхнего уровня (query, totals,
+    total_rows и т.п.) складываются в ``meta``: стоящие до массива доступны сразу,
+    стоящие после - когда строки дочитаны. Обращение к ``totals``/``query`` до конца
+    итерации дочитывает ответ, пропуская оставшиеся строки.
+
+    Итерировать можно один раз. После разбора ответа соединение закрывается.
+
+    :param response: Ответ requests, полученный с stream=True
+    :param array_key: Ключ массива строк ('data' у Метрики, 'queries' у Вебмастера)
+    """
+
+    def __init__(self, response: requests.Response, array_key: str = 'data', chunk_size: int = CHUNK_SIZE):
+        self.response = response
+        self.array_key = array_key
+        self.meta = {}
+        self.rows_read = 0
+        self._chunks = response.iter_content(chunk_size)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._state = None  # None -> 'array' (внутри массива строк) -> 'done'
+        self._iterator = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._rows()
+        return self._iterator
+
+    def close(self):
+        self.response.close()
+
+    @property
+    def query(self) -> dict:
+        return self._meta_value('query')
+
+    @property
+    def totals(self) -> list:
+        return self._meta_value('totals')
+
+    def finish(self) -> dict:
+        """Дочитывает ответ (непрочитанные строки пропускаются) и возвращает метаданные"""
+        for _ in self:
+            pass
+        return self.meta
+
+    def _meta_value(self, key: str):
+        self._start()
+        if key not in self.meta and self._state != 'done':
+            self.finish()
+        return self.meta.get(key)
+
+    def _rows(self):
+        try:
+            self._start()
+            while self._state == 'array':
+                with profiler.stage('json_decode'):
+                    batch = self._batch()
+                self.rows_read += len(batch)
+                yield from batch
+        finally:
+            self.close()
+
+    def _batch(self) -> list:
+        """Декодирует до ROWS_PER_BATCH строк массива; на закрывающей скобке дочитывает хвост объекта"""
+        batch = []
+        if self._char() == ']':
+            self._pos += 1
+            self._after_array()
+            return batch
+        while len(batch) < ROWS_PER_BATCH:
+            batch.append(self._value())
+            if self._expect(',]') == ']':
+                self._after_array()
+                break
+        return batch
+
+    def _start(self):
+        """Разбирает начало объекта до массива строк (или до конца, если массива нет)"""
+        if self._state is not None:
+            return
+        self._state = 'members'
+        with profiler.stage('json_decode'):
+            self._expect('{')
+            if self._char() == '}':
+                self._pos += 1
+                self._state = 'done'
+            else:
+                self._members()
+
+    def _after_array(self):
+        if self._expect(',}') == ',':
+            self._members()
+        else:
+            self._state = 'done'
+
+    def _members(self):
+        """Читает пары ключ-значение верхнего уровня до массива строк или до конца объекта"""
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise MetrikaAPIError(f"Malformed API response: expected a key, got {key!r}")
+            self._expect(':')
+            if key == self.array_key and self._char() == '[':
+                self._pos += 1
+                self._state = 'array'
+                return
+            self.meta[key] = self._value()
+            if self._expect(',}') == '}':
+                self._state = 'done'
+                return
+
+    def _fill(self) -> bool:
+        """Дочитывает следующий кусок ответа. False - ответ уже прочитан целиком"""
+        if self._eof:
+            return False
+        try:
+            with profiler.stage('api_wait'):
+                chunk = next(self._chunks, None)
+        except requests.exceptions.RequestException as e:
+            raise MetrikaAPIError(f"Request failed: {str(e)}")
+        if chunk is None:
+            self._eof = True
+            text = self._utf8.decode(b'', final=True)
+        else:
+            text = self._utf8.decode(chunk)
+        # Разобранная часть буфера отбрасывается
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _char(self) -> str:
+        """Следующий значимый символ без сдвига позиции ('' - конец ответа)"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        char = self._char()
+        if not char or char not in chars:
+            raise MetrikaAPIError(f"Malformed API response: expected one of {chars!r}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Декодирует следующее значение целиком, дочитывая ответ, пока оно не станет полным"""
+        while True:
+            if not self._char():
+                raise MetrikaAPIError("Malformed API response: unexpected end of body")
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # raw_decode принимает начало числа ('2' из '2.5', '1' из '1e5'), поэтому число
+                # полное, только если за ним разделитель или ответ дочитан
+                if (not isinstance(value, (int, float)) or self._eof
+                        or (end < len(self._buffer) and self._buffer[end] in _NUMBER_END)):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    raise MetrikaAPIError(f"Malformed API response: {e}")
+            self._fill()
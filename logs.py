@@ -0,0 +1,149 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Общий уровень и уровни по подсистемам (имена модулей): LOG_LEVELS="db=WARNING,main=DEBUG"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FILE = os.getenv('LOG_FILE', 'bd.log')
+# Сколько однотипных событий (логгер + event) в секунду пропускать, остальные только считаются
+LOG_EVENT_RATE = float(os.getenv('LOG_EVENT_RATE', 20))
+
+_listener = None
+_rate_filter = None
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.DEBUG, **fields):
+    """
+    Структурированное событие: имя и поля key=value. Поля не форматируются,
+    если уровень выключен, поэтому построчные события на DEBUG почти бесплатны
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
+
+
+class EventFormatter(logging.Formatter):
+    """Дописывает к сообщению поля события в виде key=value"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return message
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Пропускает не больше ``rate`` событий в секунду с одинаковыми логгером и event.
+    Количество отброшенных дописывается полем suppressed к первому событию следующей секунды;
+    если такого события больше не было, его пишет flush() при остановке логирования.
+    Обычные записи (без event) проходят всегда.
+    """
+
+    def __init__(self, rate: float = LOG_EVENT_RATE):
+        super().__init__()
+        self.rate = rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        if event is None or not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault((record.name, event), [now, 0, 0, record.levelno])
+            if now - window[0] >= 1.0:
+                if window[2]:
+                    record.fields = dict(record.fields, suppressed=window[2])
+                window[:] = [now, 0, 0, record.levelno]
+            window[1] += 1
+            if window[1] > self.rate:
+                window[2] += 1
+                window[3] = max(window[3], record.levelno)
+                return False
+        return True
+
+    def flush(self):
+        """Пишет счётчики suppressed, которые не успели приписаться к следующему событию"""
+        with self._lock:
+            pending = [(name, event, window[2], window[3])
+                       for (name, event), window in self._windows.items() if window[2]]
+            self._windows.clear()
+        for name, event, suppressed, level in pending:
+            logging.getLogger(name).log(level, event, extra={'event': event, 'fields': {'suppressed': suppressed}})
+
+
+class _LocalQueueHandler(QueueHandler):
+    # Очередь внутри процесса: запись не нужно сериализовать, форматирование уходит в фоновый поток
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def parse_levels(levels: str) -> dict:
+    """'db=WARNING,main=DEBUG' -> {'db': 'WARNING', 'main': 'DEBUG'}"""
+    result = {}
+    for item in levels.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            result[name.strip()] = level.strip().upper()
+    return result
+
+
+def setup_logging(level: str = None, levels: str = None, log_file: str = LOG_FILE, console: bool = True):
+    """
+    Настраивает логирование процесса: записи всех модулей уходят в очередь,
+    а в файл с ротацией и в консоль их пишет фоновый поток. Повторный вызов ничего не делает.
+
+    Уровни подсистем сопоставляются с именами логгеров, поэтому модули берут логгер
+    по имени подсистемы ('main', 'db', 'daemon'), а не по __name__: у модуля, запущенного
+    как скрипт, __name__ == '__main__', и его уровень из LOG_LEVELS не применился бы.
+
+    :param level: Общий уровень (по умолчанию LOG_LEVEL)
+    :param levels: Уровни подсистем, 'db=WARNING,main=DEBUG' (по умолчанию LOG_LEVELS)
+    """
+    global _listener, _rate_filter
+    if _listener is not None:
+        return
+
+    formatter = EventFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    handlers = []
+    if log_file:
+        # Ротация логов (10 МБ, максимум 5 файлов)
+        file_handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LocalQueueHandler(log_queue)
+    _rate_filter = RateLimitFilter()
+    queue_handler.addFilter(_rate_filter)
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel((level or LOG_LEVEL).upper())
+    for name, subsystem_level in parse_levels(levels if levels is not None else LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает отложенные счётчики suppressed и очередь и останавливает фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _rate_filter.flush()
+        _listener.stop()
+        _listener = None
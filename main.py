@@ -1,24 +1,73 @@
-import db
+import argparse
+import budget
+import logging
 import os
 
+from collections import Counter
 from dotenv import load_dotenv
-from core import YandexMetrika, YandexWebmaster, get_yandex_webmaster_user_id
+from core import MetrikaQueryPlanner, YandexMetrika, YandexWebmaster, get_yandex_webmaster_user_id
+from datetime import date, timedelta
+from exceptions import MetrikaAPIError, MetrikaAuthError, MetrikaCircuitOpenError, SinkWriteError
+from logs import log_event, setup_logging
+from models import OrganicPageRow, ReferralUrlRow, SearchQueryRow, SectionRow, TrafficRow
+from profiling import profiler
+from resilience import TokenPool
+from sinks import Sink, get_sink
 from utils import (
     format_date,
+    generate_daily_periods,
     generate_monthly_periods,
     format_date,
     get_current_month_period
     )
 
 
+logger = logging.getLogger('main')
+
 load_dotenv()
 COUNTER_ID = os.getenv('COUNTER_ID')
 OAUTH_TOKEN = os.getenv('OAUTH_TOKEN')
+# Пул токенов через запятую: у каждого своя суточная квота, запросы распределяются между ними
+OAUTH_TOKENS = [token.strip() for token in os.getenv('OAUTH_TOKENS', OAUTH_TOKEN or '').split(',') if token.strip()]
 WEBMASTER_HOST = os.getenv('WEBMASTER_HOST')
-WEBMASTER_USER_ID = get_yandex_webmaster_user_id(OAUTH_TOKEN) # лол яндекс контора криворуких пидорасов апи их полое говно
 
+# Каталог разделов: окно подсчёта визитов, порог активности, максимум разделов и срок жизни каталога
+SECTION_WINDOW_DAYS = int(os.getenv('SECTION_WINDOW_DAYS', 90))
+SECTION_MIN_VISITS = int(os.getenv('SECTION_MIN_VISITS', 100))
+SECTION_LIMIT = int(os.getenv('SECTION_LIMIT', 500))
+SECTION_MAX_AGE_DAYS = int(os.getenv('SECTION_MAX_AGE_DAYS', 7))
+# Через сколько дней данные за день считаются окончательными и больше не перезапрашиваются
+DAILY_SETTLE_DAYS = int(os.getenv('DAILY_SETTLE_DAYS', 1))
+# Повтор невыполненных единиц работы: пауза после первой неудачи (удваивается с каждой попыткой),
+# её предел и число попыток, после которого единица повторяется только вручную (--retry-all)
+DEAD_LETTER_BACKOFF_SECONDS = float(os.getenv('DEAD_LETTER_BACKOFF_SECONDS', 300))
+DEAD_LETTER_MAX_BACKOFF_SECONDS = float(os.getenv('DEAD_LETTER_MAX_BACKOFF_SECONDS', 6 * 3600))
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv('DEAD_LETTER_MAX_ATTEMPTS', 8))
+
+
+def discover_sections(metrika: YandexMetrika, sink: Sink, window_days: int = SECTION_WINDOW_DAYS,
+                      min_visits: int = SECTION_MIN_VISITS, limit: int = SECTION_LIMIT) -> list:
+    '''
+    Обновляет каталог разделов по топу startURLPathLevel2 за последние window_days дней.
+    Активными считаются разделы, набравшие не меньше min_visits визитов.
 
-def get_metrika_data(token, counter_id, date_from: str, date_to: str):
+    :return: Список URL активных разделов
+    '''
+    window_to = date.today() - timedelta(days=1)
+    window_from = window_to - timedelta(days=window_days - 1)
+    window_from, window_to = window_from.strftime('%Y-%m-%d'), window_to.strftime('%Y-%m-%d')
+
+    top_sections = profiler.call(metrika.get_top_sections, window_from, window_to, limit)
+    rows = [
+        SectionRow(url, visits, window_from, window_to, min_visits, visits >= min_visits)
+        for url, visits in top_sections
+    ]
+    active = sink.replace_sections(rows)
+    logger.info('Каталог разделов обновлён: %s найдено, %s активных (%s - %s)', len(rows), active, window_from, window_to)
+    return [row.url for row in rows if row.active]
+
+
+def get_metrika_data(token, counter_id, date_from: str, date_to: str, sink: Sink = None, sections: list = None):
     '''
     Получить все данные от указанного периода до сегодняшнего дня
     
@@ -26,106 +75,358 @@ def get_metrika_data(token, counter_id, date_from: str, date_to: str):
     :param couner_id: ID счётчика
     :param date_from: Начальная дата (YYYY-MM-DD)
     :param date_to: Конечная дата (YYYY-MM-DD)
+    :param sink: Хранилище для записи. По умолчанию выбирается по STORAGE_BACKEND
+    :param sections: URL разделов. По умолчанию активные разделы из каталога;
+        если каталога нет или он старше SECTION_MAX_AGE_DAYS, он обновляется
     '''
     metrika = YandexMetrika(token, counter_id)
+    sink = sink or get_sink()
 
-    urls = ['https://zaruku.ru/rak-lyogkogo/',
-            'https://zaruku.ru/rak-molochnoj-zhelezy/',
-            'https://zaruku.ru/obshie-temy/',
-            'https://zaruku.ru/rak-mochevogo-puzyrya/',
-            'https://zaruku.ru/melanoma/',
-            'https://zaruku.ru/limfoma/',
-            'https://zaruku.ru/rak-pecheni/',
-            'https://zaruku.ru/pitanie/'
-            ]
+    urls = sections
+    if urls is None:
+        urls = sink.get_active_sections(SECTION_MAX_AGE_DAYS) or discover_sections(metrika, sink)
 
+    deferred = []
     for url in urls:
-        traffic_data = {
-            'url': None, 'date_from': None, 'date_to': None, 'organic': None, 
-            'direct': None, 'social': None, 'referral': None, 'ad': None, 
-            'internal': None, 'email': None, 'google_traffic': None, 
-            'yandex_traffic': None, 'bounce_rate': None, 'page_depth': None, 
-            'avg_visit': None, 'visits': None, 'month_year': None
-        }
-
-        for date_start, date_end in generate_monthly_periods(date_from, date_to):
-            
-            traffic_data['url'] = url 
-            traffic_data['date_from'] = date_start
-            traffic_data['date_to'] = date_end
-
-            traffic_data.update(metrika.get_all_traffic_by_url(date_start, date_end, url))
-            traffic_data.update(metrika.get_behavior_metrics(date_start, date_end, url))
-
-            search_engines = metrika.get_search_engines_traffic(date_start, date_end, url)
-            traffic_data['yandex_traffic'] = search_engines.get('yandex')
-            traffic_data['google_traffic'] = search_engines.get('google')
-
-            traffic_data['month_year'] = format_date(str(traffic_data['date_from']))
-            print(traffic_data)
-            db.upsert_traffic_data(traffic_data)
-            print(f'Записано в БД {url}, {date_start} - {date_end}')
-
-            for page_data in (metrika.get_organic_pages_from_url(date_start, date_end, url)):
-                organic_page_data = {
-                    'base_url': None,
-                    'page_url': None, 'date_from': None, 'date_to': None, 
-                    'page_url': None, 'bounce_rate': None, 
-                    'visits': None, 'traffic_share': None, 'month_year': None
-                }
-                
-                organic_page_data.update(page_data)
-                organic_page_data['base_url'] = url
-                organic_page_data['date_from'] = date_start
-                organic_page_data['date_to'] = date_end
-                organic_page_data['month_year'] = format_date(str(traffic_data['date_from']))
-
-                db.upsert_organic_pages_data(organic_page_data)
-                print(f'Записано в БД {organic_page_data.get('page_url')}, {date_start} - {date_end}')
+        with profiler.label(f'section:{url}'):
+            for date_start, date_end in generate_monthly_periods(date_from, date_to):
+                try:
+                    load_section_period(metrika, sink, url, date_start, date_end)
+                except MetrikaCircuitOpenError as e:
+                    deferred.append(('section', url, date_start, date_end))
+                    logger.warning('Отложено %s, %s - %s: %s', url, date_start, date_end, e)
 
     for date_start, date_end in generate_monthly_periods(date_from, date_to):
-        x = get_metrika_referral_urls(metrika, date_start, date_end)
+        try:
+            load_referral_period(metrika, sink, date_start, date_end)
+        except MetrikaCircuitOpenError as e:
+            deferred.append(('referral', None, date_start, date_end))
+            logger.warning('Отложены реферальные ссылки %s - %s: %s', date_start, date_end, e)
+
+    return deferred
+
+
+def load_section_period(metrika: YandexMetrika, sink: Sink, url: str, date_start: str, date_end: str):
+    '''
+    Выгружает трафик и органические страницы одного раздела за один период
+    '''
+    # Трафик по источникам, поисковики и поведение - одним-двумя вызовами API
+    planner = MetrikaQueryPlanner(metrika)
+    all_traffic = metrika.plan_all_traffic_by_url(planner, date_start, date_end, url)
+    behavior = metrika.plan_behavior_metrics(planner, date_start, date_end, url)
+    search_engines = metrika.plan_search_engines_traffic(planner, date_start, date_end, url)
+    profiler.call(planner.execute)
+
+    with profiler.stage('row_assembly'):
+        month_year = format_date(date_start)
+        engines = search_engines()
+        traffic_row = TrafficRow(
+            url=url, date_from=date_start, date_to=date_end,
+            **all_traffic(),
+            google_traffic=engines.get('google'),
+            yandex_traffic=engines.get('yandex'),
+            **behavior(),
+            month_year=month_year
+        )
+
+    sink.upsert_traffic_data([traffic_row])
+    with profiler.stage('logging'):
+        log_event(logger, 'row_written', table='all_traffic_by_url', url=url, visits=traffic_row.visits,
+                  date_from=date_start, date_to=date_end)
+
+    pages = profiler.call(metrika.get_organic_pages_from_url, date_start, date_end, url)
+    with profiler.stage('row_assembly'):
+        organic_pages = [
+            OrganicPageRow(url, page['page_url'], date_start, date_end,
+                           page['bounce_rate'], page['visits'], page['traffic_share'], month_year)
+            for page in pages
+        ]
+
+    sink.upsert_organic_pages_data(organic_pages)
+    with profiler.stage('logging'):
+        for page in organic_pages:
+            log_event(logger, 'row_written', table='organic_pages_by_url', url=page.page_url,
+                      date_from=date_start, date_to=date_end)
+        log_event(logger, 'section_loaded', logging.INFO, url=url, pages=len(organic_pages),
+                  date_from=date_start, date_to=date_end)
+    sink.mark_loaded('all_traffic_by_url', url, date_start, date_end, len(organic_pages))
+
+
+def load_referral_period(metrika: YandexMetrika, sink: Sink, date_start: str, date_end: str):
+    '''
+    Выгружает реферальные ссылки за один период
+    '''
+    x = get_metrika_referral_urls(metrika, date_start, date_end)
+    sink.upsert_referral_urls_data(x)
+    with profiler.stage('logging'):
         for url_data in x:
-            print(url_data)
-            db.upsert_referral_urls_data(url_data)
-        print(f'Записаны в БД реферальные ссылки {date_start} - {date_end}')
+            log_event(logger, 'row_written', table='referral_urls', url=url_data.referral_url,
+                      visits=url_data.visits, date_from=date_start, date_to=date_end)
+        log_event(logger, 'referrals_loaded', logging.INFO, rows=len(x), date_from=date_start, date_to=date_end)
+    sink.mark_loaded('referral_urls', None, date_start, date_end, len(x))
 
 
 def get_metrika_referral_urls(metrika: YandexMetrika, date_from: str, date_to: str) -> list:
     '''
-    Возвращает список словарей. Один словарь - один url реферер
+    Возвращает список ReferralUrlRow. Одна строка - один url реферер
     '''
-
-    res = []
-    for url, visits in metrika.get_referral_traffic(date_from, date_to).items():
-        url_data = {
-            'referral_url': url,
-            'visits': int(visits)
-        }
-        url_data['date_from'] = date_from
-        url_data['date_to'] = date_to
-        url_data['month_year'] = format_date(date_from)
-        res.append(url_data)
-    
-    return res
+    referral_traffic = profiler.call(metrika.get_referral_traffic, date_from, date_to)
+    with profiler.stage('row_assembly'):
+        month_year = format_date(date_from)
+        return [
+            ReferralUrlRow(url, int(visits), date_from, date_to, month_year)
+            for url, visits in referral_traffic.items()
+        ]
     
 
-def get_webmaster_data(token, host, user_id, date_start, date_end):
+def settled_days(sink: Sink, table: str, date_from: str, date_to: str, url: str = None) -> list:
+    '''
+    Дни периода, которые уже устоялись (старше DAILY_SETTLE_DAYS) и ещё не выгружены в дневную таблицу.
+    Выгруженным считается и день без строк: его отмечает load_log
+    '''
+    last_settled = (date.today() - timedelta(days=DAILY_SETTLE_DAYS)).strftime('%Y-%m-%d')
+    date_to = min(date_to, last_settled)
+    if date_from > date_to:
+        return []
+    loaded = sink.get_loaded_days(table, date_from, date_to, url)
+    return [day for day in generate_daily_periods(date_from, date_to) if (day, day) not in loaded]
+
+
+def get_metrika_daily_data(token, counter_id, date_from: str, date_to: str, sink: Sink = None, sections: list = None):
+    '''
+    Дневная выгрузка трафика разделов и реферальных ссылок. Каждый день запрашивается
+    один раз, когда устоится; месячные итоги считает БД (представления *_monthly)
+
+    :return: Список отложенных единиц работы, как у get_metrika_data
+    '''
+    metrika = YandexMetrika(token, counter_id)
+    sink = sink or get_sink()
+
+    urls = sections
+    if urls is None:
+        urls = sink.get_active_sections(SECTION_MAX_AGE_DAYS) or discover_sections(metrika, sink)
+
+    deferred = []
+    for url in urls:
+        with profiler.label(f'section:{url}'):
+            for day in settled_days(sink, 'all_traffic_by_url_daily', date_from, date_to, url):
+                try:
+                    load_section_day(metrika, sink, url, day)
+                except MetrikaCircuitOpenError as e:
+                    deferred.append(('section_daily', url, day, day))
+                    logger.warning('Отложено %s, %s: %s', url, day, e)
+
+    for day in settled_days(sink, 'referral_urls_daily', date_from, date_to):
+        try:
+            load_referral_day(metrika, sink, day)
+        except MetrikaCircuitOpenError as e:
+            deferred.append(('referral_daily', None, day, day))
+            logger.warning('Отложены реферальные ссылки %s: %s', day, e)
+
+    return deferred
+
+
+def load_section_day(metrika: YandexMetrika, sink: Sink, url: str, day: str):
+    '''
+    Выгружает трафик одного раздела за один день в all_traffic_by_url_daily
+    '''
+    planner = MetrikaQueryPlanner(metrika)
+    all_traffic = metrika.plan_all_traffic_by_url(planner, day, day, url)
+    behavior = metrika.plan_behavior_metrics(planner, day, day, url)
+    search_engines = metrika.plan_search_engines_traffic(planner, day, day, url)
+    profiler.call(planner.execute)
+
+    with profiler.stage('row_assembly'):
+        engines = search_engines()
+        traffic_row = TrafficRow(
+            url=url, date_from=day, date_to=day,
+            **all_traffic(),
+            google_traffic=engines.get('google'),
+            yandex_traffic=engines.get('yandex'),
+            **behavior(),
+            month_year=format_date(day)
+        )
+
+    sink.upsert_traffic_daily([traffic_row])
+    with profiler.stage('logging'):
+        log_event(logger, 'section_loaded', logging.INFO, url=url, visits=traffic_row.visits, day=day)
+    sink.mark_loaded('all_traffic_by_url_daily', url, day, day, 1)
+
+
+def load_referral_day(metrika: YandexMetrika, sink: Sink, day: str):
+    '''
+    Выгружает реферальные ссылки за один день в referral_urls_daily
+    '''
+    rows = get_metrika_referral_urls(metrika, day, day)
+    sink.upsert_referral_urls_daily(rows)
+    with profiler.stage('logging'):
+        log_event(logger, 'referrals_loaded', logging.INFO, rows=len(rows), day=day)
+    sink.mark_loaded('referral_urls_daily', None, day, day, len(rows))
+
+
+def get_webmaster_data(token, host, user_id, date_start, date_end, sink: Sink = None):
     webmaster = YandexWebmaster(token, host, user_id)
+    sink = sink or get_sink()
+    deferred = []
     for date_from, date_to in generate_monthly_periods(date_start, date_end):
-        for query in webmaster.get_top_search_requests(date_from, date_to).get('queries'):
-            indicators = query['indicators']
-            data = {
-                'query_text': query['query_text'],
-                'shows': indicators['TOTAL_SHOWS'],
-                'clicks': indicators['TOTAL_CLICKS'],
-                'avg_show_position': indicators['AVG_SHOW_POSITION'],
-                'date_from': date_from,
-                'date_to': date_to,
-                'month_year': format_date(str(date_from))
-                    }
-            db.upsert_search_queries_webmaster_data(data)
-            print(f'Записано в БД {data.get('query_text')}, {date_from} - {date_to}')
+        with profiler.label(f'period:{date_from}'):
+            try:
+                load_webmaster_period(webmaster, sink, date_from, date_to)
+            except MetrikaCircuitOpenError as e:
+                deferred.append(('webmaster', None, date_from, date_to))
+                logger.warning('Отложены запросы Вебмастера %s - %s: %s', date_from, date_to, e)
+    return deferred
+
+
+def load_webmaster_period(webmaster: YandexWebmaster, sink: Sink, date_from: str, date_to: str):
+    '''
+    Выгружает популярные поисковые запросы Вебмастера за один период
+    '''
+    queries = webmaster_queries(webmaster, date_from, date_to)
+
+    sink.upsert_search_queries_webmaster_data(queries)
+    with profiler.stage('logging'):
+        for query in queries:
+            log_event(logger, 'row_written', table='search_queries_webmaster', query=query.query_text,
+                      date_from=date_from, date_to=date_to)
+        log_event(logger, 'queries_loaded', logging.INFO, rows=len(queries), date_from=date_from, date_to=date_to)
+    sink.mark_loaded('search_queries_webmaster', None, date_from, date_to, len(queries))
+
+
+def webmaster_queries(webmaster: YandexWebmaster, date_from: str, date_to: str) -> list:
+    '''
+    Возвращает список SearchQueryRow популярных запросов за период
+    '''
+    # Топ запросов бывает большим, поэтому строки собираются по мере декодирования ответа
+    top_search_requests = profiler.call(webmaster.get_top_search_requests, date_from, date_to, stream=True)
+    with profiler.stage('row_assembly'):
+        month_year = format_date(date_from)
+        return [
+            SearchQueryRow(
+                query['query_text'],
+                query['indicators']['TOTAL_SHOWS'],
+                query['indicators']['TOTAL_CLICKS'],
+                query['indicators']['AVG_SHOW_POSITION'],
+                date_from, date_to, month_year
+            )
+            for query in top_search_requests
+        ]
+
+def get_webmaster_daily_data(token, host, user_id, date_start, date_end, sink: Sink = None):
+    '''
+    Дневная выгрузка популярных запросов Вебмастера в search_queries_webmaster_daily.
+    Месячное представление суммирует дневные топы, поэтому запросы, не попавшие
+    в топ отдельных дней, в нём недоучтены
+    '''
+    webmaster = YandexWebmaster(token, host, user_id)
+    sink = sink or get_sink()
+    deferred = []
+    for day in settled_days(sink, 'search_queries_webmaster_daily', date_start, date_end):
+        with profiler.label(f'period:{day}'):
+            try:
+                load_webmaster_day(webmaster, sink, day)
+            except MetrikaCircuitOpenError as e:
+                deferred.append(('webmaster_daily', None, day, day))
+                logger.warning('Отложены запросы Вебмастера %s: %s', day, e)
+    return deferred
+
+
+def load_webmaster_day(webmaster: YandexWebmaster, sink: Sink, day: str):
+    '''
+    Выгружает популярные поисковые запросы Вебмастера за один день
+    '''
+    queries = webmaster_queries(webmaster, day, day)
+    sink.upsert_search_queries_webmaster_daily(queries)
+    with profiler.stage('logging'):
+        log_event(logger, 'queries_loaded', logging.INFO, rows=len(queries), day=day)
+    sink.mark_loaded('search_queries_webmaster_daily', None, day, day, len(queries))
+
+
+def dead_letter_key(unit: budget.WorkUnit) -> str:
+    return f"{unit.kind}:{unit.url or ''}:{unit.date_from or ''}:{unit.date_to or ''}"
+
+
+def run_units(metrika: YandexMetrika, webmaster: YandexWebmaster, sink: Sink, units: list) -> list:
+    '''
+    Выполняет запланированные единицы работы (budget.WorkUnit) в порядке приоритета
+    и записывает израсходованные вызовы API в счётчик квоты за сегодня.
+
+    Ошибка API или записи в БД не прерывает прогон: единица попадает в dead_letters
+    с параметрами и текстом ошибки (см. retry_dead_letters), остальные выполняются.
+    Выполненная единица убирается из dead_letters, если была там.
+    Ошибка авторизации прерывает прогон: она не зависит от единицы работы и поднимается,
+    только когда доступа нет ни у одного токена пула (остальные 403 уводят токен в карантин)
+
+    :return: Список отложенных из-за деградировавших эндпоинтов единиц
+    '''
+    loaders = {
+        'discover': lambda unit: discover_sections(metrika, sink),
+        'section': lambda unit: load_section_period(metrika, sink, unit.url, unit.date_from, unit.date_to),
+        'referral': lambda unit: load_referral_period(metrika, sink, unit.date_from, unit.date_to),
+        'webmaster': lambda unit: load_webmaster_period(webmaster, sink, unit.date_from, unit.date_to),
+        'section_daily': lambda unit: load_section_day(metrika, sink, unit.url, unit.date_from),
+        'referral_daily': lambda unit: load_referral_day(metrika, sink, unit.date_from),
+        'webmaster_daily': lambda unit: load_webmaster_day(webmaster, sink, unit.date_from)
+    }
+    dead = {letter.unit_key for letter in sink.get_dead_letters(due_only=False)}
+    deferred = []
+    failed = 0
+    try:
+        for unit in units:
+            key = dead_letter_key(unit)
+            with profiler.label(f'{unit.kind}:{unit.url or unit.date_from}'):
+                try:
+                    loaders[unit.kind](unit)
+                except MetrikaCircuitOpenError as e:
+                    deferred.append(unit)
+                    logger.warning('Отложено %s %s %s - %s: %s', unit.kind, unit.url or '', unit.date_from,
+                                   unit.date_to, e)
+                    continue
+                except MetrikaAuthError:
+                    raise
+                except (MetrikaAPIError, SinkWriteError) as e:
+                    failed += 1
+                    stage = 'write' if isinstance(e, SinkWriteError) else 'fetch'
+                    attempts = sink.add_dead_letter(key, unit.kind, unit._asdict(), stage, str(e),
+                                                    DEAD_LETTER_BACKOFF_SECONDS, DEAD_LETTER_MAX_BACKOFF_SECONDS)
+                    logger.error('Не выполнено %s %s %s - %s (%s, попытка %s): %s', unit.kind, unit.url or '',
+                                 unit.date_from, unit.date_to, stage, attempts, e)
+                    continue
+                if key in dead:
+                    sink.remove_dead_letter(key)
+                    logger.info('Выполнено из dead_letters: %s', key)
+    finally:
+        record_api_usage(sink, metrika=metrika, webmaster=webmaster)
+    if failed:
+        logger.warning('Не выполнено единиц работы: %s из %s, повтор: --retry', failed, len(units))
+    for service, client in (('metrika', metrika), ('webmaster', webmaster)):
+        quarantined = [token for token, _, blocked in client.tokens.stats() if blocked]
+        if quarantined:
+            logger.warning('Токены %s в карантине: %s', service, ', '.join(quarantined))
+    return deferred
+
+
+def dead_letter_units(sink: Sink, retry_all: bool = False) -> list:
+    '''
+    Единицы работы из dead_letters для повтора. По умолчанию только те, чья пауза
+    до повтора истекла и попытки не исчерпаны (DEAD_LETTER_MAX_ATTEMPTS); с retry_all - все
+    '''
+    if retry_all:
+        letters = sink.get_dead_letters(due_only=False)
+    else:
+        letters = sink.get_dead_letters(due_only=True, max_attempts=DEAD_LETTER_MAX_ATTEMPTS)
+    return [budget.WorkUnit(**letter.params) for letter in letters]
+
+
+def record_api_usage(sink: Sink, **clients):
+    '''
+    Переносит счётчики вызовов клиентов (service=клиент) в расход квоты за сегодня и обнуляет их
+    '''
+    today = date.today().strftime('%Y-%m-%d')
+    for service, client in clients.items():
+        sink.add_api_usage(today, service, client.calls)
+        client.calls.clear()
+
 
 def check_services(token, counter_id, webmaster_host, yandex_user_id):
     metrika = YandexMetrika(token, counter_id)
@@ -136,23 +437,76 @@ def check_services(token, counter_id, webmaster_host, yandex_user_id):
         return False
 
 
-if __name__ == '__main__':
-    dates = (get_current_month_period())
-    date_from = dates[0]
-    date_to = dates[1]
-    get_metrika_data(OAUTH_TOKEN, COUNTER_ID, date_from, date_to)
-    get_webmaster_data(OAUTH_TOKEN, WEBMASTER_HOST, WEBMASTER_USER_ID, date_from, date_to)
-    print('Успешный успех')
-
-    
-
-    
-    
-
+def parse_args():
+    parser = argparse.ArgumentParser(description='Выгрузка данных Метрики и Вебмастера в БД')
+    parser.add_argument('--storage', choices=['postgres', 'sqlite', 'null'],
+                        help='Хранилище для записи (по умолчанию STORAGE_BACKEND или postgres)')
+    parser.add_argument('--discover', action='store_true',
+                        help='Обновить каталог разделов перед выгрузкой, даже если он свежий')
+    parser.add_argument('--grain', choices=['monthly', 'daily'], default='monthly',
+                        help='Гранулярность хранения: месяц целиком или устоявшиеся дни (итоги по месяцам в БД)')
+    parser.add_argument('--date-from', help='Начало выгрузки (YYYY-MM-DD), по умолчанию начало текущего месяца')
+    parser.add_argument('--date-to', help='Конец выгрузки (YYYY-MM-DD), по умолчанию сегодня')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Только посчитать вызовы API и раскладку по квоте, ничего не запрашивая')
+    parser.add_argument('--retry', action='store_true',
+                        help='Повторить только невыполненные единицы работы из dead_letters, чья пауза истекла')
+    parser.add_argument('--retry-all', action='store_true',
+                        help='Как --retry, но без учёта паузы и числа попыток')
+    parser.add_argument('--profile', action='store_true',
+                        help='Вывести разбивку времени по стадиям, методам и разделам')
+    parser.add_argument('--profile-dump', metavar='PATH',
+                        help='Сохранить дамп cProfile (и PATH.folded для flamegraph). Включает --profile')
+    return parser.parse_args()
 
 
+if __name__ == '__main__':
+    args = parse_args()
+    setup_logging()
+    if args.profile or args.profile_dump:
+        profiler.start(args.profile_dump)
 
-    
-    
+    dates = (get_current_month_period())
+    date_from = args.date_from or dates[0]
+    date_to = args.date_to or dates[1]
+    budgets = budget.default_budgets(len(OAUTH_TOKENS))
+    metrika = YandexMetrika(TokenPool(OAUTH_TOKENS, budget.METRIKA_CALLS_PER_DAY), COUNTER_ID,
+                            rate_limit=budgets['metrika'].per_second)
+    sink = get_sink(args.storage)
+    try:
+        # Новые таблицы (каталог разделов, журнал загрузок, расход квоты, dead_letters, сводки топа)
+        # появляются при первом запуске на существующей БД
+        sink.create_tables()
+        if args.retry or args.retry_all:
+            # Только то, что не выполнилось в прошлых прогонах; каталог и период не нужны
+            units, cache_hits = dead_letter_units(sink, args.retry_all), Counter()
+            logger.info('Единиц работы к повтору: %s', len(units))
+        else:
+            sections = [] if args.discover else sink.get_active_sections(SECTION_MAX_AGE_DAYS)
+            stale = not sections
+            if stale and args.dry_run:
+                # Каталог обновится при реальном запуске, а пока оцениваем по последнему известному
+                sections = sink.get_active_sections()
+                if not sections:
+                    logger.warning('Каталог разделов пуст: вызовы по разделам станут известны после его обновления')
+            elif stale:
+                sections = discover_sections(metrika, sink)
+                record_api_usage(sink, metrika=metrika)
 
+            units, cache_hits = budget.enumerate_units(metrika, sink, sections, date_from, date_to, args.grain,
+                                                       DAILY_SETTLE_DAYS, discover=stale and args.dry_run)
+        used = sink.get_api_usage(date.today().strftime('%Y-%m-%d'))
+        schedule = budget.schedule_units(units, budgets, used)
+        print(budget.format_plan(units, cache_hits, schedule, budgets, used))
 
+        if not args.dry_run:
+            # user_id каждого токена пула клиент запросит сам при первом обращении к Вебмастеру
+            webmaster = YandexWebmaster(TokenPool(OAUTH_TOKENS, budget.WEBMASTER_CALLS_PER_DAY), WEBMASTER_HOST,
+                                        rate_limit=budgets['webmaster'].per_second)
+            run_units(metrika, webmaster, sink, schedule.scheduled)
+    finally:
+        sink.close()
+        if profiler.enabled:
+            profiler.stop()
+            print(profiler.report())
+    print('Успешный успех')
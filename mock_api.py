@@ -0,0 +1,288 @@
+import json
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SECTIONS = [
+    'https://zaruku.ru/rak-lyogkogo/',
+    'https://zaruku.ru/rak-molochnoj-zhelezy/',
+    'https://zaruku.ru/obshie-temy/',
+    'https://zaruku.ru/rak-mochevogo-puzyrya/',
+    'https://zaruku.ru/melanoma/',
+    'https://zaruku.ru/limfoma/',
+    'https://zaruku.ru/rak-pecheni/',
+    'https://zaruku.ru/pitanie/'
+]
+TRAFFIC_SOURCES = ['organic', 'direct', 'social', 'referral', 'ad', 'internal', 'email']
+SEARCH_ENGINES = ['Yandex', 'Google', 'Bing', 'DuckDuckGo', 'Mail.ru', 'Rambler']
+
+
+class MockYandexHandler(BaseHTTPRequestHandler):
+    """Обработчик, имитирующий ответы API Метрики и Вебмастера"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        route = self._route(parsed.path)
+        server.count(route)
+
+        if server.latency:
+            time.sleep(max(0.0, server.rng_uniform(server.latency - server.jitter, server.latency + server.jitter)))
+        if server.tail_rate and server.rng_uniform(0, 1) < server.tail_rate:
+            time.sleep(server.tail_latency)
+
+        if route is None:
+            return self._send(404, {'errors': [{'message': 'Not found'}]})
+        token = self.headers.get('Authorization', '').replace('OAuth ', '', 1)
+        used = server.count_token(token)
+        if token in server.denied_tokens:
+            return self._send(403, {'errors': [{'message': 'Access denied'}]})
+        if server.token_quota and used > server.token_quota:
+            return self._send(429, {'errors': [{'error_type': 'quota_requests_by_uid', 'message': 'Quota exceeded'}]})
+        if server.error_rate and server.rng_uniform(0, 1) < server.error_rate:
+            return self._send(server.error_status, {'errors': [{'message': 'Injected error'}]})
+
+        self._send(200, getattr(self, f'_{route}')(params))
+
+    def _route(self, path: str):
+        if path == '/stat/v1/data':
+            return 'stat_data'
+        if path == '/stat/v1/data/comparison':
+            return 'comparison'
+        if path == '/management/v1/counters':
+            return 'counters'
+        if path == '/v4/user':
+            return 'user'
+        if path.startswith('/v4/user/') and path.endswith('/summary'):
+            return 'summary'
+        if path.startswith('/v4/user/') and path.endswith('/search-queries/popular'):
+            return 'popular_queries'
+        return None
+
+    def _send(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rng(self, params: dict) -> random.Random:
+        # Один и тот же запрос даёт один и тот же ответ
+        return random.Random(f'{self.server.seed}:{sorted(params.items())}')
+
+    def _counters(self, params: dict) -> dict:
+        return {'counters': [{'id': 12345678, 'name': 'mock', 'site': 'zaruku.ru'}]}
+
+    def _user(self, params: dict) -> dict:
+        return {'user_id': 1234567}
+
+    def _summary(self, params: dict) -> dict:
+        return {'sqi': 120, 'excluded_pages_count': 10, 'searchable_pages_count': 2000, 'site_problems': {}}
+
+    def _popular_queries(self, params: dict) -> dict:
+        rng = self._rng(params)
+        queries = []
+        for i in range(self.server.rows):
+            shows = rng.randint(10, 50000)
+            queries.append({
+                'query_id': f'q{i}',
+                'query_text': f'запрос {i}',
+                'indicators': {
+                    'TOTAL_SHOWS': shows,
+                    'TOTAL_CLICKS': rng.randint(0, shows),
+                    'AVG_SHOW_POSITION': round(rng.uniform(1, 50), 2),
+                    'AVG_CLICK_POSITION': round(rng.uniform(1, 20), 2)
+                }
+            })
+        return {
+            'queries': queries,
+            'date_from': params.get('date_from', [''])[0],
+            'date_to': params.get('date_to', [''])[0],
+            'count': len(queries)
+        }
+
+    def _metric_value(self, rng: random.Random, metric: str):
+        if metric.endswith(('bounceRate', 'pageDepth')):
+            return round(rng.uniform(1, 60), 6)
+        if metric.endswith('avgVisitDurationSeconds'):
+            return round(rng.uniform(10, 600), 6)
+        return float(rng.randint(0, 5000))
+
+    def _dimension_value(self, dimension: str, i: int) -> dict:
+        if dimension.endswith('trafficSource'):
+            source = TRAFFIC_SOURCES[i % len(TRAFFIC_SOURCES)]
+            return {'id': source, 'name': source.capitalize()}
+        if dimension.endswith('searchEngine'):
+            engine = SEARCH_ENGINES[i % len(SEARCH_ENGINES)]
+            return {'id': engine.lower(), 'name': engine}
+        if dimension.endswith('startURLPathLevel2'):
+            return {'name': SECTIONS[i] if i < len(SECTIONS) else f'https://zaruku.ru/section-{i}/'}
+        if dimension.endswith('externalReferer'):
+            return {'name': f'https://ref{i}.example.com/'}
+        return {'name': f'https://zaruku.ru/section/page-{i}/'}
+
+    def _dimension_size(self, dimension: str) -> int:
+        if dimension.endswith('trafficSource'):
+            return len(TRAFFIC_SOURCES)
+        if dimension.endswith('searchEngine'):
+            return len(SEARCH_ENGINES)
+        if dimension.endswith('startURLPathLevel2'):
+            return self.server.sections
+        return self.server.rows
+
+    def _stat_data(self, params: dict) -> dict:
+        rng = self._rng(params)
+        metrics = params.get('metrics', ['ym:s:visits'])[0].split(',')
+        dimensions = [d for d in params.get('dimensions', [''])[0].split(',') if d]
+        limit = int(params.get('limit', ['100'])[0])
+
+        combos = [[]]
+        for dimension in dimensions:
+            combos = [combo + [i] for combo in combos for i in range(self._dimension_size(dimension))]
+        combos = combos[:limit]
+
+        data = []
+        for combo in combos:
+            data.append({
+                'dimensions': [self._dimension_value(d, i) for d, i in zip(dimensions, combo)],
+                'metrics': [self._metric_value(rng, m) for m in metrics]
+            })
+
+        return {
+            'query': {
+                'ids': [int(params.get('ids', ['0'])[0] or 0)],
+                'dimensions': dimensions,
+                'metrics': metrics,
+                'date1': params.get('date1', [''])[0],
+                'date2': params.get('date2', [''])[0],
+                'filters': params.get('filters', [''])[0],
+                'limit': limit
+            },
+            'data': data,
+            'total_rows': len(data),
+            'sampled': False,
+            'totals': [sum(row['metrics'][i] for row in data) for i in range(len(metrics))]
+        }
+
+
+    def _comparison(self, params: dict) -> dict:
+        # Сегмент a - подмножество сегмента b, как organic внутри всего трафика
+        response = self._stat_data(params)
+        metrics = response['query']['metrics']
+        rng = self._rng(params)
+        for row in response['data']:
+            share = rng.uniform(0.2, 0.8)
+            row['metrics'] = {
+                'a': [float(round(v * share)) if m.endswith('visits') else v for v, m in zip(row['metrics'], metrics)],
+                'b': row['metrics']
+            }
+        response['totals'] = {
+            key: [sum(row['metrics'][key][i] for row in response['data']) for i in range(len(metrics))]
+            for key in ('a', 'b')
+        }
+        return response
+
+
+class MockYandexServer(ThreadingHTTPServer):
+    """
+    Локальный HTTP-сервер вместо API Метрики (/stat/v1/data, /comparison, /management/v1/counters)
+    и Вебмастера (/v4/user, /summary, /search-queries/popular).
+
+    :param latency: Средняя задержка ответа (секунды)
+    :param jitter: Разброс задержки (секунды)
+    :param tail_rate: Доля «зависающих» ответов (0..1)
+    :param tail_latency: Дополнительная задержка зависающих ответов (секунды)
+    :param error_rate: Доля ответов с ошибкой (0..1)
+    :param error_status: HTTP-статус для ошибочных ответов
+    :param rows: Количество строк в ответах с группировками и в топе запросов Вебмастера
+    :param sections: Количество разделов сайта (группировка startURLPathLevel2)
+    :param denied_tokens: OAuth-токены, на которые сервер отвечает 403
+    :param token_quota: Сколько запросов принимать от одного токена, дальше - 429 с ошибкой квоты (0 - без квоты)
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 tail_rate: float = 0.0, tail_latency: float = 0.0, error_rate: float = 0.0, error_status: int = 500, rows: int = 100, sections: int = 8,
+                 seed: int = 0, denied_tokens: tuple = (), token_quota: int = 0):
+        super().__init__((host, port), MockYandexHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rows = rows
+        self.sections = sections
+        self.seed = seed
+        self.denied_tokens = set(denied_tokens)
+        self.token_quota = token_quota
+        self.requests = Counter()
+        self.tokens = Counter()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, route: str):
+        with self._lock:
+            self.requests[route or 'unknown'] += 1
+
+    def count_token(self, token: str) -> int:
+        with self._lock:
+            self.tokens[token] += 1
+            return self.tokens[token]
+
+    def rng_uniform(self, a: float, b: float) -> float:
+        with self._lock:
+            return self._rng.uniform(a, b)
+
+    def start(self) -> 'MockYandexServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Локальный мок API Яндекс.Метрики и Вебмастера')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--tail-rate', type=float, default=0.0)
+    parser.add_argument('--tail-latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--sections', type=int, default=8)
+    parser.add_argument('--denied-tokens', nargs='*', default=(), help='Токены, получающие 403')
+    parser.add_argument('--token-quota', type=int, default=0, help='Запросов на токен до 429 с ошибкой квоты')
+    args = parser.parse_args()
+
+    server = MockYandexServer(port=args.port, latency=args.latency, tail_rate=args.tail_rate,
+                              tail_latency=args.tail_latency, error_rate=args.error_rate, rows=args.rows,
+                              sections=args.sections, denied_tokens=args.denied_tokens, token_quota=args.token_quota)
+    print(f'METRIKA_API_URL={server.url} WEBMASTER_API_URL={server.url}/v4')
+    server.serve_forever()
@@ -0,0 +1,90 @@
+from typing import NamedTuple
+
+# Строки таблиц БД. Порядок полей совпадает с порядком колонок в INSERT,
+# поэтому строку можно передавать драйверу как есть, без промежуточных словарей
+
+
+class TrafficRow(NamedTuple):
+    """Строка all_traffic_by_url"""
+    url: str
+    date_from: str
+    date_to: str
+    organic: int
+    direct: int
+    social: int
+    referral: int
+    ad: int
+    internal: int
+    email: int
+    google_traffic: int
+    yandex_traffic: int
+    bounce_rate: float
+    page_depth: float
+    avg_visit: float
+    visits: int
+    month_year: str
+
+
+class OrganicPageRow(NamedTuple):
+    """Строка organic_pages_by_url"""
+    base_url: str
+    page_url: str
+    date_from: str
+    date_to: str
+    bounce_rate: float
+    visits: int
+    traffic_share: float
+    month_year: str
+
+
+class ReferralUrlRow(NamedTuple):
+    """Строка referral_urls"""
+    referral_url: str
+    visits: int
+    date_from: str
+    date_to: str
+    month_year: str
+
+
+class SearchQueryRow(NamedTuple):
+    """Строка search_queries_webmaster"""
+    query_text: str
+    shows: int
+    clicks: int
+    avg_show_position: float
+    date_from: str
+    date_to: str
+    month_year: str
+
+
+class SectionRow(NamedTuple):
+    """Строка каталога разделов sections"""
+    url: str
+    visits: int
+    window_from: str
+    window_to: str
+    min_visits: int
+    active: bool
+
+
+class DeadLetter(NamedTuple):
+    """Строка dead_letters: единица работы, которая не выполнилась, с параметрами для повтора"""
+    unit_key: str
+    kind: str
+    params: dict
+    stage: str
+    error: str
+    attempts: int
+    next_retry_at: str
+
+
+class TopNSummaryRow(NamedTuple):
+    """Строка topn_summaries: сводка тяжёлых элементов одной таблицы за период (см. topn)"""
+    table_name: str
+    metric: str
+    scope: str
+    date_from: str
+    date_to: str
+    floor: float
+    total: float
+    items: list
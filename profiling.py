@@ -0,0 +1,182 @@
+import cProfile
+import time
+
+from collections import defaultdict
+from typing import Optional
+
+# Порядок стадий в отчёте. Остальные стадии выводятся после них
+STAGES = ['api_wait', 'json_decode', 'row_assembly', 'db_connect', 'db_execute', 'commit', 'logging']
+
+
+class _NullContext:
+    """Пустой контекст, чтобы выключенный профайлер ничего не стоил"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Stage:
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter_stage(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit_stage()
+        return False
+
+
+class _Label:
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._labels.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._labels.pop()
+        return False
+
+
+class Profiler:
+    """
+    Разбивка времени прогона по стадиям (ожидание API, декодирование JSON,
+    сборка строк, запись в БД, коммит, логирование).
+
+    Время стадии считается эксклюзивно: вложенная стадия вычитается из внешней.
+    Каждое измерение привязывается к текущему стеку меток (раздел, метод клиента),
+    поэтому в отчёте видно, какой метод YandexMetrika и какой раздел сколько стоили.
+    Стек стадий и меток один на процесс, поэтому стадии открываются только в основном потоке
+    (не в потоках хеджирования запросов).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._labels = []
+        self._stack = []  # [имя стадии, время входа, время вложенных стадий]
+        self._stats = defaultdict(lambda: [0, 0.0])  # (метки, стадия) -> [вызовы, секунды]
+        self._started_at = None
+        self._wall = 0.0
+        self._cprofile = None
+        self._dump_path = None
+
+    def start(self, dump_path: Optional[str] = None):
+        """
+        Включает профилирование
+
+        :param dump_path: Путь для дампа cProfile (pstats). Рядом пишется
+            файл ``<dump_path>.folded`` в формате collapsed stacks для flamegraph.pl
+        """
+        self.enabled = True
+        self._stats.clear()
+        self._dump_path = dump_path
+        if dump_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._started_at = time.perf_counter()
+
+    def stop(self):
+        """Выключает профилирование и сохраняет дампы, если они были запрошены"""
+        if not self.enabled:
+            return
+        self._wall = time.perf_counter() - self._started_at
+        self.enabled = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self._dump_path)
+            self.write_folded(f'{self._dump_path}.folded')
+            self._cprofile = None
+
+    def stage(self, name: str):
+        """Контекст измерения стадии"""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def label(self, name: str):
+        """Контекст метки (раздел, период и т.п.) для атрибуции времени"""
+        if not self.enabled:
+            return _NULL
+        return _Label(self, name)
+
+    def call(self, func, *args, **kwargs):
+        """Вызывает метод клиента под меткой с его именем (например YandexMetrika.get_behavior_metrics)"""
+        if not self.enabled:
+            return func(*args, **kwargs)
+        with _Label(self, func.__qualname__):
+            return func(*args, **kwargs)
+
+    def _enter_stage(self, name: str):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def _exit_stage(self):
+        name, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        if self._stack:
+            self._stack[-1][2] += elapsed
+        entry = self._stats[(tuple(self._labels), name)]
+        entry[0] += 1
+        entry[1] += elapsed - nested
+
+    def stage_totals(self) -> dict:
+        """Суммарное время по стадиям: {стадия: (вызовы, секунды)}"""
+        totals = defaultdict(lambda: [0, 0.0])
+        for (_, stage), (calls, seconds) in self._stats.items():
+            totals[stage][0] += calls
+            totals[stage][1] += seconds
+        return {stage: tuple(value) for stage, value in totals.items()}
+
+    def label_totals(self) -> dict:
+        """Время по меткам: {метка: {стадия: секунды}}. Метка учитывается, пока она в стеке"""
+        totals = defaultdict(lambda: defaultdict(float))
+        for (labels, stage), (_, seconds) in self._stats.items():
+            for label in set(labels):
+                totals[label][stage] += seconds
+        return totals
+
+    def _ordered_stages(self, stages) -> list:
+        return [s for s in STAGES if s in stages] + sorted(s for s in stages if s not in STAGES)
+
+    def report(self) -> str:
+        """Текстовый отчёт: стадии, методы клиентов и разделы"""
+        stage_totals = self.stage_totals()
+        stages = self._ordered_stages(stage_totals)
+        tracked = sum(seconds for _, seconds in stage_totals.values())
+
+        lines = [f'Общее время: {self._wall:.3f} с (не размечено: {max(self._wall - tracked, 0):.3f} с)', '']
+        lines.append(f"{'стадия':<16}{'вызовы':>10}{'секунды':>12}{'доля':>8}")
+        for stage in stages:
+            calls, seconds = stage_totals[stage]
+            share = seconds / self._wall * 100 if self._wall else 0
+            lines.append(f'{stage:<16}{calls:>10}{seconds:>12.3f}{share:>7.1f}%')
+
+        label_totals = self.label_totals()
+        if label_totals:
+            header = f"{'метка':<60}" + ''.join(f'{s:>13}' for s in stages) + f"{'всего':>11}"
+            lines += ['', header]
+            ordered = sorted(label_totals.items(), key=lambda item: -sum(item[1].values()))
+            for label, by_stage in ordered:
+                row = f'{label[:59]:<60}' + ''.join(f'{by_stage.get(s, 0.0):>13.3f}' for s in stages)
+                lines.append(row + f'{sum(by_stage.values()):>11.3f}')
+
+        return '\n'.join(lines)
+
+    def write_folded(self, path: str):
+        """Пишет стек меток и стадий в формате collapsed stacks (значения в микросекундах)"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for (labels, stage), (_, seconds) in sorted(self._stats.items()):
+                frames = ';'.join(label.replace(';', ',').replace(' ', '_') for label in labels + (stage,))
+                f.write(f'{frames} {int(seconds * 1_000_000)}\n')
+
+
+profiler = Profiler()
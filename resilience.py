@@ -0,0 +1,266 @@
+import os
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from exceptions import MetrikaAPIError, MetrikaAuthError, MetrikaCircuitOpenError
+
+HEDGE_PERCENTILE = float(os.getenv('API_HEDGE_PERCENTILE', 95))
+HEDGE_BUDGET = float(os.getenv('API_HEDGE_BUDGET', 0.05))
+HEDGE_MIN_SAMPLES = int(os.getenv('API_HEDGE_MIN_SAMPLES', 20))
+BREAKER_FAILURES = int(os.getenv('API_BREAKER_FAILURES', 5))
+BREAKER_RESET_SECONDS = float(os.getenv('API_BREAKER_RESET_SECONDS', 60))
+# Карантин токена пула после 403 (нет доступа). Токен с исчерпанной суточной квотой ждёт следующих суток
+TOKEN_AUTH_COOLDOWN_SECONDS = float(os.getenv('API_TOKEN_AUTH_COOLDOWN_SECONDS', 3600))
+# Пауза всех запросов после 429 без Retry-After и сколько раз повторять запрос после такой паузы
+RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv('API_RATE_LIMIT_BACKOFF_SECONDS', 1))
+RATE_LIMIT_RETRIES = int(os.getenv('API_RATE_LIMIT_RETRIES', 3))
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов по эндпоинтам"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, endpoint: str, percentile: float, min_samples: int = HEDGE_MIN_SAMPLES):
+        """Перцентиль длительности или None, если замеров пока мало"""
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного эндпоинта.
+
+    После ``failure_threshold`` ошибок подряд размыкается и ``reset_seconds`` секунд
+    сразу отвечает MetrikaCircuitOpenError, не нагружая деградировавший эндпоинт.
+    Затем пропускает один пробный запрос: успех замыкает цепь, ошибка размыкает снова.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint: str, failure_threshold: int = BREAKER_FAILURES,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_seconds:
+                    retry_in = self.reset_seconds - (time.monotonic() - self.opened_at)
+                    raise MetrikaCircuitOpenError(
+                        f"Endpoint {self.endpoint} is degraded, retry in {retry_in:.0f}s"
+                    )
+                self.state = self.HALF_OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def _close_response(future):
+    """Закрывает ответ проигравшего хеджированного запроса"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class HedgingPolicy:
+    """
+    Хеджирование запросов: если ответ не пришёл за перцентиль длительности
+    последних запросов к эндпоинту, отправляется дубликат и берётся первый ответ.
+    Доля продублированных запросов ограничена ``budget``.
+    """
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, budget: float = HEDGE_BUDGET,
+                 min_delay: float = 0.05, max_workers: int = 4):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.requests = 0
+        self.hedged = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+
+    def delay(self, latency: LatencyTracker, endpoint: str):
+        """Через сколько секунд дублировать запрос (None - не дублировать)"""
+        with self._lock:
+            self.requests += 1
+            if self.hedged >= self.budget * self.requests:
+                return None
+        threshold = latency.percentile(endpoint, self.percentile)
+        if threshold is None:
+            return None
+        return max(threshold, self.min_delay)
+
+    def run(self, send, delay: float):
+        """
+        Выполняет send(); если он не уложился в delay, запускает дубликат и возвращает первый успешный ответ.
+        Проигравший запрос отменяется, а если уже отправлен - его ответ закрывается по готовности,
+        чтобы не держать подключение пула (ответы с stream=True читаются лениво)
+        """
+        primary = self._executor.submit(send)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedged += 1
+        futures = [primary, self._executor.submit(send)]
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in futures:
+                        if loser is not future:
+                            loser.cancel()
+                            loser.add_done_callback(_close_response)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class RateLimiter:
+    """
+    Разносит запросы так, чтобы их было не больше ``per_second`` в секунду
+    (None - без ограничения). pause() задерживает все следующие запросы,
+    например после 429 от API
+    """
+
+    def __init__(self, per_second: float = None):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class PooledToken:
+    """OAuth-токен пула: запросы за сутки и карантин. index - номер в пуле (с 1), по нему токен виден в логах"""
+
+    def __init__(self, token: str, index: int = 1):
+        self.token = token
+        self.index = index
+        self.headers = {"Authorization": f"OAuth {token}"}
+        self.day = date.today()
+        self.calls = 0
+        self.quarantined_until = 0.0
+        self.denied = False  # карантин из-за 403, а не из-за исчерпанной квоты
+        self.quarantines = 0
+
+    def __repr__(self) -> str:
+        # Ни токен, ни его часть не попадают в логи и /status
+        return f"<token #{self.index}>"
+
+
+class TokenPool:
+    """
+    Пул OAuth-токенов одного сервиса. У каждого токена своя суточная квота,
+    поэтому запросы раздаются токену с наибольшим запасом (``per_day`` минус
+    запросы за сегодня; без ``per_day`` - наименее загруженному).
+
+    В карантин токен уходит, только когда ему отказано в доступе (403, на
+    ``auth_cooldown_seconds``) или исчерпана его суточная квота (до следующих суток);
+    запрос повторяется с другим токеном, и выгрузка не прерывается. Ограничение
+    частоты (429 без исчерпанной квоты) общее для всех токенов и обрабатывается
+    паузой RateLimiter, а не карантином. Если свободных токенов не осталось,
+    acquire() поднимает MetrikaAuthError (у всех 403) или MetrikaAPIError.
+    """
+
+    def __init__(self, tokens, per_day: int = None, auth_cooldown_seconds: float = TOKEN_AUTH_COOLDOWN_SECONDS):
+        self.tokens = [
+            PooledToken(token, index)
+            for index, token in enumerate([tokens] if isinstance(tokens, str) else tokens, 1)
+        ]
+        if not self.tokens:
+            raise ValueError("Пул токенов пуст")
+        self.per_day = per_day
+        self.auth_cooldown_seconds = auth_cooldown_seconds
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def _headroom(self, token: PooledToken) -> float:
+        today = date.today()
+        if token.day != today:
+            token.day, token.calls = today, 0
+        return (self.per_day if self.per_day is not None else 0) - token.calls
+
+    def acquire(self) -> PooledToken:
+        """Токен для следующего запроса; запрос сразу засчитывается токену"""
+        with self._lock:
+            now = time.monotonic()
+            ready = [token for token in self.tokens if token.quarantined_until <= now]
+            if not ready:
+                if all(token.denied for token in self.tokens):
+                    raise MetrikaAuthError("Access denied for every token in the pool", 403)
+                raise MetrikaAPIError("Daily quota is exhausted for every token in the pool", 429)
+            token = max(ready, key=self._headroom)
+            token.calls += 1
+            return token
+
+    def exhausted(self, token: PooledToken) -> bool:
+        """Токен израсходовал суточную квоту per_day"""
+        with self._lock:
+            return self.per_day is not None and self._headroom(token) <= 0
+
+    def quarantine(self, token: PooledToken, denied: bool = False):
+        """Убирает токен из раздачи: после 403 на auth_cooldown_seconds, при исчерпанной квоте - до следующих суток"""
+        with self._lock:
+            token.denied = denied
+            if denied:
+                seconds = self.auth_cooldown_seconds
+            else:
+                tomorrow = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+                seconds = (tomorrow - datetime.now()).total_seconds()
+            token.quarantined_until = time.monotonic() + seconds
+            token.quarantines += 1
+
+    def stats(self) -> list:
+        """[(токен, запросов за сегодня, в карантине)] для логов и /status"""
+        now = time.monotonic()
+        with self._lock:
+            return [(repr(token), token.calls, token.quarantined_until > now) for token in self.tokens]
@@ -0,0 +1,744 @@
+import db
+import json
+import logging
+import os
+import psycopg2
+import sqlite3
+import topn
+
+from collections import Counter
+from exceptions import SinkWriteError
+from models import DeadLetter, OrganicPageRow, ReferralUrlRow, SearchQueryRow, SectionRow, TopNSummaryRow, TrafficRow
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+
+class Sink:
+    """
+    Хранилище, через которое пишет пайплайн.
+
+    Каждый метод принимает пачку строк одной таблицы (NamedTuple из models)
+    и возвращает количество записанных строк. Если пачка не записалась,
+    транзакция откатывается и поднимается SinkWriteError.
+    Для таблиц из topn.TOPN_TABLES вместе с пачкой записываются сводки топа её периода.
+    В ``rows`` копится статистика по таблицам за время жизни sink.
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.rows = Counter()
+
+    def create_tables(self):
+        pass
+
+    def keep_warm(self):
+        """Держать подключения открытыми между пачками (для долгоживущего процесса)"""
+        pass
+
+    def _write(self, table: str, rows: list) -> int:
+        raise NotImplementedError
+
+    def _write_summarized(self, table: str, rows: list) -> int:
+        written = self._write(table, rows)
+        if written:
+            with profiler.stage('row_assembly'):
+                summaries = topn.summarize(table, rows)
+            with profiler.stage('db_execute'):
+                self.put_topn_summaries(summaries)
+        return written
+
+    def upsert_traffic_data(self, rows: list) -> int:
+        return self._write('all_traffic_by_url', rows)
+
+    def upsert_organic_pages_data(self, rows: list) -> int:
+        return self._write_summarized('organic_pages_by_url', rows)
+
+    def upsert_referral_urls_data(self, rows: list) -> int:
+        return self._write_summarized('referral_urls', rows)
+
+    def upsert_search_queries_webmaster_data(self, rows: list) -> int:
+        return self._write_summarized('search_queries_webmaster', rows)
+
+    def upsert_traffic_daily(self, rows: list) -> int:
+        return self._write('all_traffic_by_url_daily', rows)
+
+    def upsert_referral_urls_daily(self, rows: list) -> int:
+        return self._write_summarized('referral_urls_daily', rows)
+
+    def upsert_search_queries_webmaster_daily(self, rows: list) -> int:
+        return self._write_summarized('search_queries_webmaster_daily', rows)
+
+    def get_loaded_days(self, table: str, date_from: str, date_to: str, url: str = None,
+                        settle_days: int = None) -> set:
+        """
+        Периоды (date_from, date_to), выгрузка которых уже выполнена. Частично выгруженный
+        месяц отличается от полного по date_to.
+        С settle_days - только записанные через столько дней после конца периода
+        """
+        raise NotImplementedError
+
+    def mark_loaded(self, table: str, url: str, date_from: str, date_to: str, rows: int):
+        """
+        Отмечает выгрузку периода выполненной, даже если строк не было: по этой отметке
+        get_loaded_days пропускает период, а не запрашивает пустые дни снова
+        """
+        raise NotImplementedError
+
+    def add_api_usage(self, day: str, service: str, calls: dict):
+        """Прибавляет израсходованные вызовы API (эндпоинт -> количество) к счётчикам за день"""
+        raise NotImplementedError
+
+    def get_api_usage(self, day: str) -> dict:
+        """Израсходованные за день вызовы API: service -> количество"""
+        raise NotImplementedError
+
+    def add_dead_letter(self, unit_key: str, kind: str, params: dict, stage: str, error: str,
+                        backoff_seconds: float, max_backoff_seconds: float) -> int:
+        """
+        Записывает невыполненную единицу работы (stage: 'fetch' или 'write') с параметрами для повтора.
+        Пауза до повтора удваивается с каждой попыткой, но не больше max_backoff_seconds.
+        Возвращает номер попытки
+        """
+        raise NotImplementedError
+
+    def get_dead_letters(self, due_only: bool = True, max_attempts: int = None) -> list:
+        """Невыполненные единицы работы (DeadLetter), от старых к новым"""
+        raise NotImplementedError
+
+    def remove_dead_letter(self, unit_key: str):
+        """Убирает единицу работы из dead_letters"""
+        raise NotImplementedError
+
+    def put_topn_summaries(self, rows: list):
+        """Записывает сводки топа (TopNSummaryRow), заменяя прежние сводки тех же периодов"""
+        raise NotImplementedError
+
+    def iter_topn_summaries(self, table: str, metric: str, date_from: str, date_to: str, scope: str = None):
+        """Сводки топа таблицы за периоды внутри диапазона (итератор TopNSummaryRow)"""
+        raise NotImplementedError
+
+    def get_period_rows(self, table: str, row_type, date_from: str) -> list:
+        """Строки таблицы за период с началом date_from (самая полная версия незакрытого месяца)"""
+        raise NotImplementedError
+
+    def get_month_versions(self, table: str) -> dict:
+        """Месяц (YYYY-MM) по date_from -> (строк, наибольший updated_at) для всех месяцев таблицы"""
+        raise NotImplementedError
+
+    def iter_month_rows(self, table: str, row_type, month: str):
+        """Строки таблицы, у которых date_from приходится на месяц (итератор row_type)"""
+        raise NotImplementedError
+
+    def replace_sections(self, rows: list) -> int:
+        """Заменяет каталог разделов (SectionRow). Возвращает количество активных"""
+        raise NotImplementedError
+
+    def get_active_sections(self, max_age_days: int = None) -> list:
+        """URL активных разделов. Пустой список, если каталога нет или он старше max_age_days"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class PostgresSink(Sink):
+    """Postgres из DB_CONFIG. Пачка строк пишется через db.upsert_many одним подключением"""
+    name = 'postgres'
+
+    def create_tables(self):
+        db.create_tables()
+
+    def keep_warm(self):
+        db.init_pool()
+
+    def close(self):
+        db.close_pool()
+
+    def _write(self, table: str, rows: list) -> int:
+        try:
+            written = db.upsert_many(table, rows, raise_errors=True)
+        except psycopg2.Error as e:
+            raise SinkWriteError(f"{table}: {e}") from e
+        self.rows[table] += written
+        return written
+
+    def get_loaded_days(self, table: str, date_from: str, date_to: str, url: str = None,
+                        settle_days: int = None) -> set:
+        return db.get_loaded_days(table, date_from, date_to, url, settle_days)
+
+    def mark_loaded(self, table: str, url: str, date_from: str, date_to: str, rows: int):
+        try:
+            db.mark_loaded(table, url, date_from, date_to, rows)
+        except psycopg2.Error as e:
+            raise SinkWriteError(f"load_log: {e}") from e
+
+    def add_api_usage(self, day: str, service: str, calls: dict):
+        db.add_api_usage(day, service, calls)
+
+    def get_api_usage(self, day: str) -> dict:
+        return db.get_api_usage(day)
+
+    def add_dead_letter(self, unit_key: str, kind: str, params: dict, stage: str, error: str,
+                        backoff_seconds: float, max_backoff_seconds: float) -> int:
+        return db.add_dead_letter(unit_key, kind, params, stage, error, backoff_seconds, max_backoff_seconds)
+
+    def get_dead_letters(self, due_only: bool = True, max_attempts: int = None) -> list:
+        return db.get_dead_letters(due_only, max_attempts)
+
+    def remove_dead_letter(self, unit_key: str):
+        db.remove_dead_letter(unit_key)
+
+    def put_topn_summaries(self, rows: list):
+        try:
+            db.put_topn_summaries(rows)
+        except psycopg2.Error as e:
+            raise SinkWriteError(f"topn_summaries: {e}") from e
+
+    def iter_topn_summaries(self, table: str, metric: str, date_from: str, date_to: str, scope: str = None):
+        return db.iter_topn_summaries(table, metric, date_from, date_to, scope)
+
+    def get_period_rows(self, table: str, row_type, date_from: str) -> list:
+        return db.get_period_rows(table, row_type, date_from)
+
+    def get_month_versions(self, table: str) -> dict:
+        return db.get_month_versions(table)
+
+    def iter_month_rows(self, table: str, row_type, month: str):
+        return db.iter_month_rows(table, row_type, month)
+
+    def replace_sections(self, rows: list) -> int:
+        return db.replace_sections(rows)
+
+    def get_active_sections(self, max_age_days: int = None) -> list:
+        return db.get_active_sections(max_age_days)
+
+
+# Схема SQLite отличается от Postgres: тексты запросов и URL страниц и рефереров лежат прямо
+# в таблицах строковыми колонками, без справочников dim_* и таблиц фактов *_facts (в Postgres
+# под этими именами представления). Набор и смысл колонок при чтении совпадают,
+# но SQL, обращающийся к *_facts или dim_*, работает только с Postgres
+SQLITE_COMMANDS = [
+    """
+    CREATE TABLE IF NOT EXISTS all_traffic_by_url (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        organic INTEGER NOT NULL,
+        direct INTEGER NOT NULL,
+        social INTEGER NOT NULL,
+        referral INTEGER NOT NULL,
+        ad INTEGER NOT NULL,
+        internal INTEGER NOT NULL,
+        email INTEGER NOT NULL,
+        google_traffic INTEGER NOT NULL,
+        yandex_traffic INTEGER NOT NULL,
+        bounce_rate REAL NOT NULL,
+        page_depth REAL NOT NULL,
+        avg_visit REAL NOT NULL,
+        visits INTEGER NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, date_to, url)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS organic_pages_by_url (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        base_url TEXT,
+        page_url TEXT,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        bounce_rate REAL NOT NULL,
+        visits INTEGER NOT NULL,
+        traffic_share REAL NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, date_to, page_url)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS search_queries_webmaster (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        query_text TEXT,
+        shows INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        avg_show_position REAL NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, date_to, query_text)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS referral_urls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referral_url TEXT,
+        visits INTEGER NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, date_to, referral_url)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sections (
+        url TEXT PRIMARY KEY,
+        visits INTEGER NOT NULL,
+        window_from TEXT NOT NULL,
+        window_to TEXT NOT NULL,
+        min_visits INTEGER NOT NULL,
+        active INTEGER NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS all_traffic_by_url_daily (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        organic INTEGER NOT NULL,
+        direct INTEGER NOT NULL,
+        social INTEGER NOT NULL,
+        referral INTEGER NOT NULL,
+        ad INTEGER NOT NULL,
+        internal INTEGER NOT NULL,
+        email INTEGER NOT NULL,
+        google_traffic INTEGER NOT NULL,
+        yandex_traffic INTEGER NOT NULL,
+        bounce_rate REAL NOT NULL,
+        page_depth REAL NOT NULL,
+        avg_visit REAL NOT NULL,
+        visits INTEGER NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, url),
+        CHECK (date_from = date_to)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS referral_urls_daily (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referral_url TEXT,
+        visits INTEGER NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, referral_url),
+        CHECK (date_from = date_to)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS search_queries_webmaster_daily (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        query_text TEXT,
+        shows INTEGER NOT NULL,
+        clicks INTEGER NOT NULL,
+        avg_show_position REAL NOT NULL,
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        month_year TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (date_from, query_text),
+        CHECK (date_from = date_to)
+    )
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS all_traffic_by_url_monthly AS
+    SELECT
+        url,
+        date(date_from, 'start of month') AS date_from,
+        date(date_from, 'start of month', '+1 month', '-1 day') AS date_to,
+        SUM(organic) AS organic,
+        SUM(direct) AS direct,
+        SUM(social) AS social,
+        SUM(referral) AS referral,
+        SUM(ad) AS ad,
+        SUM(internal) AS internal,
+        SUM(email) AS email,
+        SUM(google_traffic) AS google_traffic,
+        SUM(yandex_traffic) AS yandex_traffic,
+        ROUND(SUM(bounce_rate * visits) / NULLIF(SUM(visits), 0), 2) AS bounce_rate,
+        ROUND(SUM(page_depth * visits) / NULLIF(SUM(visits), 0), 2) AS page_depth,
+        ROUND(SUM(avg_visit * visits) / NULLIF(SUM(visits), 0), 2) AS avg_visit,
+        SUM(visits) AS visits,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM all_traffic_by_url_daily
+    GROUP BY url, date(date_from, 'start of month')
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS referral_urls_monthly AS
+    SELECT
+        referral_url,
+        SUM(visits) AS visits,
+        date(date_from, 'start of month') AS date_from,
+        date(date_from, 'start of month', '+1 month', '-1 day') AS date_to,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM referral_urls_daily
+    GROUP BY referral_url, date(date_from, 'start of month')
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS search_queries_webmaster_monthly AS
+    SELECT
+        query_text,
+        SUM(shows) AS shows,
+        SUM(clicks) AS clicks,
+        ROUND(SUM(avg_show_position * shows) / NULLIF(SUM(shows), 0), 2) AS avg_show_position,
+        date(date_from, 'start of month') AS date_from,
+        date(date_from, 'start of month', '+1 month', '-1 day') AS date_to,
+        MIN(month_year) AS month_year,
+        COUNT(*) AS days,
+        MAX(updated_at) AS updated_at
+    FROM search_queries_webmaster_daily
+    GROUP BY query_text, date(date_from, 'start of month')
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS api_usage (
+        day TEXT NOT NULL,
+        service TEXT NOT NULL,
+        endpoint TEXT NOT NULL,
+        calls INTEGER NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (day, service, endpoint)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS load_log (
+        table_name TEXT NOT NULL,
+        url TEXT NOT NULL DEFAULT '',
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        rows INTEGER NOT NULL DEFAULT 0,
+        loaded_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (table_name, url, date_from, date_to)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        unit_key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        error TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        next_retry_at TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS topn_summaries (
+        table_name TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        scope TEXT NOT NULL DEFAULT '',
+        date_from TEXT NOT NULL,
+        date_to TEXT NOT NULL,
+        floor REAL NOT NULL,
+        total REAL NOT NULL,
+        items TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (table_name, metric, scope, date_from)
+    )
+    """
+]
+
+
+def _sqlite_upsert(table: str, row_type, conflict: list) -> str:
+    """Строит INSERT ... ON CONFLICT DO UPDATE с позиционными параметрами в порядке полей строки"""
+    columns = row_type._fields
+    updates = ', '.join(f'{c} = excluded.{c}' for c in columns if c not in conflict)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT ({', '.join(conflict)}) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP"
+    )
+
+
+SQLITE_UPSERTS = {
+    'all_traffic_by_url': _sqlite_upsert('all_traffic_by_url', TrafficRow, ['date_from', 'date_to', 'url']),
+    'organic_pages_by_url': _sqlite_upsert('organic_pages_by_url', OrganicPageRow, ['date_from', 'date_to', 'page_url']),
+    'referral_urls': _sqlite_upsert('referral_urls', ReferralUrlRow, ['date_from', 'date_to', 'referral_url']),
+    'search_queries_webmaster': _sqlite_upsert('search_queries_webmaster', SearchQueryRow,
+                                               ['date_from', 'date_to', 'query_text']),
+    'sections': _sqlite_upsert('sections', SectionRow, ['url']),
+    'all_traffic_by_url_daily': _sqlite_upsert('all_traffic_by_url_daily', TrafficRow, ['date_from', 'url']),
+    'referral_urls_daily': _sqlite_upsert('referral_urls_daily', ReferralUrlRow, ['date_from', 'referral_url']),
+    'search_queries_webmaster_daily': _sqlite_upsert('search_queries_webmaster_daily', SearchQueryRow,
+                                                     ['date_from', 'query_text'])
+}
+
+
+class SQLiteSink(Sink):
+    """
+    Встроенная SQLite-база для локальной разработки, CI и однохостовых установок.
+
+    Одно соединение на всё время работы, журнал WAL, пачка строк пишется
+    одним executemany и одним коммитом.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.path = path or os.getenv('SQLITE_PATH', 'datalens.sqlite3')
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_tables()
+
+    def create_tables(self):
+        for command in SQLITE_COMMANDS:
+            self.conn.execute(command)
+        self.conn.commit()
+
+    def _write(self, table: str, rows: list) -> int:
+        if not rows:
+            return 0
+        try:
+            with profiler.stage('db_execute'):
+                self.conn.executemany(SQLITE_UPSERTS[table], rows)
+            with profiler.stage('commit'):
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error("Ошибка записи в %s: %s", table, e)
+            self.conn.rollback()
+            raise SinkWriteError(f"{table}: {e}") from e
+        self.rows[table] += len(rows)
+        return len(rows)
+
+    def get_loaded_days(self, table: str, date_from: str, date_to: str, url: str = None,
+                        settle_days: int = None) -> set:
+        log_query = 'SELECT date_from, date_to FROM load_log WHERE table_name = ? AND url = ? AND date_from BETWEEN ? AND ?'
+        log_params = [table, url or '', date_from, date_to]
+        query = f'SELECT date_from, date_to FROM {table} WHERE date_from BETWEEN ? AND ?'
+        params = [date_from, date_to]
+        if url is not None:
+            query += ' AND url = ?'
+            params.append(url)
+        if settle_days is not None:
+            log_query += ' AND loaded_at >= date(date_to, ?)'
+            log_params.append(f'+{int(settle_days)} days')
+            query += ' AND updated_at >= date(date_to, ?)'
+            params.append(f'+{int(settle_days)} days')
+        return {tuple(row) for row in self.conn.execute(f'{log_query} UNION {query}', log_params + params)}
+
+    def mark_loaded(self, table: str, url: str, date_from: str, date_to: str, rows: int):
+        try:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT INTO load_log (table_name, url, date_from, date_to, rows) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (table_name, url, date_from, date_to) '
+                    'DO UPDATE SET rows = excluded.rows, loaded_at = CURRENT_TIMESTAMP',
+                    (table, url or '', date_from, date_to, rows)
+                )
+        except sqlite3.Error as e:
+            raise SinkWriteError(f"load_log: {e}") from e
+
+    def add_api_usage(self, day: str, service: str, calls: dict):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO api_usage (day, service, endpoint, calls) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (day, service, endpoint) DO UPDATE SET calls = calls + excluded.calls, '
+                'updated_at = CURRENT_TIMESTAMP',
+                [(day, service, endpoint, count) for endpoint, count in calls.items() if count]
+            )
+
+    def get_api_usage(self, day: str) -> dict:
+        query = 'SELECT service, SUM(calls) FROM api_usage WHERE day = ? GROUP BY service'
+        return dict(self.conn.execute(query, (day,)).fetchall())
+
+    def add_dead_letter(self, unit_key: str, kind: str, params: dict, stage: str, error: str,
+                        backoff_seconds: float, max_backoff_seconds: float) -> int:
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO dead_letters (unit_key, kind, params, stage, error, next_retry_at) "
+                "VALUES (:key, :kind, :params, :stage, :error, datetime('now', '+' || MIN(:backoff, :max_backoff) || ' seconds')) "
+                "ON CONFLICT (unit_key) DO UPDATE SET params = excluded.params, stage = excluded.stage, "
+                "error = excluded.error, attempts = attempts + 1, "
+                "next_retry_at = datetime('now', '+' || MIN(:backoff * (1 << attempts), :max_backoff) || ' seconds'), "
+                "updated_at = CURRENT_TIMESTAMP",
+                {'key': unit_key, 'kind': kind, 'params': json.dumps(params), 'stage': stage, 'error': error,
+                 'backoff': backoff_seconds, 'max_backoff': max_backoff_seconds}
+            )
+        return self.conn.execute('SELECT attempts FROM dead_letters WHERE unit_key = ?', (unit_key,)).fetchone()[0]
+
+    def get_dead_letters(self, due_only: bool = True, max_attempts: int = None) -> list:
+        query = ('SELECT unit_key, kind, params, stage, error, attempts, next_retry_at '
+                 'FROM dead_letters WHERE 1')
+        params = []
+        if due_only:
+            query += " AND next_retry_at <= datetime('now')"
+        if max_attempts is not None:
+            query += ' AND attempts < ?'
+            params.append(max_attempts)
+        return [
+            DeadLetter(key, kind, json.loads(unit_params), stage, error, attempts, next_retry_at)
+            for key, kind, unit_params, stage, error, attempts, next_retry_at
+            in self.conn.execute(query + ' ORDER BY created_at, rowid', params)
+        ]
+
+    def remove_dead_letter(self, unit_key: str):
+        with self.conn:
+            self.conn.execute('DELETE FROM dead_letters WHERE unit_key = ?', (unit_key,))
+
+    def put_topn_summaries(self, rows: list):
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT INTO topn_summaries (table_name, metric, scope, date_from, date_to, floor, total, items) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (table_name, metric, scope, date_from) DO UPDATE SET date_to = excluded.date_to, '
+                    'floor = excluded.floor, total = excluded.total, items = excluded.items, '
+                    'updated_at = CURRENT_TIMESTAMP',
+                    [row[:-1] + (json.dumps(row.items, ensure_ascii=False),) for row in rows]
+                )
+        except sqlite3.Error as e:
+            logger.error("Ошибка записи сводок топа: %s", e)
+            raise SinkWriteError(f"topn_summaries: {e}") from e
+
+    def iter_topn_summaries(self, table: str, metric: str, date_from: str, date_to: str, scope: str = None):
+        query = ('SELECT table_name, metric, scope, date_from, date_to, floor, total, items FROM topn_summaries '
+                 'WHERE table_name = ? AND metric = ? AND date_from >= ? AND date_to <= ?')
+        params = [table, metric, date_from, date_to]
+        if scope is not None:
+            query += ' AND scope = ?'
+            params.append(scope)
+        for row in self.conn.execute(query, params):
+            yield TopNSummaryRow(*row[:-1], json.loads(row[-1]))
+
+    def get_period_rows(self, table: str, row_type, date_from: str) -> list:
+        query = (f"SELECT {', '.join(row_type._fields)} FROM {table} "
+                 f"WHERE date_from = ? AND date_to = (SELECT MAX(date_to) FROM {table} WHERE date_from = ?)")
+        return [row_type(*row) for row in self.conn.execute(query, (date_from, date_from))]
+
+    def get_month_versions(self, table: str) -> dict:
+        query = f"SELECT substr(date_from, 1, 7), COUNT(*), MAX(updated_at) FROM {table} GROUP BY 1"
+        return {month: (rows, updated_at) for month, rows, updated_at in self.conn.execute(query)}
+
+    def iter_month_rows(self, table: str, row_type, month: str):
+        query = f"SELECT {', '.join(row_type._fields)} FROM {table} WHERE substr(date_from, 1, 7) = ?"
+        for row in self.conn.execute(query, (month,)):
+            yield row_type(*row)
+
+    def replace_sections(self, rows: list) -> int:
+        with self.conn:
+            self.conn.execute('UPDATE sections SET active = 0, updated_at = CURRENT_TIMESTAMP')
+            self.conn.executemany(SQLITE_UPSERTS['sections'], rows)
+        return sum(1 for row in rows if row.active)
+
+    def get_active_sections(self, max_age_days: int = None) -> list:
+        query = 'SELECT url FROM sections WHERE active'
+        params = ()
+        if max_age_days is not None:
+            query += " AND updated_at > datetime('now', ?)"
+            params = (f'-{int(max_age_days)} days',)
+        return [row[0] for row in self.conn.execute(query + ' ORDER BY visits DESC', params)]
+
+    def close(self):
+        self.conn.close()
+
+
+class NullSink(Sink):
+    """Ничего не пишет, только считает строки. Для бенчмарков чистой выгрузки"""
+    name = 'null'
+
+    def __init__(self):
+        super().__init__()
+        self.sections = []
+        self.api_usage = Counter()
+        self.dead_letters = {}
+        self.topn_summaries = {}
+
+    def _write(self, table: str, rows: list) -> int:
+        self.rows[table] += len(rows)
+        return len(rows)
+
+    def get_loaded_days(self, table: str, date_from: str, date_to: str, url: str = None,
+                        settle_days: int = None) -> set:
+        return set()
+
+    def mark_loaded(self, table: str, url: str, date_from: str, date_to: str, rows: int):
+        pass
+
+    def add_api_usage(self, day: str, service: str, calls: dict):
+        self.api_usage[(day, service)] += sum(calls.values())
+
+    def get_api_usage(self, day: str) -> dict:
+        return {service: calls for (d, service), calls in self.api_usage.items() if d == day}
+
+    def add_dead_letter(self, unit_key: str, kind: str, params: dict, stage: str, error: str,
+                        backoff_seconds: float, max_backoff_seconds: float) -> int:
+        # Паузы до повтора нет: NullSink живёт один прогон
+        previous = self.dead_letters.get(unit_key)
+        attempts = previous.attempts + 1 if previous else 1
+        self.dead_letters[unit_key] = DeadLetter(unit_key, kind, params, stage, error, attempts, None)
+        return attempts
+
+    def get_dead_letters(self, due_only: bool = True, max_attempts: int = None) -> list:
+        return [letter for letter in self.dead_letters.values()
+                if max_attempts is None or letter.attempts < max_attempts]
+
+    def remove_dead_letter(self, unit_key: str):
+        self.dead_letters.pop(unit_key, None)
+
+    def put_topn_summaries(self, rows: list):
+        for row in rows:
+            self.topn_summaries[(row.table_name, row.metric, row.scope, row.date_from)] = row
+
+    def iter_topn_summaries(self, table: str, metric: str, date_from: str, date_to: str, scope: str = None):
+        return [
+            row for row in self.topn_summaries.values()
+            if row.table_name == table and row.metric == metric and row.date_from >= date_from
+            and row.date_to <= date_to and (scope is None or row.scope == scope)
+        ]
+
+    def get_period_rows(self, table: str, row_type, date_from: str) -> list:
+        return []
+
+    def get_month_versions(self, table: str) -> dict:
+        return {}
+
+    def iter_month_rows(self, table: str, row_type, month: str):
+        return iter(())
+
+    def replace_sections(self, rows: list) -> int:
+        # Каталог держим в памяти, чтобы пайплайн мог по нему пройти
+        self.sections = sorted((row for row in rows if row.active), key=lambda row: -row.visits)
+        return len(self.sections)
+
+    def get_active_sections(self, max_age_days: int = None) -> list:
+        return [row.url for row in self.sections]
+
+
+SINKS = {
+    'postgres': PostgresSink,
+    'sqlite': SQLiteSink,
+    'null': NullSink
+}
+
+
+def get_sink(backend: str = None) -> Sink:
+    """
+    Создаёт sink по имени бэкенда
+
+    :param backend: 'postgres', 'sqlite' или 'null'. По умолчанию берётся из STORAGE_BACKEND (postgres)
+    """
+    backend = (backend or os.getenv('STORAGE_BACKEND', 'postgres')).lower()
+    if backend not in SINKS:
+        raise ValueError(f"Неизвестный STORAGE_BACKEND: {backend}. Доступны: {', '.join(SINKS)}")
+    return SINKS[backend]()
@@ -0,0 +1,271 @@
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import time
+
+from array import array
+from datetime import datetime, timezone
+from logs import log_event
+from models import OrganicPageRow, ReferralUrlRow, SearchQueryRow, TrafficRow
+
+logger = logging.getLogger('snapshot')
+
+# Таблицы, которые выгружаются колоночным снимком, и тип их строк
+SNAPSHOT_TABLES = {
+    'all_traffic_by_url': TrafficRow,
+    'organic_pages_by_url': OrganicPageRow,
+    'referral_urls': ReferralUrlRow,
+    'search_queries_webmaster': SearchQueryRow,
+    'all_traffic_by_url_daily': TrafficRow,
+    'referral_urls_daily': ReferralUrlRow,
+    'search_queries_webmaster_daily': SearchQueryRow
+}
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshot')
+MANIFEST = 'manifest.json'
+# Сколько хранится заменённый или удалённый каталог месяца: читатель, открывший снимок
+# по прежнему манифесту, успевает дочитать колонки
+SNAPSHOT_RETIRE_SECONDS = float(os.getenv('SNAPSHOT_RETIRE_SECONDS', 3600))
+
+# Виды колонок: int64/float64 - числа (int с пропусками хранится как float64 с NaN),
+# date - datetime64[D], dict - коды int32 (-1 - пусто) + словарь значений <колонка>.labels.json
+_DATE_COLUMNS = ('date_from', 'date_to')
+
+
+def column_kinds(row_type) -> dict:
+    """Колонка -> вид хранения по аннотациям NamedTuple из models"""
+    kinds = {}
+    for field, annotation in row_type.__annotations__.items():
+        if field in _DATE_COLUMNS:
+            kinds[field] = 'date'
+        elif annotation is str:
+            kinds[field] = 'dict'
+        elif annotation is int:
+            kinds[field] = 'int64'
+        else:
+            kinds[field] = 'float64'
+    return kinds
+
+
+class MonthSnapshot:
+    """
+    Колонки одного месяца снимка. Числа и даты отображаются в память (np.load с mmap_mode='r'),
+    поэтому читаются с диска только те колонки, к которым обратились.
+    Строковые колонки хранятся кодами словаря: ``column()`` отдаёт коды, ``labels()`` - словарь,
+    ``values()`` - декодированные значения. Словарь у каждого месяца свой.
+    """
+
+    def __init__(self, path: str, kinds: dict, rows: int):
+        self.path = path
+        self.kinds = kinds
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def column(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+
+    def labels(self, name: str) -> np.ndarray:
+        with open(os.path.join(self.path, f"{name}.labels.json"), encoding='utf-8') as f:
+            return np.array(json.load(f), dtype=object)
+
+    def values(self, name: str) -> np.ndarray:
+        if self.kinds[name] != 'dict':
+            return self.column(name)
+        # Последний элемент - для кода -1 (пустое значение)
+        return np.append(self.labels(name), None)[self.column(name)]
+
+
+def _encode_month(rows, kinds: dict) -> tuple:
+    """
+    Один проход по строкам месяца: числа копятся в array('d'), строки и даты - сразу кодами словаря
+
+    :return: (колонка -> массив, колонка -> словарь для dict-колонок, строк)
+    """
+    names = list(kinds)
+    numbers = {name: array('d') for name in names if kinds[name] in ('int64', 'float64')}
+    codes = {name: array('i') for name in names if kinds[name] in ('date', 'dict')}
+    indexes = {name: {} for name in codes}
+    count = 0
+    for row in rows:
+        count += 1
+        for name, value in zip(names, row):
+            if name in numbers:
+                numbers[name].append(np.nan if value is None else value)
+            elif value is None:
+                codes[name].append(-1)
+            else:
+                index = indexes[name]
+                codes[name].append(index.setdefault(value, len(index)))
+
+    columns, labels = {}, {}
+    for name, values in numbers.items():
+        column = np.frombuffer(values, dtype=np.float64)
+        if kinds[name] == 'int64' and not np.isnan(column).any():
+            column = column.astype(np.int64)
+        columns[name] = column
+    for name, column in codes.items():
+        column = np.frombuffer(column, dtype=np.int32)
+        unique = list(indexes[name])
+        if kinds[name] == 'date':
+            # Дата разбирается один раз на уникальное значение, а не на строку
+            dates = np.append(np.array([str(value) for value in unique], dtype='datetime64[D]'),
+                              np.datetime64('NaT'))
+            columns[name] = dates[column]
+        else:
+            columns[name] = column
+            labels[name] = unique
+    return columns, labels, count
+
+
+def _write_month(table_dir: str, month: str, columns: dict, labels: dict) -> str:
+    """
+    Пишет месяц в новый каталог <month>.<n>, не трогая прежний: читатель переходит на него,
+    только когда каталог записан в манифест
+
+    :return: Имя каталога относительно table_dir
+    """
+    versions = [
+        int(name.rsplit('.', 1)[1]) for name in os.listdir(table_dir)
+        if name.startswith(f"{month}.") and name.rsplit('.', 1)[1].isdigit()
+    ]
+    name = f"{month}.{max(versions, default=0) + 1}"
+    tmp_path = os.path.join(table_dir, name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for column_name, column in columns.items():
+        np.save(os.path.join(tmp_path, f"{column_name}.npy"), column)
+    for column_name, values in labels.items():
+        with open(os.path.join(tmp_path, f"{column_name}.labels.json"), 'w', encoding='utf-8') as f:
+            json.dump(values, f, ensure_ascii=False)
+    os.rename(tmp_path, os.path.join(table_dir, name))
+    return name
+
+
+def _month_path(month: str, info: dict) -> str:
+    # Манифесты до версионных каталогов хранили месяц в каталоге <month>
+    return info.get('path', month)
+
+
+def _purge_retired(table_dir: str, retired: dict):
+    """Удаляет каталоги, выведенные из манифеста больше SNAPSHOT_RETIRE_SECONDS назад"""
+    now = time.time()
+    for name, retired_at in list(retired.items()):
+        if now - retired_at >= SNAPSHOT_RETIRE_SECONDS:
+            shutil.rmtree(os.path.join(table_dir, name), ignore_errors=True)
+            del retired[name]
+
+
+def read_manifest(table_dir: str) -> dict:
+    try:
+        with open(os.path.join(table_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(table_dir: str, manifest: dict):
+    path = os.path.join(table_dir, MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def refresh_table(sink, table: str, output_dir: str = SNAPSHOT_DIR, full: bool = False) -> dict:
+    """
+    Обновляет снимок таблицы: перезаписывает только месяцы, чья версия (строк, наибольший
+    updated_at) изменилась с прошлого обновления, и убирает месяцы, которых больше нет в таблице.
+    Версия берётся до чтения строк, поэтому строки, записанные во время выгрузки, попадут
+    в следующее обновление. Манифест сохраняется после каждого месяца.
+    Новый месяц пишется в отдельный каталог, а прежний удаляется не раньше чем через
+    SNAPSHOT_RETIRE_SECONDS, поэтому читатель никогда не видит в манифесте отсутствующий каталог
+
+    :param full: Перезаписать все месяцы
+    :return: {'table', 'written', 'removed', 'rows'} - записанные и удалённые месяцы, строк записано
+    """
+    row_type = SNAPSHOT_TABLES[table]
+    kinds = column_kinds(row_type)
+    table_dir = os.path.join(output_dir, table)
+    os.makedirs(table_dir, exist_ok=True)
+
+    manifest = read_manifest(table_dir)
+    previous = manifest.get('months', {})
+    retired = manifest.get('retired', {})
+    if manifest.get('columns') != kinds:
+        # Поменялся состав колонок - прежние месяцы несовместимы
+        full = True
+    months = {} if full else dict(previous)
+    manifest = {'table': table, 'columns': kinds, 'months': months, 'retired': retired}
+    _purge_retired(table_dir, retired)
+
+    versions = sink.get_month_versions(table)
+    result = {'table': table, 'written': [], 'removed': [], 'rows': 0}
+    for month in sorted(set(previous) - set(versions)):
+        months.pop(month, None)
+        retired[_month_path(month, previous[month])] = time.time()
+        _write_manifest(table_dir, manifest)
+        result['removed'].append(month)
+
+    for month, (rows, updated_at) in sorted(versions.items()):
+        known = months.get(month)
+        if known and known['rows'] == rows and known['updated_at'] == updated_at:
+            continue
+        columns, labels, count = _encode_month(sink.iter_month_rows(table, row_type, month), kinds)
+        path = _write_month(table_dir, month, columns, labels)
+        months[month] = {
+            'rows': count,
+            'updated_at': updated_at,
+            'path': path,
+            'exported_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+        }
+        if month in previous:
+            retired[_month_path(month, previous[month])] = time.time()
+        _write_manifest(table_dir, manifest)
+        log_event(logger, 'snapshot_month_written', logging.INFO, table=table, month=month, rows=count)
+        result['written'].append(month)
+        result['rows'] += count
+
+    _write_manifest(table_dir, manifest)
+    return result
+
+
+def open_snapshot(table: str, output_dir: str = SNAPSHOT_DIR, month_from: str = None, month_to: str = None):
+    """
+    Месяцы снимка таблицы по возрастанию, в границах [month_from, month_to] (YYYY-MM)
+
+    Yields:
+        (месяц, MonthSnapshot)
+    """
+    table_dir = os.path.join(output_dir, table)
+    manifest = read_manifest(table_dir)
+    for month, info in sorted(manifest.get('months', {}).items()):
+        if (month_from and month < month_from) or (month_to and month > month_to):
+            continue
+        yield month, MonthSnapshot(os.path.join(table_dir, _month_path(month, info)), manifest['columns'],
+                                   info['rows'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Колоночный снимок таблиц по месяцам для аналитики')
+    parser.add_argument('--storage', choices=['postgres', 'sqlite'],
+                        help='Хранилище (по умолчанию STORAGE_BACKEND или postgres)')
+    parser.add_argument('--dir', default=SNAPSHOT_DIR, help='Каталог снимка')
+    parser.add_argument('--tables', nargs='+', choices=list(SNAPSHOT_TABLES), help='По умолчанию все')
+    parser.add_argument('--full', action='store_true', help='Перезаписать все месяцы, а не только изменённые')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from logs import setup_logging
+    from sinks import get_sink
+
+    args = parse_args()
+    setup_logging()
+    with get_sink(args.storage) as sink:
+        for table in args.tables or SNAPSHOT_TABLES:
+            result = refresh_table(sink, table, args.dir, args.full)
+            print(f"{table}: записано месяцев {len(result['written'])} ({result['rows']} строк), "
+                  f"удалено {len(result['removed'])}")
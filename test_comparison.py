@@ -0,0 +1,158 @@
+import pytest
+
+from core import YandexMetrika
+
+URL = 'https://zaruku.ru/pitanie/'
+ORGANIC = "ym:s:trafficSource=='organic'"
+
+# Ответы /stat/v1/data/comparison в том виде, в каком их отдаёт API: метрики строк и totals - по сегментам a и b
+SECTION_RESPONSE = {
+    'query': {'ids': [1], 'metrics': ['ym:s:visits'], 'date1_a': '2024-01-01', 'date2_a': '2024-01-31',
+              'date1_b': '2024-01-01', 'date2_b': '2024-01-31'},
+    'data': [{'dimensions': [], 'metrics': {'a': [412.0], 'b': [1077.0]}}],
+    'total_rows': 1,
+    'totals': {'a': [412.0], 'b': [1077.0]}
+}
+BEHAVIOR_RESPONSE = {
+    'query': {'ids': [1], 'metrics': ['ym:s:visits', 'ym:s:bounceRate', 'ym:s:pageDepth',
+                                      'ym:s:avgVisitDurationSeconds']},
+    'data': [{'dimensions': [], 'metrics': {'a': [412.0, 18.44660194, 1.27912621, 73.90533981],
+                                            'b': [1077.0, 24.51253482, 1.61188486, 95.6638812]}}],
+    'total_rows': 1,
+    'totals': {'a': [412.0, 18.44660194, 1.27912621, 73.90533981],
+               'b': [1077.0, 24.51253482, 1.61188486, 95.6638812]}
+}
+PAGES_RESPONSE = {
+    'query': {'ids': [1], 'metrics': ['ym:s:visits', 'ym:s:bounceRate'], 'dimensions': ['ym:s:startURL']},
+    'data': [
+        {'dimensions': [{'name': 'https://zaruku.ru/pitanie/dieta/', 'favicon': 'zaruku.ru'}],
+         'metrics': {'a': [300.0, 12.33333333], 'b': [500.0, 20.0]}},
+        {'dimensions': [{'name': 'https://zaruku.ru/pitanie/belok/', 'favicon': 'zaruku.ru'}],
+         'metrics': {'a': [100.0, 31.0], 'b': [300.0, 25.46]}},
+        {'dimensions': [{'name': 'https://zaruku.ru/pitanie/sahar/', 'favicon': 'zaruku.ru'}],
+         'metrics': {'a': [0.0, 0.0], 'b': [200.0, 50.0]}}
+    ],
+    'total_rows': 3,
+    'totals': {'a': [400.0, 17.5], 'b': [1000.0, 27.64]}
+}
+EMPTY_RESPONSE = {'query': {}, 'data': [], 'total_rows': 0, 'totals': {'a': [0.0], 'b': [0.0]}}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self) -> dict:
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeMetrika(YandexMetrika):
+    """Метрика, которая отдаёт записанный ответ и запоминает адрес и параметры вызова"""
+
+    def __init__(self, response: dict):
+        super().__init__('token', '1', api_url='https://api-metrika.yandex.net')
+        self.response = response
+        self.sent = []
+
+    def _send(self, method, full_url, endpoint, **kwargs):
+        self.sent.append((full_url, kwargs['params']))
+        return FakeResponse(self.response)
+
+
+def test_compare_segments_params():
+    metrika = FakeMetrika(PAGES_RESPONSE)
+    metrika.compare_segments('2024-01-01', '2024-01-31', ['ym:s:visits', 'ym:s:bounceRate'], ('organic', 'all'),
+                             dimensions=['ym:s:startURL'], filters="ym:s:startURL=~'^x'", limit=10,
+                             sort='-ym:s:visits')
+
+    assert metrika.sent == [('https://api-metrika.yandex.net/stat/v1/data/comparison', {
+        'ids': '1',
+        'metrics': 'ym:s:visits,ym:s:bounceRate',
+        'date1_a': '2024-01-01',
+        'date2_a': '2024-01-31',
+        'date1_b': '2024-01-01',
+        'date2_b': '2024-01-31',
+        'accuracy': 'full',
+        'dimensions': 'ym:s:startURL',
+        'filters_a': f"ym:s:startURL=~'^x' AND {ORGANIC}",
+        'filters_b': "ym:s:startURL=~'^x'",
+        'limit': 10,
+        'sort': '-ym:s:visits'
+    })]
+
+
+def test_compare_segments_without_filters():
+    metrika = FakeMetrika(SECTION_RESPONSE)
+    metrika.compare_segments('2024-01-01', '2024-01-31', ['ym:s:visits'], ('all', 'yandex'))
+
+    params = metrika.sent[0][1]
+    assert 'filters_a' not in params and 'dimensions' not in params and 'limit' not in params
+    assert params['filters_b'] == "ym:s:searchEngineRoot=='yandex'"
+
+
+def test_traffic_pair():
+    metrika = FakeMetrika(SECTION_RESPONSE)
+    assert metrika.get_traffic_by_urls_pair('2024-01-01', '2024-01-31', URL) == {'organic': 412.0, 'all': 1077.0}
+    params = metrika.sent[0][1]
+    assert params['filters_a'] == f"ym:s:startURLPathLevel2=='{URL}' AND {ORGANIC}"
+    assert params['filters_b'] == f"ym:s:startURLPathLevel2=='{URL}'"
+
+
+def test_traffic_pair_without_rows():
+    metrika = FakeMetrika(EMPTY_RESPONSE)
+    assert metrika.get_traffic_by_urls_pair('2024-01-01', '2024-01-31', URL, ('yandex', 'google')) == \
+        {'yandex': 0, 'google': 0}
+
+
+def test_behavior_pair():
+    metrika = FakeMetrika(BEHAVIOR_RESPONSE)
+    assert metrika.get_behavior_metrics_pair('2024-01-01', '2024-01-31', URL + '?utm=x#top') == {
+        'organic': {'bounce_rate': 18.4, 'page_depth': 1.28, 'avg_visit': 73, 'visits': 412},
+        'all': {'bounce_rate': 24.5, 'page_depth': 1.61, 'avg_visit': 95, 'visits': 1077}
+    }
+    # Параметры и якорь отбрасываются, как в get_behavior_metrics
+    assert metrika.sent[0][1]['filters_b'] == f"ym:s:startURL=~'^{URL}[^/]*/?$'"
+
+
+def test_behavior_pair_without_rows():
+    metrika = FakeMetrika(EMPTY_RESPONSE)
+    empty = {'bounce_rate': 0, 'page_depth': 0, 'avg_visit': 0, 'visits': 0}
+    assert metrika.get_behavior_metrics_pair('2024-01-01', '2024-01-31') == {'organic': empty, 'all': empty}
+    assert 'filters_b' not in metrika.sent[0][1]
+
+
+def test_pages_pair():
+    metrika = FakeMetrika(PAGES_RESPONSE)
+    pages = metrika.get_pages_from_url_pair('2024-01-01', '2024-01-31', URL, limit=3)
+
+    assert pages == [
+        {'page_url': 'https://zaruku.ru/pitanie/dieta/',
+         'organic': {'visits': 300.0, 'bounce_rate': 12.3, 'traffic_share': 75.0},
+         'all': {'visits': 500.0, 'bounce_rate': 20.0, 'traffic_share': 50.0}},
+        {'page_url': 'https://zaruku.ru/pitanie/belok/',
+         'organic': {'visits': 100.0, 'bounce_rate': 31.0, 'traffic_share': 25.0},
+         'all': {'visits': 300.0, 'bounce_rate': 25.5, 'traffic_share': 30.0}},
+        {'page_url': 'https://zaruku.ru/pitanie/sahar/',
+         'organic': {'visits': 0.0, 'bounce_rate': 0.0, 'traffic_share': 0.0},
+         'all': {'visits': 200.0, 'bounce_rate': 50.0, 'traffic_share': 20.0}}
+    ]
+    params = metrika.sent[0][1]
+    assert (params['dimensions'], params['limit'], params['sort']) == ('ym:s:startURL', 3, '-ym:s:visits')
+    assert params['filters_b'] == f"ym:s:startURL=~'^{URL}[^/]+/.*'"
+
+
+@pytest.mark.parametrize('response', [EMPTY_RESPONSE, {
+    'data': [{'dimensions': [{'name': 'https://zaruku.ru/pitanie/dieta/'}], 'metrics': {'a': [0.0, 0.0],
+                                                                                      'b': [0.0, 0.0]}}]
+}])
+def test_pages_pair_without_visits(response):
+    pages = FakeMetrika(response).get_pages_from_url_pair('2024-01-01', '2024-01-31', URL)
+    assert all(page[segment]['traffic_share'] == 0 for page in pages for segment in ('organic', 'all'))
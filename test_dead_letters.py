@@ -0,0 +1,111 @@
+import main
+import pytest
+
+from budget import STAT_ENDPOINT, WorkUnit
+from core import YandexMetrika, YandexWebmaster
+from exceptions import MetrikaAPIError, MetrikaCircuitOpenError, SinkWriteError
+from sinks import SQLiteSink
+
+BACKOFF = 300
+MAX_BACKOFF = 1000
+
+
+@pytest.fixture
+def sink(tmp_path):
+    sink = SQLiteSink(str(tmp_path / 'test.sqlite3'))
+    yield sink
+    sink.close()
+
+
+def unit(day: str = '2024-01-01') -> WorkUnit:
+    return WorkUnit('metrika', 'referral_daily', None, day, day, STAT_ENDPOINT, 1)
+
+
+def retry_in(sink: SQLiteSink, key: str) -> int:
+    """Через сколько секунд единица станет доступна для повтора"""
+    return sink.conn.execute(
+        "SELECT CAST(strftime('%s', next_retry_at) AS INTEGER) - CAST(strftime('%s', 'now') AS INTEGER) "
+        "FROM dead_letters WHERE unit_key = ?", (key,)
+    ).fetchone()[0]
+
+
+def make_due(sink: SQLiteSink):
+    with sink.conn:
+        sink.conn.execute("UPDATE dead_letters SET next_retry_at = datetime('now', '-1 seconds')")
+
+
+def test_backoff_doubles_up_to_limit(sink):
+    delays = []
+    for attempt in range(1, 6):
+        assert sink.add_dead_letter('key', 'referral', {}, 'fetch', f'error {attempt}', BACKOFF, MAX_BACKOFF) == attempt
+        delays.append(retry_in(sink, 'key'))
+
+    assert delays == pytest.approx([300, 600, 1000, 1000, 1000], abs=2)
+    [letter] = sink.get_dead_letters(due_only=False)
+    assert (letter.attempts, letter.error) == (5, 'error 5')
+
+
+def test_due_and_max_attempts(sink):
+    sink.add_dead_letter('waiting', 'referral', {}, 'fetch', 'e', BACKOFF, MAX_BACKOFF)
+    sink.add_dead_letter('due', 'referral', {}, 'fetch', 'e', 0, MAX_BACKOFF)
+    for _ in range(3):
+        sink.add_dead_letter('exhausted', 'referral', {}, 'fetch', 'e', 0, MAX_BACKOFF)
+
+    assert [letter.unit_key for letter in sink.get_dead_letters()] == ['due', 'exhausted']
+    assert [letter.unit_key for letter in sink.get_dead_letters(max_attempts=3)] == ['due']
+    assert len(sink.get_dead_letters(due_only=False)) == 3
+
+
+def test_dead_letter_units(sink, monkeypatch):
+    monkeypatch.setattr(main, 'DEAD_LETTER_MAX_ATTEMPTS', 2)
+    for day in ('2024-01-01', '2024-01-02', '2024-01-03'):
+        sink.add_dead_letter(main.dead_letter_key(unit(day)), 'referral_daily', unit(day)._asdict(), 'fetch', 'e',
+                             0 if day != '2024-01-02' else BACKOFF, MAX_BACKOFF)
+    sink.add_dead_letter(main.dead_letter_key(unit('2024-01-03')), 'referral_daily', unit('2024-01-03')._asdict(),
+                         'fetch', 'e', 0, MAX_BACKOFF)
+
+    # Пауза второго дня не истекла, у третьего исчерпаны попытки
+    assert main.dead_letter_units(sink) == [unit('2024-01-01')]
+    assert main.dead_letter_units(sink, retry_all=True) == [unit(day) for day in
+                                                            ('2024-01-01', '2024-01-02', '2024-01-03')]
+
+
+@pytest.fixture
+def clients():
+    return YandexMetrika('token', '1'), YandexWebmaster('token', 'host', user_id='1')
+
+
+def test_failed_unit_is_recorded_and_removed_on_success(sink, clients, monkeypatch):
+    outcomes = iter([MetrikaAPIError('Request failed', 500), SinkWriteError('write failed'), None])
+
+    def load_referral_day(metrika, sink, day):
+        error = next(outcomes)
+        if error:
+            raise error
+
+    monkeypatch.setattr(main, 'load_referral_day', load_referral_day)
+    key = main.dead_letter_key(unit())
+
+    main.run_units(*clients, sink, [unit()])
+    [letter] = sink.get_dead_letters(due_only=False)
+    assert (letter.unit_key, letter.stage, letter.attempts) == (key, 'fetch', 1)
+    assert letter.params == unit()._asdict()
+
+    make_due(sink)
+    main.run_units(*clients, sink, main.dead_letter_units(sink))
+    [letter] = sink.get_dead_letters(due_only=False)
+    assert (letter.stage, letter.attempts) == ('write', 2)
+    assert retry_in(sink, key) == pytest.approx(2 * main.DEAD_LETTER_BACKOFF_SECONDS, abs=2)
+
+    make_due(sink)
+    main.run_units(*clients, sink, main.dead_letter_units(sink))
+    assert sink.get_dead_letters(due_only=False) == []
+
+
+def test_deferred_unit_is_not_dead_lettered(sink, clients, monkeypatch):
+    def load_referral_day(metrika, sink, day):
+        raise MetrikaCircuitOpenError('Endpoint /stat/v1/data is degraded')
+
+    monkeypatch.setattr(main, 'load_referral_day', load_referral_day)
+    assert main.run_units(*clients, sink, [unit()]) == [unit()]
+    assert sink.get_dead_letters(due_only=False) == []
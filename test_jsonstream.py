@@ -0,0 +1,74 @@
+import json
+import pytest
+
+from exceptions import MetrikaAPIError
+from jsonstream import JsonStream
+
+# Ответы с числами, строками и многобайтовыми символами в строках массива и в метаданных до и после него
+BODIES = [
+    '{"query": {"metrics": ["ym:s:visits"]}, "data": [{"dimensions": [{"name": "Яндекс"}], '
+    '"metrics": [12.5, 1e5, -3, 0.25E-2]}], "totals": [12.5], "sample_share": 0.875}',
+    '{"data": [2.5, 10, 1e5, 123456789], "sample_share": 1.0E+2, "total_rows": 4}',
+    '{"count": 3, "queries": [{"query_text": "рак лёгкого", "indicators": {"TOTAL_CLICKS": 7}}], "done": true}',
+    '{"data": []}',
+]
+
+
+class FakeResponse:
+    """Ответ requests, отдающий тело заданными кусками"""
+
+    def __init__(self, chunks: list):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def decode(chunks: list, array_key: str = 'data') -> tuple:
+    stream = JsonStream(FakeResponse(chunks), array_key)
+    rows = list(stream)
+    return rows, stream.meta
+
+
+@pytest.mark.parametrize('body', BODIES)
+def test_every_chunk_boundary(body):
+    document = json.loads(body)
+    array_key = 'queries' if 'queries' in document else 'data'
+    expected_meta = {key: value for key, value in document.items() if key != array_key}
+    raw = body.encode('utf-8')
+    # Граница куска на каждом байте, в том числе внутри чисел и многобайтовых символов
+    for split in range(1, len(raw)):
+        rows, meta = decode([raw[:split], raw[split:]], array_key)
+        assert rows == document[array_key], split
+        assert meta == expected_meta, split
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    ([b'{"data":[2.', b'5]}'], [2.5]),
+    ([b'{"data":[1e', b'5]}'], [1e5]),
+    ([b'{"data":[12', b'3]}'], [123]),
+])
+def test_number_split_across_chunks(chunks, expected):
+    assert decode(chunks)[0] == expected
+
+
+def test_meta_number_split_after_array():
+    rows, meta = decode([b'{"data":[], "sample_share": 0.', b'5}'])
+    assert rows == [] and meta == {'sample_share': 0.5}
+
+
+def test_single_byte_chunks():
+    raw = BODIES[0].encode('utf-8')
+    rows, meta = decode([raw[i:i + 1] for i in range(len(raw))])
+    assert rows == json.loads(BODIES[0])['data']
+    assert meta['sample_share'] == 0.875
+
+
+@pytest.mark.parametrize('body', [b'{"data":[1,2', b'{"data":[2.', b'{"data":[1] "x"}'])
+def test_malformed_body(body):
+    with pytest.raises(MetrikaAPIError):
+        decode([body])
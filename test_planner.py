@@ -0,0 +1,224 @@
+import pytest
+
+from core import (
+    MAX_DIMENSIONS_PER_REQUEST, MAX_METRICS_PER_REQUEST, TRAFFIC_TYPES, MetrikaQuery, MetrikaQueryPlanner,
+    YandexMetrika
+)
+
+# Визиты: (источник, поисковик, раздел входа, просмотры, отказ)
+SESSIONS = [
+    ('organic', 'Yandex', '/a/', 3, 0),
+    ('organic', 'Yandex', '/a/', 1, 1),
+    ('organic', 'Yandex.Images', '/a/', 2, 0),
+    ('organic', 'Google', '/a/', 5, 0),
+    ('organic', 'Google', '/b/', 1, 1),
+    ('organic', 'Bing', '/a/', 1, 1),
+    ('direct', '(none)', '/a/', 4, 0),
+    ('direct', '(none)', '/b/', 2, 0),
+    ('social', '(none)', '/a/', 1, 1),
+    ('referral', '(none)', '/a/', 2, 0),
+    ('email', '(none)', '/b/', 1, 0),
+]
+FIELDS = ('ym:s:trafficSource', 'ym:s:searchEngine', 'ym:s:startURLPathLevel2')
+# У источника трафика API отдаёт id и подпись, у остальных группировок - только подпись
+SOURCE_LABELS = {'organic': 'Search engine traffic', 'direct': 'Direct traffic', 'social': 'Social network traffic',
+                 'referral': 'Link traffic', 'email': 'Mailing traffic'}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self) -> dict:
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeMetrika(YandexMetrika):
+    """Метрика, которая считает ответ /stat/v1/data по SESSIONS и запоминает параметры вызовов"""
+
+    def __init__(self):
+        super().__init__('token', '1')
+        self.sent = []
+
+    def _send(self, method, full_url, endpoint, **kwargs):
+        self.sent.append(kwargs['params'])
+        return FakeResponse(stat_data(kwargs['params']))
+
+
+def _matches(session: dict, filters: str) -> bool:
+    for condition in filter(None, (filters or '').split(' AND ')):
+        name, value = condition.split('==')
+        if session[name] != value.strip("'"):
+            return False
+    return True
+
+
+def _metric(metric: str, sessions: list) -> float:
+    if metric == 'ym:s:visits':
+        return float(len(sessions))
+    if metric == 'ym:s:pageviews':
+        return float(sum(s['pageviews'] for s in sessions))
+    if metric == 'ym:s:bounceRate':
+        return 100.0 * sum(s['bounce'] for s in sessions) / len(sessions)
+    raise AssertionError(metric)
+
+
+def _dimension(name: str, value: str) -> dict:
+    if name == 'ym:s:trafficSource':
+        return {'id': value, 'name': SOURCE_LABELS[value]}
+    return {'name': value}
+
+
+def stat_data(params: dict) -> dict:
+    """Ответ /stat/v1/data по параметрам запроса"""
+    sessions = [
+        dict(zip(FIELDS, row[:3]), pageviews=row[3], bounce=row[4])
+        for row in SESSIONS
+    ]
+    sessions = [s for s in sessions if _matches(s, params.get('filters'))]
+    metrics = params['metrics'].split(',')
+    dimensions = params['dimensions'].split(',') if params.get('dimensions') else []
+    groups = {}
+    for session in sessions:
+        groups.setdefault(tuple(session[d] for d in dimensions), []).append(session)
+    rows = [
+        {'dimensions': [_dimension(d, v) for d, v in zip(dimensions, key)],
+         'metrics': [_metric(m, group) for m in metrics]}
+        for key, group in sorted(groups.items())
+    ][:params.get('limit', 10000)]
+    return {'query': dict(params), 'data': rows, 'total_rows': len(rows),
+            'totals': [_metric(m, sessions) if sessions else 0.0 for m in metrics]}
+
+
+def _rows(result: dict) -> list:
+    return sorted(
+        (tuple(d.get('id', d['name']) for d in row['dimensions']), tuple(row['metrics']))
+        for row in result['data']
+    )
+
+
+def _section_queries(metrika: FakeMetrika, planner: MetrikaQueryPlanner, url: str = '/a/'):
+    """Запросы одного раздела, как их планирует main.load_section_period"""
+    traffic = metrika.plan_all_traffic_by_url(planner, '2024-01-01', '2024-01-31', url)
+    engines = metrika.plan_search_engines_traffic(planner, '2024-01-01', '2024-01-31', url)
+    return traffic, engines
+
+
+def test_section_merges_into_one_call():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika, max_rows=500)
+    _section_queries(metrika, planner)
+
+    assert planner.execute() == 1
+    assert metrika.sent == [{
+        'ids': '1',
+        'metrics': 'ym:s:visits',
+        'date1': '2024-01-01',
+        'date2': '2024-01-31',
+        'limit': 500,
+        'dimensions': 'ym:s:trafficSource,ym:s:searchEngine',
+        'filters': "ym:s:startURLPathLevel2=='/a/'"
+    }]
+
+
+def test_section_slices():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika)
+    traffic, engines = _section_queries(metrika, planner)
+    planner.execute()
+
+    sources = [row[0] for row in SESSIONS if row[2] == '/a/']
+    assert traffic() == {name: sources.count(source) for name, source in TRAFFIC_TYPES.items()}
+    # Поисковый трафик раздела - органические визиты, начавшиеся в разделе (ym:s:startURLPathLevel2)
+    assert engines() == {'yandex': 3.0, 'google': 1.0, 'other_search': 1.0}
+
+
+def test_section_slices_without_rows():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika)
+    traffic, engines = _section_queries(metrika, planner, '/missing/')
+    planner.execute()
+
+    assert traffic() == {name: 0 for name in TRAFFIC_TYPES}
+    assert engines() == {'yandex': 0, 'google': 0, 'other_search': 0}
+
+
+def test_rollup_matches_unmerged_queries():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika)
+    queries = [
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits', 'ym:s:pageviews'],
+                                 where={'ym:s:trafficSource': source}))
+        for source in ('organic', 'direct', 'social', 'ad')
+    ] + [
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits'], dimensions=['ym:s:searchEngine'],
+                                 where={'ym:s:trafficSource': 'organic'})),
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:pageviews'],
+                                 dimensions=['ym:s:startURLPathLevel2'])),
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits']))
+    ]
+    assert planner.execute() == 1
+
+    for query in queries:
+        alone = stat_data(query.params('1'))
+        assert _rows(query.result) == _rows(alone)
+        assert query.result['totals'] == alone['totals']
+
+
+def test_non_additive_metrics_are_not_rolled_up():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika)
+    bounce = planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits', 'ym:s:bounceRate'],
+                                      filters="ym:s:startURLPathLevel2=='/a/'"))
+    by_source = planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits'],
+                                         filters="ym:s:startURLPathLevel2=='/a/'",
+                                         where={'ym:s:trafficSource': 'organic'}))
+    # Отказы нельзя сложить по источникам, поэтому запросы уходят разными вызовами
+    assert planner.execute() == 2
+    assert _rows(bounce.result) == _rows(stat_data(bounce.params('1')))
+    assert _rows(by_source.result) == _rows(stat_data(by_source.params('1')))
+
+
+def test_standalone_query_is_sent_as_is():
+    metrika = FakeMetrika()
+    planner = MetrikaQueryPlanner(metrika)
+    query = planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits'], dimensions=['ym:s:searchEngine'],
+                                     limit=2, sort='-ym:s:visits'))
+    planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits']))
+
+    assert planner.execute() == 2
+    assert metrika.sent[0] == query.params('1')
+    assert query.result['query']['limit'] == 2
+
+
+@pytest.mark.parametrize('count, calls', [(MAX_METRICS_PER_REQUEST, 1), (MAX_METRICS_PER_REQUEST + 1, 2)])
+def test_split_by_metrics(count, calls):
+    planner = MetrikaQueryPlanner(FakeMetrika())
+    for i in range(count):
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', [f'ym:s:metric{i}']))
+
+    planned = planner.plan()
+    assert len(planned) == calls
+    assert [len(call.metrics) for call in planned] == ([MAX_METRICS_PER_REQUEST, 1] if calls > 1 else [count])
+    assert sum(len(call.queries) for call in planned) == count
+
+
+@pytest.mark.parametrize('count, calls', [(MAX_DIMENSIONS_PER_REQUEST, 1), (MAX_DIMENSIONS_PER_REQUEST + 1, 2)])
+def test_split_by_dimensions(count, calls):
+    planner = MetrikaQueryPlanner(FakeMetrika())
+    for i in range(count):
+        planner.add(MetrikaQuery('2024-01-01', '2024-01-31', ['ym:s:visits'], where={f'ym:s:dimension{i}': 'x'}))
+
+    planned = planner.plan()
+    assert len(planned) == calls
+    assert [len(call.dimensions) for call in planned] == ([MAX_DIMENSIONS_PER_REQUEST, 1] if calls > 1 else [count])
+    assert all(len(call.params('1', 10000)['dimensions'].split(',')) <= MAX_DIMENSIONS_PER_REQUEST
+               for call in planned)
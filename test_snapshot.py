@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+import snapshot
+
+from models import OrganicPageRow, TrafficRow
+from snapshot import open_snapshot, refresh_table
+
+
+class FakeSink:
+    """Строки таблиц по месяцам; версия месяца - (строк, наибольший updated_at), как у sinks"""
+
+    def __init__(self, tables: dict):
+        self.tables = tables  # таблица -> {месяц: (строки, updated_at)}
+        self.reads = []
+
+    def get_month_versions(self, table: str) -> dict:
+        return {month: (len(rows), updated_at) for month, (rows, updated_at) in self.tables.get(table, {}).items()}
+
+    def iter_month_rows(self, table: str, row_type, month: str):
+        self.reads.append((table, month))
+        return iter(self.tables[table][month][0])
+
+
+def traffic(url: str, day: str, visits, google=None) -> TrafficRow:
+    return TrafficRow(url, day, day, 1, 2, 0, 0, 0, 0, 0, google, 3, 12.5, 1.5, 60.0, visits, day[:7])
+
+
+TRAFFIC = {
+    '2024-01': ([traffic('/a/', '2024-01-01', 10, 4), traffic('/b/', '2024-01-02', 5, None),
+                 traffic('/a/', '2024-01-02', 7, 1)], '2024-02-01 00:00:00'),
+    '2024-02': ([traffic('/b/', '2024-02-01', 3, 2)], '2024-03-01 00:00:00')
+}
+PAGES = {
+    '2024-01': ([OrganicPageRow('/a/', '/a/x/', '2024-01-01', '2024-01-31', 10.0, 5, 50.0, 'Январь 2024'),
+                 OrganicPageRow('/a/', None, '2024-01-01', '2024-01-31', 20.0, 5, 50.0, 'Январь 2024')],
+                '2024-02-01 00:00:00')
+}
+
+
+@pytest.fixture
+def sink():
+    return FakeSink({'all_traffic_by_url': dict(TRAFFIC), 'organic_pages_by_url': dict(PAGES)})
+
+
+def months(table: str, output_dir, **kwargs) -> dict:
+    return dict(open_snapshot(table, str(output_dir), **kwargs))
+
+
+def test_round_trip(sink, tmp_path):
+    result = refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    assert (result['written'], result['rows']) == (['2024-01', '2024-02'], 4)
+
+    january = months('all_traffic_by_url', tmp_path)['2024-01']
+    assert len(january) == 3
+    assert january.values('url').tolist() == ['/a/', '/b/', '/a/']
+    assert january.values('date_from').tolist() == \
+        np.array(['2024-01-01', '2024-01-02', '2024-01-02'], dtype='datetime64[D]').tolist()
+    # Колонка int без пропусков остаётся int64, с пропуском хранится как float64 с NaN
+    assert january.column('visits').dtype == np.int64
+    assert january.column('visits').tolist() == [10, 5, 7]
+    google = january.column('google_traffic')
+    assert google.dtype == np.float64 and np.isnan(google[1]) and google[[0, 2]].tolist() == [4.0, 1.0]
+    assert january.column('bounce_rate').tolist() == [12.5, 12.5, 12.5]
+    assert january.labels('url').tolist() == ['/a/', '/b/']
+
+    assert list(months('all_traffic_by_url', tmp_path, month_from='2024-02')) == ['2024-02']
+    assert list(months('all_traffic_by_url', tmp_path, month_to='2024-01')) == ['2024-01']
+
+
+def test_none_strings(sink, tmp_path):
+    refresh_table(sink, 'organic_pages_by_url', str(tmp_path))
+    january = months('organic_pages_by_url', tmp_path)['2024-01']
+
+    assert january.values('page_url').tolist() == ['/a/x/', None]
+    assert january.column('page_url').tolist() == [0, -1]
+    assert january.values('month_year').tolist() == ['Январь 2024', 'Январь 2024']
+
+
+def test_unchanged_months_are_skipped(sink, tmp_path):
+    refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    sink.reads.clear()
+
+    assert refresh_table(sink, 'all_traffic_by_url', str(tmp_path))['written'] == []
+    assert sink.reads == []
+
+    rows, _ = TRAFFIC['2024-02']
+    sink.tables['all_traffic_by_url']['2024-02'] = (rows + [traffic('/c/', '2024-02-02', 1, 0)],
+                                                    '2024-03-02 00:00:00')
+    result = refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    assert (result['written'], result['rows']) == (['2024-02'], 2)
+    assert sink.reads == [('all_traffic_by_url', '2024-02')]
+    assert months('all_traffic_by_url', tmp_path)['2024-02'].values('url').tolist() == ['/b/', '/c/']
+
+    assert refresh_table(sink, 'all_traffic_by_url', str(tmp_path), full=True)['written'] == ['2024-01', '2024-02']
+
+
+def test_reader_keeps_replaced_month(sink, tmp_path):
+    refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    # Читатель открыл снимок по прежнему манифесту и ещё не читал колонки
+    opened = months('all_traffic_by_url', tmp_path)
+
+    sink.tables['all_traffic_by_url']['2024-01'] = ([traffic('/d/', '2024-01-05', 1)], '2024-02-02 00:00:00')
+    del sink.tables['all_traffic_by_url']['2024-02']
+    result = refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    assert (result['written'], result['removed']) == (['2024-01'], ['2024-02'])
+
+    assert opened['2024-01'].values('url').tolist() == ['/a/', '/b/', '/a/']
+    assert opened['2024-02'].column('visits').tolist() == [3]
+    current = months('all_traffic_by_url', tmp_path)
+    assert list(current) == ['2024-01'] and current['2024-01'].values('url').tolist() == ['/d/']
+
+
+def test_retired_months_are_purged(sink, tmp_path, monkeypatch):
+    refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    sink.tables['all_traffic_by_url']['2024-01'] = ([traffic('/d/', '2024-01-05', 1)], '2024-02-02 00:00:00')
+    refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    table_dir = tmp_path / 'all_traffic_by_url'
+    assert sorted(path.name for path in table_dir.iterdir()) == ['2024-01.1', '2024-01.2', '2024-02.1',
+                                                                 'manifest.json']
+
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_RETIRE_SECONDS', 0)
+    refresh_table(sink, 'all_traffic_by_url', str(tmp_path))
+    assert sorted(path.name for path in table_dir.iterdir()) == ['2024-01.2', '2024-02.1', 'manifest.json']
+    assert snapshot.read_manifest(str(table_dir))['retired'] == {}
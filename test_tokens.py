@@ -0,0 +1,168 @@
+import core
+import pytest
+import time
+
+from datetime import date, timedelta
+from exceptions import MetrikaAPIError, MetrikaAuthError
+from resilience import TokenPool
+
+TOKENS = ['y0_secret-token-one', 'y0_secret-token-two']
+
+
+def test_acquire_prefers_headroom():
+    pool = TokenPool(TOKENS, per_day=10)
+    pool.tokens[0].calls = 4
+
+    assert [pool.acquire().index for _ in range(8)] == [2, 2, 2, 2, 1, 2, 1, 2]
+    assert [token.calls for token in pool.tokens] == [6, 6]
+
+
+def test_acquire_without_quota_balances_load():
+    pool = TokenPool(TOKENS)
+    assert [pool.acquire().index for _ in range(4)] == [1, 2, 1, 2]
+
+
+def test_denied_token_returns_after_cooldown():
+    pool = TokenPool(TOKENS, auth_cooldown_seconds=0.05)
+    pool.quarantine(pool.tokens[0], denied=True)
+
+    assert {pool.acquire().index for _ in range(3)} == {2}
+    time.sleep(0.06)
+    assert 1 in {pool.acquire().index for _ in range(3)}
+
+
+def test_quota_quarantine_lasts_until_midnight():
+    pool = TokenPool(TOKENS, per_day=10)
+    token = pool.tokens[0]
+    pool.quarantine(token)
+
+    seconds_left = token.quarantined_until - time.monotonic()
+    assert 0 < seconds_left <= 24 * 3600
+    assert not token.denied and token.quarantines == 1
+    assert pool.stats()[0][2]
+
+
+def test_all_denied_raises_auth_error():
+    pool = TokenPool(TOKENS)
+    for token in pool.tokens:
+        pool.quarantine(token, denied=True)
+
+    with pytest.raises(MetrikaAuthError):
+        pool.acquire()
+
+
+def test_exhausted_pool_raises_quota_error():
+    pool = TokenPool(TOKENS, per_day=10)
+    pool.quarantine(pool.tokens[0], denied=True)
+    pool.quarantine(pool.tokens[1])
+
+    with pytest.raises(MetrikaAPIError) as error:
+        pool.acquire()
+    assert not isinstance(error.value, MetrikaAuthError)
+    assert error.value.status_code == 429
+
+
+def test_headroom_resets_on_new_day():
+    pool = TokenPool(TOKENS[:1], per_day=10)
+    token = pool.tokens[0]
+    token.calls = 10
+    assert pool.exhausted(token)
+
+    token.day = date.today() - timedelta(days=1)
+    assert not pool.exhausted(token)
+    assert (token.day, token.calls) == (date.today(), 0)
+
+
+def test_tokens_are_not_exposed():
+    pool = TokenPool(TOKENS)
+    pool.acquire()
+    labels = [label for label, _, _ in pool.stats()]
+
+    assert labels == ['<token #1>', '<token #2>']
+    assert not any(secret[-4:] in repr(token) for secret in TOKENS for token in pool.tokens)
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, text: str = '{}', headers: dict = None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """Отвечает заданной последовательностью ответов и запоминает, каким токеном ушёл запрос"""
+
+    def __init__(self, responses: list):
+        self.responses = iter(responses)
+        self.tokens = []
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        self.tokens.append(headers['Authorization'].split()[1])
+        return next(self.responses)
+
+
+def client(responses: list, per_day: int = None):
+    client = core.BaseYandexClient(TokenPool(TOKENS, per_day=per_day), hedge=False)
+    client.session = FakeSession(responses)
+    client.pauses = []
+    client.limiter.pause = client.pauses.append
+    return client
+
+
+def throttled(retry_after: str = None) -> FakeResponse:
+    return FakeResponse(429, '{"errors": [{"error_type": "quota_requests_by_ip"}]}',
+                        {'Retry-After': retry_after} if retry_after else None)
+
+
+def test_rate_limit_429_backs_off_without_quarantine():
+    api = client([throttled('2'), throttled(), FakeResponse(200)])
+
+    assert api._send('GET', 'https://api/stat', '/stat').status_code == 200
+    assert api.pauses == [2.0, core.RATE_LIMIT_BACKOFF_SECONDS]
+    assert not any(blocked for _, _, blocked in api.tokens.stats())
+
+
+def test_rate_limit_429_gives_up_after_retries():
+    responses = [throttled('0') for _ in range(core.RATE_LIMIT_RETRIES + 1)]
+    api = client(responses)
+
+    response = api._send('GET', 'https://api/stat', '/stat')
+    assert response.status_code == 429
+    assert len(api.pauses) == core.RATE_LIMIT_RETRIES + 1
+    assert all(r.closed for r in responses[:-1])
+    assert api.breakers['/stat'].failures == 1
+
+
+def test_quota_429_rotates_token():
+    quota = FakeResponse(429, '{"errors": [{"error_type": "quota_requests_by_uid"}]}')
+    api = client([quota, FakeResponse(200)])
+
+    assert api._send('GET', 'https://api/stat', '/stat').status_code == 200
+    assert api.session.tokens == TOKENS
+    assert api.pauses == []
+    assert [blocked for _, _, blocked in api.tokens.stats()] == [True, False]
+
+
+def test_429_after_daily_quota_rotates_token():
+    # Первый токен этим запросом израсходовал per_day: 429 без квоты пользователя в ответе
+    # всё равно означает исчерпанную квоту
+    api = client([throttled(), FakeResponse(200)], per_day=5)
+    for token in api.tokens.tokens:
+        token.calls = 4
+
+    assert api._send('GET', 'https://api/stat', '/stat').status_code == 200
+    assert api.session.tokens == TOKENS
+    assert [blocked for _, _, blocked in api.tokens.stats()] == [True, False]
+
+
+def test_403_on_every_token_raises_auth_error():
+    api = client([FakeResponse(403), FakeResponse(403)])
+
+    assert api._send('GET', 'https://api/stat', '/stat').status_code == 403
+    assert all(token.denied for token in api.tokens.tokens)
+    with pytest.raises(MetrikaAuthError):
+        api.tokens.acquire()
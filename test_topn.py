@@ -0,0 +1,173 @@
+import random
+import pytest
+
+from collections import Counter
+from models import SearchQueryRow
+from sinks import SQLiteSink
+from topn import Summary, summarize, top_items
+
+MONTHS = [('2024-01-01', '2024-01-31'), ('2024-02-01', '2024-02-29'), ('2024-03-01', '2024-03-31'),
+          ('2024-04-01', '2024-04-30'), ('2024-05-01', '2024-05-31'), ('2024-06-01', '2024-06-30')]
+
+
+def random_periods(seed: int, periods: int = 6, universe: int = 300, per_period: int = 120) -> list:
+    """Веса элементов по периодам: распределение с тяжёлым хвостом, у каждого периода свой набор элементов"""
+    rng = random.Random(seed)
+    items = [f'item{i}' for i in range(universe)]
+    return [
+        {item: int(1000 / (1 + items.index(item)) ** 0.8 * rng.uniform(0.2, 3)) + rng.randint(0, 5)
+         for item in rng.sample(items, per_period)}
+        for _ in range(periods)
+    ]
+
+
+def merge_all(periods: list, period_capacity: int, capacity: int) -> Summary:
+    merged = Summary(capacity)
+    for weights in periods:
+        merged.merge(Summary.exact(weights, period_capacity))
+    return merged
+
+
+def exact_weights(periods: list) -> Counter:
+    total = Counter()
+    for weights in periods:
+        total.update(weights)
+    return total
+
+
+def check_bounds(merged: Summary, exact: Counter):
+    for item, weight in exact.items():
+        if item in merged.items:
+            lower, upper = merged.items[item]
+            assert lower <= weight <= upper, item
+        else:
+            assert weight <= merged.floor, item
+    assert merged.total == sum(exact.values())
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('period_capacity, capacity', [(20, 20), (40, 25), (15, 60)])
+def test_truncated_merge_bounds(seed, period_capacity, capacity):
+    periods = random_periods(seed)
+    merged = merge_all(periods, period_capacity, capacity)
+    exact = exact_weights(periods)
+
+    assert len(merged.items) <= capacity and merged.floor > 0
+    check_bounds(merged, exact)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('n', [1, 5, 10])
+def test_guaranteed_items_are_in_true_top(seed, n):
+    periods = random_periods(seed)
+    merged = merge_all(periods, 40, 40)
+    exact = exact_weights(periods)
+    # С учётом равных весов: элемент в топе, если его вес не меньше n-го по величине
+    nth_weight = sorted(exact.values(), reverse=True)[n - 1]
+
+    top = merged.top(n)
+    assert len(top) == n
+    for item in top:
+        assert item.lower <= exact[item.item] <= item.upper
+        if item.guaranteed:
+            assert exact[item.item] >= nth_weight, item
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_zero_floor_is_exact(seed):
+    periods = random_periods(seed, universe=50, per_period=30)
+    merged = merge_all(periods, 30, 50)
+    exact = exact_weights(periods)
+
+    assert merged.floor == 0
+    assert all(lower == upper == exact[item] for item, (lower, upper) in merged.items.items())
+    top = merged.top(10)
+    assert [item.upper for item in top] == sorted(exact.values(), reverse=True)[:10]
+    assert all(item.guaranteed for item in top)
+
+
+def test_merge_bounds_by_hand():
+    first = Summary.exact({'a': 100, 'b': 60, 'c': 50}, capacity=2)
+    second = Summary.exact({'c': 80, 'd': 70, 'a': 5}, capacity=2)
+
+    merged = Summary(4)
+    merged.merge(first)
+    merged.merge(second)
+    # Элемент, которого нет в сводке периода, добирает до её floor: c во втором периоде весит 80,
+    # а в первом - не больше 50
+    assert merged.items == {'a': [100, 105], 'b': [60, 65], 'c': [80, 130], 'd': [70, 120]}
+    assert merged.floor == 55
+    # c лидирует по верхней оценке, но на самом деле a (105) тяжелее, поэтому гарантий нет
+    assert [(item.item, item.guaranteed) for item in merged.top(1)] == [('c', False)]
+
+    truncated = Summary(2)
+    truncated.merge(first)
+    truncated.merge(second)
+    # Отброшенный a (до 105) поднимает floor
+    assert truncated.items == {'c': [80, 130], 'd': [70, 120]}
+    assert truncated.floor == 105
+
+
+def test_guaranteed_by_hand():
+    merged = Summary(4)
+    merged.merge(Summary.exact({'a': 500, 'b': 60, 'c': 50}, capacity=2))
+    merged.merge(Summary.exact({'a': 400, 'd': 70, 'e': 5}, capacity=2))
+
+    assert merged.items == {'a': [900, 900], 'b': [60, 65], 'd': [70, 120]}
+    # d (не меньше 70) тяжелее b (не больше 65) и любого элемента вне сводки (не больше 55)
+    assert [(item.item, item.guaranteed) for item in merged.top(2)] == [('a', True), ('d', True)]
+    # Для топ-3 хватает и b: его нижняя оценка 60 выше floor 55
+    assert [(item.item, item.guaranteed) for item in merged.top(3)] == [('a', True), ('d', True), ('b', True)]
+
+
+class FakeSink:
+    """Хранилище сводок в памяти: сводки пишутся summarize, как при записи пачек"""
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def iter_topn_summaries(self, table, metric, date_from, date_to, scope=None):
+        return (row for row in self.rows
+                if row.metric == metric and date_from <= row.date_from and row.date_to <= date_to)
+
+
+def query_rows(periods: list) -> list:
+    return [
+        SearchQueryRow(item, clicks * 10, clicks, 3.5, date_from, date_to, date_from[:7])
+        for (date_from, date_to), weights in zip(MONTHS, periods)
+        for item, clicks in weights.items()
+    ]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_top_items_from_stored_summaries(seed):
+    periods = random_periods(seed)
+    rows = summarize('search_queries_webmaster', query_rows(periods), capacity=30)
+    sink = FakeSink(rows)
+
+    items, merged = top_items(sink, 'queries', '2024-01-01', '2024-06-30', n=10, capacity=40)
+    exact = exact_weights(periods)
+    check_bounds(merged, exact)
+    nth_weight = sorted(exact.values(), reverse=True)[9]
+    assert all(exact[item.item] >= nth_weight for item in items if item.guaranteed)
+
+    # Диапазон из части периодов читает только их сводки
+    items, merged = top_items(sink, 'queries', '2024-02-01', '2024-03-31', n=10, metric='shows', capacity=40)
+    assert merged.total == 10 * sum(exact_weights(periods[1:3]).values())
+
+
+def test_top_items_exact_on_sqlite(tmp_path):
+    sink = SQLiteSink(str(tmp_path / 'test.sqlite3'))
+    periods = random_periods(0, periods=3, universe=40, per_period=25)
+    for (date_from, date_to), weights in zip(MONTHS, periods):
+        sink.upsert_search_queries_webmaster_data([
+            SearchQueryRow(item, clicks * 10, clicks, 3.5, date_from, date_to, date_from[:7])
+            for item, clicks in weights.items()
+        ])
+    items, merged = top_items(sink, 'queries', '2024-01-01', '2024-03-31', n=5)
+    sink.close()
+
+    exact = exact_weights(periods)
+    assert merged.floor == 0
+    assert [item.lower for item in items] == sorted(exact.values(), reverse=True)[:5]
+    assert all(exact[item.item] == item.lower == item.upper for item in items)
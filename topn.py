@@ -0,0 +1,210 @@
+import argparse
+import os
+
+from datetime import date
+from dateutil.relativedelta import relativedelta
+from models import OrganicPageRow, ReferralUrlRow, SearchQueryRow, TopNSummaryRow
+from typing import NamedTuple
+
+# Сколько элементов хранит сводка одного периода. Элементы за пределами сводки
+# учитываются только верхней оценкой (floor), поэтому точность топа тем выше, чем больше запас
+TOPN_CAPACITY = int(os.getenv('TOPN_CAPACITY', 1000))
+
+# Таблица -> (тип строки, колонка элемента, метрики-веса, колонка области). Область разделяет
+# пачки одного периода: страницы входа пишутся отдельной пачкой на каждый раздел
+TOPN_TABLES = {
+    'search_queries_webmaster': (SearchQueryRow, 'query_text', ('clicks', 'shows'), None),
+    'search_queries_webmaster_daily': (SearchQueryRow, 'query_text', ('clicks', 'shows'), None),
+    'organic_pages_by_url': (OrganicPageRow, 'page_url', ('visits',), 'base_url'),
+    'referral_urls': (ReferralUrlRow, 'referral_url', ('visits',), None),
+    'referral_urls_daily': (ReferralUrlRow, 'referral_url', ('visits',), None)
+}
+# Что можно спросить у топа: источник -> таблица (месячная; дневная - с суффиксом _daily)
+TOPN_SOURCES = {
+    'queries': 'search_queries_webmaster',
+    'pages': 'organic_pages_by_url',
+    'referrers': 'referral_urls'
+}
+
+
+class TopItem(NamedTuple):
+    """
+    Элемент топа с оценкой веса за весь диапазон: точный вес лежит в [lower, upper].
+    guaranteed - элемент точно входит в топ-N, какими бы ни были неизвестные веса
+    """
+    item: str
+    lower: float
+    upper: float
+    guaranteed: bool
+
+
+class Summary:
+    """
+    Сводка тяжёлых элементов (mergeable space-saving).
+
+    Хранит не больше ``capacity`` элементов с нижней и верхней оценкой веса.
+    Любой элемент вне сводки весит не больше ``floor``; при floor == 0 сводка точная.
+    Сводки периодов сливаются merge() в одну с тем же ограничением на размер,
+    поэтому топ за любой диапазон считается в памяти O(capacity), а не O(строк).
+    """
+
+    __slots__ = ('capacity', 'items', 'floor', 'total')
+
+    def __init__(self, capacity: int = TOPN_CAPACITY):
+        self.capacity = capacity
+        self.items = {}  # элемент -> [нижняя, верхняя оценка]
+        self.floor = 0.0
+        self.total = 0.0
+
+    @classmethod
+    def exact(cls, weights: dict, capacity: int = TOPN_CAPACITY) -> 'Summary':
+        """Сводка полной пачки: веса известны точно, отбрасывается всё после capacity первых"""
+        summary = cls(capacity)
+        ranked = sorted(weights.items(), key=lambda pair: -pair[1])
+        summary.items = {item: [weight, weight] for item, weight in ranked[:capacity]}
+        summary.floor = ranked[capacity][1] if len(ranked) > capacity else 0.0
+        summary.total = float(sum(weights.values()))
+        return summary
+
+    @classmethod
+    def from_row(cls, row: TopNSummaryRow, capacity: int = TOPN_CAPACITY) -> 'Summary':
+        summary = cls(capacity)
+        summary.items = {item: [weight, weight] for item, weight in row.items}
+        summary.floor = row.floor
+        summary.total = row.total
+        return summary
+
+    def merge(self, other: 'Summary'):
+        """Добавляет к сводке другую (за другой период или область)"""
+        merged = {}
+        for item in self.items.keys() | other.items.keys():
+            mine = self.items.get(item)
+            theirs = other.items.get(item)
+            merged[item] = [
+                (mine[0] if mine else 0.0) + (theirs[0] if theirs else 0.0),
+                (mine[1] if mine else self.floor) + (theirs[1] if theirs else other.floor)
+            ]
+        floor = self.floor + other.floor
+        if len(merged) > self.capacity:
+            ranked = sorted(merged.items(), key=lambda pair: -pair[1][1])
+            floor = max(floor, ranked[self.capacity][1][1])
+            merged = dict(ranked[:self.capacity])
+        self.items = merged
+        self.floor = floor
+        self.total += other.total
+
+    def top(self, n: int) -> list:
+        """n элементов с наибольшей верхней оценкой"""
+        ranked = sorted(self.items.items(), key=lambda pair: (-pair[1][1], -pair[1][0]))
+        # Чтобы элемент точно был в топе, его нижняя оценка должна быть не меньше
+        # верхней оценки любого элемента за пределами первых n (в том числе не попавшего в сводку)
+        threshold = max(ranked[n][1][1] if len(ranked) > n else 0.0, self.floor)
+        return [
+            TopItem(item, lower, upper, lower >= threshold)
+            for item, (lower, upper) in ranked[:n]
+        ]
+
+
+def summarize(table: str, rows: list, capacity: int = TOPN_CAPACITY) -> list:
+    """
+    Сводки пачки строк таблицы из TOPN_TABLES: по одной на (период, область, метрику).
+    Пачка должна содержать все строки своего периода и области - так пишет пайплайн
+    """
+    _, item_column, metrics, scope_column = TOPN_TABLES[table]
+    groups = {}
+    for row in rows:
+        scope = getattr(row, scope_column) if scope_column else ''
+        group = groups.setdefault((row.date_from, row.date_to, scope), {metric: {} for metric in metrics})
+        item = getattr(row, item_column)
+        for metric in metrics:
+            weights = group[metric]
+            weights[item] = weights.get(item, 0) + (getattr(row, metric) or 0)
+
+    summaries = []
+    for (date_from, date_to, scope), group in groups.items():
+        for metric, weights in group.items():
+            summary = Summary.exact(weights, capacity)
+            summaries.append(TopNSummaryRow(
+                table, metric, scope, date_from, date_to, summary.floor, summary.total,
+                [[item, lower] for item, (lower, _) in summary.items.items()]
+            ))
+    return summaries
+
+
+def top_items(sink, source: str, date_from: str, date_to: str, n: int = 500, metric: str = None,
+              grain: str = 'monthly', scope: str = None, capacity: int = None) -> tuple:
+    """
+    Топ-N элементов источника за диапазон по сводкам периодов, без чтения исходных строк
+
+    :param source: 'queries', 'pages' или 'referrers'
+    :param metric: Вес (по умолчанию первая метрика таблицы: clicks или visits)
+    :param grain: 'monthly' или 'daily' - из каких таблиц брать сводки
+    :param scope: Только эта область (для pages - раздел)
+    :param capacity: Размер сводки при слиянии (по умолчанию max(TOPN_CAPACITY, 4n))
+    :return: (список TopItem, сводка всего диапазона)
+    """
+    table = TOPN_SOURCES[source] + ('_daily' if grain == 'daily' else '')
+    if table not in TOPN_TABLES:
+        raise ValueError(f"Для {source} нет дневной таблицы")
+    metric = metric or TOPN_TABLES[table][2][0]
+    merged = Summary(capacity or max(TOPN_CAPACITY, 4 * n))
+    for row in sink.iter_topn_summaries(table, metric, date_from, date_to, scope):
+        merged.merge(Summary.from_row(row, merged.capacity))
+    return merged.top(n), merged
+
+
+def rebuild(sink, table: str, date_from: str, date_to: str) -> int:
+    """
+    Пересчитывает сводки по уже записанным строкам таблицы (для данных, загруженных
+    до появления сводок). Читается по одному периоду за раз
+
+    :return: Количество записанных сводок
+    """
+    written = 0
+    for period in sorted({period_from for period_from, _ in sink.get_loaded_days(table, date_from, date_to)}):
+        summaries = summarize(table, sink.get_period_rows(table, TOPN_TABLES[table][0], period))
+        sink.put_topn_summaries(summaries)
+        written += len(summaries)
+    return written
+
+
+def parse_args():
+    today = date.today()
+    parser = argparse.ArgumentParser(description='Топ запросов, страниц и рефереров за несколько периодов')
+    parser.add_argument('--storage', choices=['postgres', 'sqlite', 'null'],
+                        help='Хранилище (по умолчанию STORAGE_BACKEND или postgres)')
+    parser.add_argument('--date-from', default=(today.replace(day=1) - relativedelta(months=12)).strftime('%Y-%m-%d'),
+                        help='Начало диапазона (по умолчанию 12 полных месяцев назад)')
+    parser.add_argument('--date-to', default=today.strftime('%Y-%m-%d'))
+    parser.add_argument('--grain', choices=['monthly', 'daily'], default='monthly')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    top = commands.add_parser('top', help='Вывести топ-N')
+    top.add_argument('source', choices=list(TOPN_SOURCES))
+    top.add_argument('-n', type=int, default=500)
+    top.add_argument('--metric', help='Вес: clicks/shows для queries, visits для остальных')
+    top.add_argument('--scope', help='Только эта область (раздел для pages)')
+
+    commands.add_parser('rebuild', help='Пересчитать сводки по уже загруженным строкам')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # sinks сами импортируют этот модуль для сводок при записи, поэтому здесь - только при запуске
+    from logs import setup_logging
+    from sinks import get_sink
+
+    args = parse_args()
+    setup_logging()
+    with get_sink(args.storage) as sink:
+        sink.create_tables()
+        if args.command == 'rebuild':
+            for table in TOPN_TABLES:
+                print(f"{table}: {rebuild(sink, table, args.date_from, args.date_to)} сводок")
+        else:
+            items, summary = top_items(sink, args.source, args.date_from, args.date_to, args.n, args.metric,
+                                       args.grain, args.scope)
+            for place, item in enumerate(items, 1):
+                weight = f"{item.lower:.0f}" if item.lower == item.upper else f"{item.lower:.0f}-{item.upper:.0f}"
+                print(f"{place:>4}  {weight:>15}  {'' if item.guaranteed else '~'}  {item.item}")
+            print(f"Всего за диапазон: {summary.total:.0f}, вне сводки каждый элемент не больше {summary.floor:.0f}")
@@ -46,6 +46,22 @@ def generate_monthly_periods(from_date: str, to_date: str) -> List[Tuple[str, st
     
     return periods
 
+def generate_daily_periods(from_date: str, to_date: str) -> List[str]:
+    """
+    Генерирует список дней между указанными датами включительно
+    
+    :param from_date: Начальная дата в формате 'YYYY-MM-DD'
+    :param to_date: Конечная дата в формате 'YYYY-MM-DD'
+    :return: Список дат 'YYYY-MM-DD'
+    """
+    current_date = datetime.strptime(from_date, "%Y-%m-%d").date()
+    end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
+    days = []
+    while current_date <= end_date:
+        days.append(current_date.strftime("%Y-%m-%d"))
+        current_date += timedelta(days=1)
+    return days
+
 def format_date(date: str):
     '''2025-07-20 в July 2025
     